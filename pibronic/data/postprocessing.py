@@ -334,6 +334,9 @@ def load_analytic_data(FS, T, analytic):
             analytic["alpha_plus"] = analytic["Z"] / in_dict[temperature]["Z_sampling+beta"]
             analytic["alpha_minus"] = analytic["Z"] / in_dict[temperature]["Z_sampling-beta"]
 
+            # the results at every temperature in the file, the reweighted analysis needs more than one
+            analytic["temperatures"] = {key: value for key, value in in_dict.items() if key not in ("hash_vib", "hash_rho")}
+
     except OSError as err:
         # skip if we cannot obtain all the necessary data
         print("Skipped data from {:s} at temperature {:.2f}".format(path, T))
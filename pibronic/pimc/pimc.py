@@ -1,12 +1,18 @@
 # pimc.py
 
 # system imports
-import itertools as it
+import multiprocessing as mp
+import multiprocessing.connection
+# import itertools as it
 from functools import partial
 # import cProfile
+import ctypes
 import json
-# import time
-# import sys
+import time
+import signal
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 # third party imports
@@ -44,21 +50,73 @@ __all__ = [
            "BoxResultPM",
            "block_compute",
            "block_compute_pm",
+           "block_compute_pm_parallel",
+           "available_cpus",
            ]
 
 
 float_tolerance = 1e-23
+# eigenvalues of the quadratic terms smaller than this (relative to the largest) are dropped by the "low_rank" kernel
+low_rank_tolerance = 1e-13
+
+# the per bead costs of the quadratic kernels, in units of one pair of modes gathered by the "sparse" kernel
+# measured with tests/speed_tests/quadratic_coupling_kernels.py (B = 20, P = 15, A = 4, N = 12 to 128)
+# a pair of modes in the "dense" einsum costs 2.2 to 3.3 times as much for N >= 32
+dense_pair_cost = 3.
+# a multiply add of the "low_rank" projections is 1.1 (N = 12) to 13 (N = 128) times cheaper, 3 times from N = 32
+low_rank_multiply_add_cost = 1. / 3.
+# on top of which each eigenpair has about as much fixed work as 8 more modes
+low_rank_overhead_modes = 8
+
+# the engine doesn't use numpy's global random state
+# every block draws from its own Generator, see BoxData.block_rng()
+
+
+def circulant_eigenvalues(P):
+    """returns the eigenvalues of the P x P circulant matrix defined by [0, 1, 0, ..., 0, 1]
+    they are 2cos(2 pi k / P) and are ordered to match the modes of real_fourier_transform()
+    k = 0, then a cosine and a sine mode for each k = 1, ..., (P-1)//2, then k = P/2 if P is even"""
+    pairs = (P - 1) // 2
+    k = np.concatenate(([0], np.repeat(np.arange(1, pairs + 1), 2), [P // 2] if P % 2 == 0 else []))
+    return 2. * np.cos(2. * np.pi * k / P)
+
+
+def real_fourier_transform(coefficients):
+    """Transforms normal mode co-ordinates to bead co-ordinates along the last axis
+    this is equivalent to multiplying by the orthonormal matrix of real Fourier modes, which are the
+    eigenvectors of the circulant matrix, but it only costs O(P log P) per transform instead of O(P^2)
+    the modes are ordered as described in circulant_eigenvalues()"""
+    P = coefficients.shape[-1]
+    pairs = (P - 1) // 2
+    spectrum = np.zeros(coefficients.shape[:-1] + (P // 2 + 1,), dtype=np.complex128)
+
+    # the constant mode
+    spectrum.real[..., 0] = np.sqrt(P) * coefficients[..., 0]
+    # the cosine and sine modes
+    spectrum.real[..., 1:pairs+1] = np.sqrt(P / 2.) * coefficients[..., 1:2*pairs+1:2]
+    spectrum.imag[..., 1:pairs+1] = -np.sqrt(P / 2.) * coefficients[..., 2:2*pairs+2:2]
+    # the alternating mode
+    if P % 2 == 0:
+        spectrum.real[..., -1] = np.sqrt(P) * coefficients[..., -1]
+
+    return np.fft.irfft(spectrum, n=P, axis=-1)
 
-""" TODO - eventually this should be replaced so that each time a sample is drawn
-a new seed is generated and stored in the results file indexed with the fraction it generated
-"""
-np.random.seed()  # random
-# np.random.seed(232942)  # pick our seed
+
+def real_fourier_basis(P):
+    """returns the P x P orthonormal matrix whose columns are the modes used by real_fourier_transform()"""
+    return real_fourier_transform(np.eye(P)).T
 
 
 class TemperatureDependentClass:
-    """store temperature dependent constants here"""
-    def __init__(self, model, tau):
+    """store temperature dependent constants here
+    tau can also be a 1D array of K values, then every tensor has an extra leading K axis
+    so that the O matrices for all of them are built in a single pass, see select()
+    the O matrices and their prefactors are stored as dtype, see BoxData.dtype"""
+    def __init__(self, model, tau, dtype=F64):
+        # the stacked taus broadcast against the trailing (AN) axes
+        K = np.shape(tau)
+        tau = np.asarray(tau, dtype=F64)[..., NEW, NEW]
+
         # construct the coth and csch tensors
         omega = np.broadcast_to(model.omega, model.size['AN'])
         self.cothAN = np.tanh(hbar*tau*omega)**(-1.)
@@ -68,26 +126,61 @@ class TemperatureDependentClass:
         self.cothANP = self.cothAN.copy().reshape(*self.cothAN.shape, 1)
         self.cschANP = self.cschAN.copy().reshape(*self.cschAN.shape, 1)
 
-        self.cothBANP = self.cothAN.copy().reshape(1, *self.cothAN.shape, 1)
-        self.cschBANP = self.cschAN.copy().reshape(1, *self.cschAN.shape, 1)
-
         # this is the constant prefactor that doesn't depend on sampled co-ordinates
         energy = np.diag(model.energy) if len(model.energy.shape) > 1 else model.energy
         tilde_energy = energy + model.delta_weight  # this is \tilde{E} from equation 34 on page 4
-        prefactor = np.broadcast_to(tilde_energy, model.size['BPA'])
-        self.omatrix_prefactor = np.exp(-tau * prefactor.copy())
         # this prefactor is F^P in equation 41 on page 5 where F is defined in equation 32
-        prefactor = np.broadcast_to(self.cschAN, model.size['BPAN'])
-        self.omatrix_prefactor *= np.prod(prefactor.copy(), axis=3)**0.5
+        # only its natural logarithm is stored, the prefactor itself is formed by omatrix_prefactor when it is needed
+        # log(csch(x)) = log(2) - x - log(1 - exp(-2x)) doesn't overflow for large x
+        x = hbar*tau*omega
+        log_cschAN = np.log(2.) - x - np.log(-np.expm1(-2.*x))
+        log_prefactor = -tau[..., 0] * tilde_energy + 0.5 * log_cschAN.sum(axis=-1)
+        self.log_omatrix_prefactor = np.broadcast_to(log_prefactor[..., NEW, NEW, :], K + model.size['BPA']).astype(dtype)
+        self._omatrix_prefactor = None
 
         # note that there is no sqrt(1/2*pi) because it factors out of the numerator and denominator
 
+        # the first and second derivatives with respect to tau, used by build_o_matrix_derivatives()
+        # d coth(x)/d tau = -hbar omega csch^2(x) and d csch(x)/d tau = -hbar omega csch(x) coth(x)
+        w = hbar*omega
+        self.dcothAN = -w * self.cschAN**2.
+        self.dcschAN = -w * self.cschAN * self.cothAN
+        self.d2cothAN = 2. * w**2. * self.cschAN**2. * self.cothAN
+        self.d2cschAN = w**2. * self.cschAN * (self.cothAN**2. + self.cschAN**2.)
+        # d log(csch(x))/d tau = -hbar omega coth(x)
+        self.dlog_prefactor = -tilde_energy - 0.5 * np.sum(w * self.cothAN, axis=-1)
+        self.d2log_prefactor = 0.5 * np.sum(w**2. * self.cschAN**2., axis=-1)
+
         # cache for the Omatrix on each block loop
-        self.omatrix = np.zeros(model.size['BPAA'])
+        # the O matrices are diagonal in the surfaces so we only store the diagonal
+        self.omatrix = np.zeros(K + model.size['BPA'], dtype=dtype)
         # cache for the Omatrix scaling factor on each block loop
-        self.omatrix_scaling = np.empty(model.size['BP'])
+        self.omatrix_scaling = np.empty(K + model.size['BP'], dtype=dtype)
+        # cache for O'/O and O''/O, the derivatives with respect to tau relative to the O matrix
+        self.omatrix_d1 = np.zeros(K + model.size['BPA'], dtype=dtype)
+        self.omatrix_d2 = np.zeros(K + model.size['BPA'], dtype=dtype)
         return
 
+    @property
+    def omatrix_prefactor(self):
+        """the prefactor of the O matrices, only build_o_matrix(log=False) needs it
+        so it is formed from log_omatrix_prefactor the first time it is used, at large tau it can overflow the dtype"""
+        if self._omatrix_prefactor is None:
+            self._omatrix_prefactor = np.exp(self.log_omatrix_prefactor)
+        return self._omatrix_prefactor
+
+    @omatrix_prefactor.setter
+    def omatrix_prefactor(self, prefactor):
+        self._omatrix_prefactor = prefactor
+
+    def select(self, k):
+        """returns a TemperatureDependentClass for the k-th tau of a stacked object
+        its tensors are views, so O matrices built for the whole stack can be used through it"""
+        view = TemperatureDependentClass.__new__(TemperatureDependentClass)
+        for name, tensor in vars(self).items():
+            setattr(view, name, None if tensor is None else tensor[k])
+        return view
+
 
 class ModelClass:
     """information describing a quantum mechanical system"""
@@ -100,6 +193,9 @@ class ModelClass:
     cubic = None
     quartic = None
 
+    # the energy of each surface with the linear terms folded in, E_aa + delta_a, see precompute()
+    tilde_energy = None
+
     def __init__(self, states=1, modes=1):
         """x"""
         self.states = states
@@ -108,6 +204,16 @@ class ModelClass:
         self.mode_range = range(modes)
         return
 
+    def log_harmonic_partition_function(self, beta):
+        """returns the natural logarithm of the partition function of the model's surfaces without any coupling
+        the sum over the surfaces of exp(-beta E~_a) / prod over the modes of 2 sinh(beta omega / 2)
+        this is the integral of the trace of the bead product of the model's O matrices,
+        up to the constants that are left out of them (see TemperatureDependentClass)"""
+        exponent = -beta * self.tilde_energy
+        largest = np.amax(exponent)
+        log_sum = largest + np.log(np.sum(np.exp(exponent - largest)))
+        return log_sum - np.sum(np.log(2. * np.sinh(0.5 * beta * self.omega)))
+
     @classmethod
     def from_json_file(cls, path):
         """constructor wrapper"""
@@ -131,14 +237,11 @@ class ModelClass:
             self.linear = kwargs[VMK.G1] if VMK.G1 in kwargs else np.zeros(shape[VMK.G1], dtype=F64)
             self.quadratic = kwargs[VMK.G2] if VMK.G2 in kwargs else np.zeros(shape[VMK.G2], dtype=F64)
         else:
-            kwargs = {}
-            kwargs[VMK.N] = self.modes
-            kwargs[VMK.A] = self.states
-            kwargs[VMK.E] = self.energy
-            kwargs[VMK.w] = self.omega
-            kwargs[VMK.G1] = self.linear
-            kwargs[VMK.G2] = self.quadratic
-            vIO.load_model_from_JSON(path, kwargs)
+            # copy the parameters into the arrays we already have, so their shapes are checked
+            kwargs = vIO.load_model_from_JSON(path)
+            for key, array in [(VMK.E, self.energy), (VMK.w, self.omega), (VMK.G1, self.linear), (VMK.G2, self.quadratic)]:
+                array[:] = kwargs[key] if key in kwargs else 0.0
+                kwargs[key] = array
         # should we update the states and modes after loading the model?
         self.modes = kwargs[VMK.N]
         self.states = kwargs[VMK.A]
@@ -146,6 +249,9 @@ class ModelClass:
         self.omega = kwargs[VMK.w]
         self.linear = kwargs[VMK.G1]
         self.quadratic = kwargs[VMK.G2]
+        # the cubic and quartic terms are optional and are only kept if the model has them
+        self.cubic = kwargs.get(VMK.G3)
+        self.quartic = kwargs.get(VMK.G4)
         return
 
 
@@ -156,6 +262,8 @@ class ModelVibronic(ModelClass):
         self.size = data.size
         self.beta = data.beta
         self.tau = data.tau
+        self.reweight_taus = data.reweight_taus
+        self.dtype = data.dtype
 
         # model parameters
         self.omega = np.zeros(self.size['N'], dtype=F64)
@@ -202,7 +310,14 @@ class ModelVibronic(ModelClass):
 
     def initialize_TDP_object(self):
         """creates the TemperatureDependentClass object"""
-        self.const = TemperatureDependentClass(self, self.tau)
+        self.const = TemperatureDependentClass(self, self.tau, self.dtype)
+        return
+
+    def initialize_reweight_object(self):
+        """creates a stacked TemperatureDependentClass object for the reweighting taus, if there are any"""
+        self.const_reweight = None
+        if self.reweight_taus is not None:
+            self.const_reweight = TemperatureDependentClass(self, self.reweight_taus, self.dtype)
         return
 
     def finish_folding_in_terms(self, data):
@@ -217,6 +332,81 @@ class ModelVibronic(ModelClass):
             self.energy[a, a] = 0.0
         return
 
+    def analyse_coupling_structure(self, data):
+        """picks the kernel build_coupling_matrix() uses for the quadratic terms and precomputes its terms
+
+        the quadratic terms are symmetrized over the modes, so each unordered pair of modes (j1, j2) appears once
+        "diagonal" - only the j1 == j2 terms are nonzero, costing N A^2 per bead
+        "sparse"   - a list of the K nonzero pairs, costing K A^2 per bead
+        "low_rank" - for each pair of surfaces the N x N matrix of terms is written as its R largest eigenpairs,
+                     costing R N A^2 per bead, R is the largest number of nonzero eigenvalues
+        "dense"    - the einsum over every pair of modes, costing N^2 A^2 per bead
+        unless data.quadratic_kernel names one of them, the cheapest is chosen
+        the linear terms are only contracted over the modes which have nonzero (off diagonal) linear terms
+        """
+        N, A = self.modes, self.states
+
+        # the coupling matrix is only symmetric in the surfaces if all of its terms are, checked once here
+        for terms in (self.energy, self.linear, self.quadratic, self.cubic, self.quartic):
+            if terms is not None:
+                assert np.allclose(terms, terms.swapaxes(-1, -2)), "the coupling terms must be symmetric in the surfaces"
+
+        # 0.5 * (Q + Q^T) over the modes, so the quadratic term is the sum over j1 <= j2 of q_j1 q_j2 S_j1j2
+        symmetric = 0.5 * (self.quadratic + self.quadratic.swapaxes(0, 1))
+        upper = np.triu_indices(N)
+        pair_terms = np.where((upper[0] == upper[1])[:, NEW, NEW], 0.5, 1.) * symmetric[upper]
+        nonzero = np.any(pair_terms != 0., axis=(1, 2))
+        self.quadratic_pairs = tuple(index[nonzero] for index in upper)
+        K = len(self.quadratic_pairs[0])
+
+        # the eigenpairs of each surface pair's matrix of terms, largest magnitude first
+        eigvals, eigvects = np.linalg.eigh(symmetric.transpose(2, 3, 0, 1))
+        order = np.argsort(-np.abs(eigvals), axis=-1)
+        eigvals = np.take_along_axis(eigvals, order, axis=-1)
+        eigvects = np.take_along_axis(eigvects, order[..., NEW, :], axis=-1)
+        cutoff = low_rank_tolerance * np.amax(np.abs(eigvals), initial=0.)
+        R = int(np.amax(np.sum(np.abs(eigvals) > cutoff, axis=-1), initial=0))
+
+        # relative cost per bead, the low rank projections are one wide matrix product
+        cost = {"dense": dense_pair_cost * N**2,
+                "diagonal": N,
+                "sparse": K,
+                "low_rank": low_rank_multiply_add_cost * R * (N + low_rank_overhead_modes),
+                }
+        if np.any(self.quadratic_pairs[0] != self.quadratic_pairs[1]):
+            del cost["diagonal"]
+        self.quadratic_kernel = data.quadratic_kernel
+        if self.quadratic_kernel == "auto":
+            self.quadratic_kernel = min(cost, key=cost.get)
+        assert self.quadratic_kernel in cost, f"the quadratic terms aren't compatible with {self.quadratic_kernel}"
+
+        # the terms are stored as (number of terms, A*A) matrices so each kernel ends with one matmul
+        # except for the dense kernel's einsum, which uses the (NNAA) terms
+        # they are stored as data.dtype so they are contracted with the co-ordinates in the same precision
+        dtype = data.dtype
+        if self.quadratic_kernel == "dense":
+            self.quadratic_terms = (0.5 * self.quadratic).astype(dtype)
+        elif self.quadratic_kernel == "diagonal":
+            self.quadratic_terms = (0.5 * symmetric[range(N), range(N)]).reshape(N, A*A).astype(dtype)
+        elif self.quadratic_kernel == "sparse":
+            self.quadratic_terms = pair_terms[nonzero].reshape(K, A*A).astype(dtype)
+        elif self.quadratic_kernel == "low_rank":
+            # V_ab = 0.5 * sum_r lambda_abr (u_abr . q)^2, the projections are (N, R*A*A) and the weights (R*A*A)
+            self.quadratic_terms = (eigvects[..., :R].transpose(2, 3, 0, 1).reshape(N, R*A*A).astype(dtype),
+                                    (0.5 * eigvals[..., :R]).transpose(2, 0, 1).reshape(R*A*A).astype(dtype))
+
+        self.linear_modes = np.flatnonzero(np.any(self.linear != 0., axis=(1, 2)))
+        self.linear_terms = self.linear[self.linear_modes].reshape(-1, A*A).astype(dtype)
+
+        # the cubic and quartic terms are contracted as lists of their nonzero monomials
+        self.anharmonic_terms = []
+        for tensor in (self.cubic, self.quartic):
+            if tensor is not None:
+                modes, terms = collect_monomials(tensor)
+                if len(terms) > 0:
+                    self.anharmonic_terms.append((modes, terms.astype(dtype)))
+        return
+
     def precompute(self, data):
         """precompute some constants"""
 
@@ -224,14 +414,17 @@ class ModelVibronic(ModelClass):
 
         # duplicate the diagonal and then zero it for later use in the M matrix
         energyDiag = np.diag(self.energy).copy()
+        self.tilde_energy = energyDiag + self.delta_weight
 
         self.optimize_energy()
 
         # self.compute_weight_for_each_state(energyDiag)
 
         self.initialize_TDP_object()
+        self.initialize_reweight_object()
 
         self.finish_folding_in_terms(data)
+        self.analyse_coupling_structure(data)
         return
 
 
@@ -249,12 +442,11 @@ class ModelVibronicPM(ModelVibronic):
         return
 
     def initialize_TDP_object(self):
-        """creates the TemperatureDependentClass object"""
-
-        super().initialize_TDP_object()
-
-        self.const_plus = TemperatureDependentClass(self, self.tau_plus)
-        self.const_minus = TemperatureDependentClass(self, self.tau_minus)
+        """creates a stacked TemperatureDependentClass object for tau, tau+ and tau-
+        const, const_plus and const_minus are views into it"""
+        taus = np.array([self.tau, self.tau_plus, self.tau_minus])
+        self.const_stack = TemperatureDependentClass(self, taus, self.dtype)
+        self.const, self.const_plus, self.const_minus = [self.const_stack.select(k) for k in range(len(taus))]
         return
 
     # precompute some constants
@@ -277,6 +469,7 @@ class ModelSampling(ModelClass):
         self.size_list = data.size_list.copy()
         self.tau = data.tau
         self.beta = data.beta
+        self.dtype = data.dtype
         return
 
     def load_model(self, filePath):
@@ -304,6 +497,11 @@ class ModelSampling(ModelClass):
         self.state_shift = np.zeros(self.size['AN'], dtype=F64)
         self.cc_samples = np.zeros(self.size['BNP'], dtype=F64)
 
+        # the sampling constants of the current block, gathered from the per state constants
+        self.sample_sources = np.zeros(self.size['B'], dtype=np.intp)
+        self.sample_shift = np.zeros(self.size['BN'], dtype=F64)
+        self.sample_deviation = np.zeros(self.size['BNP'], dtype=F64)
+
         # this brings up the good point that we might want to load a JSON file without providing the number of modes and surfaces
         kwargs = {}
         kwargs[VMK.N] = self.modes
@@ -323,14 +521,31 @@ class ModelSampling(ModelClass):
         self.quadratic = kwargs[VMK.G2]
         return
 
-    def draw_sample(self, sample_view):
-        """Generates collective co-ordinates and stores them in self.cc_samples with dimensions BNP"""
-        # collective co-ordinate samples
-        self.cc_samples = np.random.normal(
-                                    loc=self.sample_means,
-                                    scale=self.standard_deviation[sample_view],
-                                    size=self.size['BNP'],
-                                    )
+    def draw_sample(self, sample_view, rng, antithetic=False):
+        """Generates collective co-ordinates and stores them in self.cc_samples with dimensions BNP
+        the random numbers are drawn from the provided generator rng
+        each sample in the block first picks the surface it is drawn from, stored in self.sample_sources
+        if antithetic is True the block is made of mirrored pairs, samples 2i and 2i+1 are drawn from the same surface
+        and the collective co-ordinates of 2i+1 are the negation of those of 2i, so they mirror each other about its mean"""
+        if antithetic:
+            # each pair shares one surface and one set of random numbers
+            B = self.size['B'][0]
+            self.sample_sources[:] = np.repeat(rng.choice(self.states, size=B // 2, p=self.state_weight), 2)
+            draws = rng.standard_normal(size=(B // 2, *self.size['BNP'][1:]))
+            self.cc_samples[0::2] = draws
+            np.negative(draws, out=self.cc_samples[1::2])
+        else:
+            # generate random surfaces to draw samples from
+            self.sample_sources[:] = rng.choice(self.states, size=self.size['B'], p=self.state_weight)
+
+        # gather the constants of the chosen surfaces
+        np.take(self.state_shift, self.sample_sources, axis=0, out=self.sample_shift)
+        np.take(self.standard_deviation, self.sample_sources, axis=0, out=self.sample_deviation)
+
+        # collective co-ordinate samples, the Gaussians have zero mean
+        if not antithetic:
+            rng.standard_normal(size=self.size['BNP'], out=self.cc_samples)
+        self.cc_samples *= self.sample_deviation
         return
 
     def compute_linear_displacement(self):
@@ -340,7 +555,9 @@ class ModelSampling(ModelClass):
 
     def compute_weight_for_each_state(self):
         """these are the weights for the oscillators associated with each state"""
-        self.state_weight = np.exp(-self.beta * (self.energy + self.delta_weight))
+        exponent = -self.beta * (self.energy + self.delta_weight)
+        # shifting the exponent doesn't change the normalized weights but stops exp() from overflowing
+        self.state_weight = np.exp(exponent - np.amax(exponent))
         # self.state_weight /= 2. * np.prod(np.sinh((self.beta * self.omega) / 2.))
 
         # we believe the factor of 2 on the outside cancels out in equation 49.
@@ -366,7 +583,7 @@ class ModelSampling(ModelClass):
 
     def initialize_TDP_object(self):
         """creates the TemperatureDependentClass object"""
-        self.const = TemperatureDependentClass(self, self.tau)
+        self.const = TemperatureDependentClass(self, self.tau, self.dtype)
         return
 
     def finish_folding_in_terms(self):
@@ -381,28 +598,14 @@ class ModelSampling(ModelClass):
         return
 
     def compute_sampling_constants(self, data):
-
-        # generate random surfaces to draw samples from
-        self.sample_sources = np.random.choice(range(self.states),
-                                               size=self.size['X'],
-                                               p=self.state_weight
-                                               )
-
-        import collections
-        np.set_printoptions(threshold=1E6)
-        print("sample sources", self.sample_sources)
-        print(collections.Counter(self.sample_sources))
-
-        # the ordered offsets for multiple surfaces
-        self.sample_shift = self.state_shift[self.sample_sources, :]
-        # calculate the means of each Gaussian
+        """the constants are stored per surface (ANP), the surfaces are only chosen when a block is drawn
+        so the memory used doesn't depend on the number of samples"""
 
         # inverse_covariance_matrix = 2. * coth_tensor[:, :, NEW] - sch_tensor[:, :, NEW] * O_eigvals[NEW, NEW, :]
         # inverse_covariance_matrix = 2. * self.const.coth[..., NEW] - self.const.csch[..., NEW] * data.circulant_eigvals[NEW, NEW, ...]
         self.inverse_covariance = (2. * self.const.cothANP
                                    - self.const.cschANP * data.circulant_eigvals)
-        self.standard_deviation = np.sqrt(1. / self.inverse_covariance[self.sample_sources, ...])
-        self.sample_means = np.zeros(self.size['BNP'], dtype=F64)
+        self.standard_deviation = np.sqrt(1. / self.inverse_covariance)
         return
 
     # precompute some constants
@@ -413,6 +616,7 @@ class ModelSampling(ModelClass):
         self.compute_linear_displacement()
 
         self.optimize_energy()
+        self.tilde_energy = self.energy + self.delta_weight
 
         self.compute_weight_for_each_state()
 
@@ -424,6 +628,89 @@ class ModelSampling(ModelClass):
         return
 
 
+class BoxWorkspace:
+    """Preallocated storage for the temporaries of the per block kernels
+    every buffer is sized once (in BoxData.preprocess()) and then overwritten by each block
+    so the block loop doesn't have to allocate large arrays
+    the per bead buffers are stored as data.dtype, the bead products are always accumulated in double precision"""
+
+    def __init__(self, data):
+        B, P, N, A = data.block_size, data.beads, data.modes, data.states
+        half = P - P // 2  # ceil(P/2) beads are left after the first pass of a pairwise product
+        dtype = data.dtype
+
+        # build_o_matrix()
+        self.rolled = np.empty(data.size['BNP'], dtype=dtype)
+        self.features = np.empty((B, P, 3*N), dtype=dtype)
+
+        # build_coupling_matrix(), the products of the co-ordinates each quadratic kernel contracts with its terms
+        self.coupling_linear = np.empty(data.size['BPAA'], dtype=dtype)
+        self.coupling_coordinates = np.empty((N, B*P), dtype=dtype)
+        self.anharmonic_products = [np.empty((len(terms), B*P), dtype=dtype) for _, terms in data.vib.anharmonic_terms]
+        # the co-ordinates of the modes with linear terms are gathered here, unless every mode has them
+        self.linear_coordinates = None
+        if len(data.vib.linear_modes) < N:
+            self.linear_coordinates = np.empty((len(data.vib.linear_modes), B*P), dtype=dtype)
+        kernel = data.vib.quadratic_kernel
+        self.coupling_products = None
+        if kernel == "diagonal":
+            self.coupling_products = np.empty((N, B*P), dtype=dtype)
+        elif kernel == "sparse":
+            self.coupling_products = np.empty((2, len(data.vib.quadratic_pairs[0]), B*P), dtype=dtype)
+        elif kernel == "low_rank":
+            self.coupling_products = np.empty((B*P, data.vib.quadratic_terms[1].size), dtype=dtype)
+
+        # build_M_matrix()
+        self.diagonal = np.empty(data.size['BPA'], dtype=dtype)
+        self.scaled_eigvects = np.empty(data.size['BPAA'], dtype=dtype)
+        self.pade = PadeWorkspace(data.size['BPAA'], dtype) if data.use_pade_exponential() else None
+
+        # the serial bead product alternates between this and data.numerator
+        self.numerator = np.empty(data.size['BAA'], dtype=F64)
+
+        # the pairwise bead products alternate between each pair of buffers
+        self.bead_pairs = None
+        self.diagonal_pairs = None
+        self.control_pairs = None
+        if data.use_tree_product():
+            self.bead_pairs = tuple(np.empty((B, half, A, A), dtype=F64) for _ in range(2))
+            self.diagonal_pairs = tuple(np.empty((B, half, data.rho.states), dtype=F64) for _ in range(2))
+            if data.control_variates:
+                self.control_pairs = tuple(np.empty((B, half, A), dtype=F64) for _ in range(2))
+
+        # build_derivative_numerator(), the derivatives of M, the (A, A', A''/2) triples and their products
+        self.derivative_M = None
+        self.derivative_chain = None
+        self.derivative_numerators = None
+        if data.derivatives:
+            self.derivative_M = np.empty((2, B, P, A, A), dtype=dtype)
+            self.derivative_chain = np.empty((3, B, P, A, A), dtype=dtype)
+            self.derivative_numerators = np.empty((2, 3, B, A, A), dtype=F64)
+
+        # build_reweighted_numerator(), for the taus of BoxData.reweight_temperatures
+        self.reweight_stack = None
+        self.reweight_numerators = None
+        self.reweight_bead_pairs = None
+        if data.reweight_taus is not None:
+            K = len(data.reweight_taus)
+            self.reweight_stack = np.empty((K, B, P, A, A), dtype=dtype)
+            self.reweight_numerators = tuple(np.empty((K*B, A, A), dtype=F64) for _ in range(2))
+            if data.use_tree_product():
+                self.reweight_bead_pairs = tuple(np.empty((K*B, half, A, A), dtype=F64) for _ in range(2))
+
+        # build_stacked_numerator(), for the K taus of a stacked TemperatureDependentClass
+        K = data.number_of_taus
+        self.folded_stack = None
+        self.stack_numerators = None
+        self.stack_bead_pairs = None
+        if K > 1:
+            self.folded_stack = np.empty((K, B, P, A, A), dtype=dtype)
+            self.stack_numerators = tuple(np.empty((K*B, A, A), dtype=F64) for _ in range(2))
+            if data.use_tree_product():
+                self.stack_bead_pairs = tuple(np.empty((K*B, half, A, A), dtype=F64) for _ in range(2))
+        return
+
+
 class BoxData:
     """use this to pass execution parameters back and forth between methods"""
     block_size = 0
@@ -444,6 +731,92 @@ class BoxData:
     id_data = 0
     id_rho = 0
 
+    # how the products over the beads are computed, either "serial", "tree" or "auto"
+    # "auto" uses the tree (pairwise) reduction when there are bead_product_crossover or more beads
+    bead_product = "auto"
+    bead_product_crossover = 16
+
+    # how the collective co-ordinates are transformed to bead co-ordinates, either "fft" or "dense"
+    # "fft" uses the closed form eigenvectors of the circulant matrix (real Fourier modes)
+    # "dense" diagonalizes the circulant matrix and multiplies by its eigenvectors
+    normal_mode_transform = "fft"
+
+    # if True the numerator and denominator of each sample are stored as a mantissa
+    # and the natural logarithm of a scaling factor, which stops them from overflowing
+    # or underflowing for large numbers of beads or low temperatures
+    log_scale = False
+
+    # if True block_compute() also stores the first and second derivatives of g with respect to beta
+    # for each sample (see build_derivative_numerator()), so the energy and heat capacity don't need g+ and g-
+    derivatives = False
+
+    # how the coupling matrices are diagonalized, either "lapack", "closed_form", "jacobi" or "auto" (see symmetric_eigh())
+    # "auto" uses the vectorized closed form kernels when there are 3 or fewer surfaces and LAPACK otherwise
+    eigen_solver = "auto"
+
+    # how the quadratic terms of the coupling matrix are built, either "dense", "diagonal", "sparse", "low_rank" or "auto"
+    # "auto" picks the cheapest kernel the structure of the vibronic model's quadratic terms allows
+    # see ModelVibronic.analyse_coupling_structure()
+    quadratic_kernel = "auto"
+
+    # how the M matrices exp(-tau V) are computed, either "eigh", "pade" or "auto"
+    # "eigh" rebuilds them from the eigendecomposition of the coupling matrix V
+    # "pade" uses a scaling and squaring Pade approximant which skips the diagonalization (see expm_pade())
+    # "auto" uses "pade" when there are matrix_exponential_crossover or more surfaces and only one tau per block,
+    # reweighting builds M for several taus from one eigendecomposition so it stays with "eigh"
+    # the gain from "pade" is modest (see tests/speed_tests/matrix_exponential_backend.py) so it is opt-in
+    matrix_exponential = "eigh"
+    matrix_exponential_crossover = 4
+
+    # the precision of the co-ordinates, the O matrices and the coupling and M matrices, either np.float64 or np.float32
+    # with np.float32 the per bead tensors take half the memory and bandwidth, but the products over the beads,
+    # the traces and the logarithms of the scaling factors are still accumulated in double precision
+    # see tests/speed_tests/single_precision_bias.py for the bias this introduces relative to np.float64
+    dtype = F64
+
+    # the samples drawn at temperature can also be reweighted to the temperatures in this list
+    # for each of them g is evaluated on the same samples, sharing the eigendecomposition of the coupling matrix
+    # g is also evaluated at beta +/- constants.delta_beta so E and Cv can be estimated at each temperature
+    # see build_reweighted_numerator(), None disables the reweighting
+    reweight_temperatures = None
+    reweight_taus = None
+
+    # the denominators of these other sampling models are also evaluated on the samples drawn from rho
+    # so candidate sampling models can be compared without sampling from each of them (see build_extra_denominators())
+    # the ids label the models' columns in the results and the paths are their json files, None disables this
+    extra_rho_ids = None
+    path_extra_rho_models = None
+
+    # entropy of the seed that each block's random number stream is spawned from
+    # if it is None then preprocess() will draw fresh entropy from the OS
+    seed = None
+    # the job's streams are spawned from the seed with this id, so jobs sharing a seed don't share samples
+    id_job = None
+
+    # the serial drivers save the completed blocks every checkpoint_blocks blocks and/or checkpoint_seconds seconds
+    # and whenever they receive SIGUSR1 or SIGTERM (after which they exit), None disables that trigger
+    checkpoint_blocks = None
+    checkpoint_seconds = None
+    # if True the serial drivers continue from the blocks already saved in this job's result file
+    resume = False
+
+    # if True the next block is drawn and transformed on a helper thread while the current block is computed
+    prefetch = True
+
+    # if True each block is drawn as mirrored pairs of samples (see ModelSampling.draw_sample())
+    # samples 2i and 2i+1 are reflections of each other about the mean of the surface they were drawn from
+    # the pairs are correlated so the statistics treat each of them as one sample (see stats.pair_antithetic_terms())
+    antithetic = False
+
+    # if True the drivers also store the harmonic control variate h of each sample, which costs about as much as rho
+    # h is the trace of the bead product of the vibronic model's O matrices without the coupling matrix,
+    # its expected value Z_h / Z_rho is known analytically (see harmonic_control_means()) so it can be used
+    # as a control variate for g (see stats.apply_control_variates())
+    control_variates = False
+
+    # the number of taus the vibronic model's constants are stacked over (see TemperatureDependentClass)
+    number_of_taus = 1
+
     # instance of the ModelVibronic class
     # holds all parameters associated with the model
     vib = None
@@ -533,6 +906,9 @@ class BoxData:
                 SEP.R: self.id_rho,
                 SEP.beta: self.beta,
                 SEP.tau: self.tau,
+                SEP.seed: self.seed,
+                SEP.rwT: None if self.reweight_temperatures is None else self.reweight_temperatures.tolist(),
+                SEP.xR: self.extra_rho_ids,
                 # "s": self.hash_vib,
                 # "x": self.hash_rho,
             }
@@ -573,6 +949,12 @@ class BoxData:
             self.tau = params[SEP.tau.value]
         else:
             self.tau = self.beta / self.beads
+        # the seed is optional, without it preprocess() draws fresh entropy
+        if SEP.seed.value in params.keys():
+            self.seed = params[SEP.seed.value]
+        # the reweighting temperatures are optional
+        if params.get(SEP.rwT.value) is not None:
+            self.reweight_temperatures = params[SEP.rwT.value]
         # dumb hacks
         if SEP.dB.value in params.keys():
             if type(params[SEP.dB.value]) is float:
@@ -587,47 +969,152 @@ class BoxData:
         self.hash_vib = FS.hash_vib
         self.hash_rho = FS.hash_rho
 
+        # the extra sampling models are optional
+        if params.get(SEP.xR.value) is not None:
+            self.extra_rho_ids = params[SEP.xR.value]
+            self.path_extra_rho_models = [
+                file_structure.FileStructure(params["path_root"], self.id_data, id_rho).path_rho_model
+                for id_rho in self.extra_rho_ids
+                ]
+
         for k, v in params.items():
             log.debug(type(v), k, v)
 
         return
 
-    def draw_sample(self, sample_view):
+    def rng_job_key(self):
+        """returns the integer that identifies this job's streams, jobs without an id use 0"""
+        return 0 if self.id_job is None else int(self.id_job)
+
+    def block_rng(self, block_index):
+        """returns the random number generator for the block block_index
+        each block has its own independent stream spawned from self.seed (first by job then by block),
+        so a block draws the same samples no matter which process computes it or in which order"""
+        seed_sequence = np.random.SeedSequence(self.seed, spawn_key=(self.rng_job_key(), block_index))
+        return np.random.default_rng(seed_sequence)
+
+    def regenerate_block(self, block_index):
+        """redraws the samples of the block block_index and transforms them to bead dependent co-ordinates
+        returns a copy of the co-ordinates R (BNP) and the surfaces they were sampled from (B)
+        the data object needs the same seed and id_job as the run that produced the block"""
+        start = block_index * self.block_size
+        sample_view = slice(start, start + self.block_size)
+        self.draw_sample(sample_view, block_index)
+        self.transform_sampled_coordinates(sample_view)
+        return self.qTensor.copy(), self.rho.sample_sources.copy()
+
+    def assert_exponent_range(self):
+        """draws the first block and checks that its M matrices, at each tau they are built for, fit in self.dtype
+        so a configuration whose M matrices overflow is rejected before any results are computed
+        without log_scale the blocks are checked again as they are computed, see assert_exponents_in_range()"""
+        self.regenerate_block(0)
+        build_coupling_matrix(self)
+        symmetric_eigh(self.coupling_matrix, self.eigen_solver, out=(self.coupling_eigvals, self.coupling_eigvects))
+        taus = [self.tau] if self.reweight_taus is None else [self.tau, *self.reweight_taus]
+        for tau in taus:
+            assert_exponents_in_range(-tau * self.coupling_eigvals, self.dtype)
+        return
+
+    def use_tree_product(self):
+        """returns True if the bead products should be computed with pairwise_bead_product()"""
+        if self.bead_product == "auto":
+            return self.beads >= self.bead_product_crossover
+        return self.bead_product == "tree"
+
+    def harmonic_control_means(self, betas=None):
+        """returns the expected values of h/rho (see BoxData.control_variates) for h at each of the betas
+        by default only at self.beta, the samples are always drawn from rho at self.beta so E[h/rho] = Z_h / Z_rho
+        where both partition functions are those of the uncoupled harmonic surfaces (see log_harmonic_partition_function())"""
+        betas = [self.beta] if betas is None else betas
+        log_Z_rho = self.rho.log_harmonic_partition_function(self.beta)
+        return np.exp([self.vib.log_harmonic_partition_function(beta) - log_Z_rho for beta in betas])
+
+    def use_pade_exponential(self):
+        """returns True if the M matrices should be computed with expm_pade() instead of diagonalizing V"""
+        if self.matrix_exponential == "auto":
+            return self.states >= self.matrix_exponential_crossover and self.reweight_temperatures is None
+        return self.matrix_exponential == "pade"
+
+    def draw_sample(self, sample_view, block_index):
         """Draws samples from the distribution rho -
         the rho object fills its cc_samples parameter with collective co-ordinates
         which will be transformed to bead dependent co-ordinates by self.transform_sampled_coordinates()"""
-        self.rho.draw_sample(sample_view)
+        self.rho.draw_sample(sample_view, self.block_rng(block_index), self.antithetic)
         return
 
-    def generate_random_R_values(self, result, storage_array, sample_view):
+    def generate_random_R_values(self, result, storage_array, sample_view, block_index):
         """Randomly generates R values that have no relation to the distribution rho or g
-        they only have the correct dimensions BANP and are shifted appropriately """
+        they only have the correct dimensions BNP, the surface dependent displacements are applied by build_o_matrix()"""
         # generate sample points in dimensionless co-ordinates R
-        storage_array[sample_view, :, :] = np.random.random(size=self.rho.size['BNP'])
-        np.copyto(self.qTensor, storage_array[sample_view, NEW, ...])
-
-        # we transform the dimensionless co-ordinates to surface dependent co-ordinates q = R - d
-        self.qTensor -= self.vib.state_shift[NEW, :, :, NEW]
+        storage_array[sample_view, :, :] = self.block_rng(block_index).random(size=self.rho.size['BNP'])
+        np.copyto(self.qTensor, storage_array[sample_view, ...])
         return
 
-    def transform_sampled_coordinates(self, sample_view):
-        """transform from collective co-ordinates to bead dependent co-ordinates"""
+    def transform_sampled_coordinates(self, sample_view, out=None):
+        """transform from collective co-ordinates to bead dependent co-ordinates
+        the co-ordinates are stored in out (BNP), by default self.qTensor"""
+        out = self.qTensor if out is None else out
         # self.qTensor = np.broadcast_to(np.einsum('ab,ijb->ija', self.circulant_eigvects, self.cc_samples), self.size['XANP'])
         # self.qTensor = np.einsum('ab,ijb->ija', self.circulant_eigvects, self.cc_samples)[:, NEW, :, :]
         # self.qTensor = np.einsum('ab,ijb->ija', self.circulant_eigvects, self.cc_samples)[:, NEW, ...]
-        self.qTensor[:] = np.einsum('ab,ijb->ija',
-                                    self.circulant_eigvects,
-                                    self.rho.cc_samples,
-                                    )[:, NEW, ...]
+        if self.normal_mode_transform == "fft":
+            out[:] = real_fourier_transform(self.rho.cc_samples)
+        else:
+            np.einsum('ab,ijb->ija',
+                      self.circulant_eigvects,
+                      self.rho.cc_samples,
+                      out=out,
+                      casting='same_kind',
+                      )
 
         # remove sample dependent normal mode displacement (from sampling model)
-        self.qTensor += self.rho.sample_shift[sample_view, NEW, :, NEW]
-        for a in range(self.rho.states):
-            self.qTempTensor[:, a, ...] = self.qTensor[:, 0, ...].copy()
+        # the surface dependent displacements of each model are applied inside build_o_matrix()
+        out += self.rho.sample_shift[:, :, NEW]
+        return
 
-        # add surface dependent normal mode displacement (from vibronic model)
-        # self.qTensor -= self.vib.state_shift[NEW, :, :, NEW]
+    def prepare_block(self, block_index, out):
+        """draws the samples of the block block_index and stores their bead dependent co-ordinates in out (BNP)"""
+        start = block_index * self.block_size
+        sample_view = slice(start, start + self.block_size)
+        self.draw_sample(sample_view, block_index)
+        self.transform_sampled_coordinates(sample_view, out)
+        return
 
+    def sampled_blocks(self, block_indices):
+        """yields each block index once the co-ordinates of that block are in self.qTensor
+        if self.prefetch is True the next block is prepared on a helper thread while the caller computes
+        the current one, the two blocks alternate between a pair of buffers
+        the sampling and the transform only use self.rho's buffers, which the kernels don't touch,
+        and numpy releases the GIL in both so they overlap with the linear algebra"""
+        if not self.prefetch:
+            for block_index in block_indices:
+                self.prepare_block(block_index, self.qTensor)
+                yield block_index
+            return
+
+        buffers = (self.qTensor, np.empty_like(self.qTensor))
+        indices = iter(block_indices)
+        current = next(indices, None)
+        if current is None:
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            slot = 0
+            pending = executor.submit(self.prepare_block, current, buffers[slot])
+            try:
+                while current is not None:
+                    pending.result()
+                    upcoming = next(indices, None)
+                    if upcoming is not None:
+                        pending = executor.submit(self.prepare_block, upcoming, buffers[1 - slot])
+
+                    self.qTensor = buffers[slot]
+                    yield current
+                    current, slot = upcoming, 1 - slot
+            finally:
+                # wait for the helper before handing back the original buffer
+                pending.exception()
+                self.qTensor = buffers[0]
         return
 
     def initialize_models(self):
@@ -639,9 +1126,20 @@ class BoxData:
         self.rho = ModelSampling(self)
         self.rho.load_model(self.path_rho_model)
         self.rho.precompute(self)
+        return
 
-        tempSize = [self.block_size, self.rho.states, self.modes, self.beads]
-        self.qTempTensor = np.zeros(tempSize, dtype=F64)
+    def initialize_extra_sampling_models(self):
+        """loads the sampling models of extra_rho_ids, they are never sampled from"""
+        self.extra_rhos = []
+        if self.extra_rho_ids is None:
+            return
+
+        for path in self.path_extra_rho_models:
+            model = ModelSampling(self)
+            model.load_model(path)
+            model.precompute(self)
+            assert model.modes == self.modes, f"the sampling model {path:} has a different number of modes"
+            self.extra_rhos.append(model)
         return
 
     def preprocess(self):
@@ -654,7 +1152,7 @@ class BoxData:
                            'B': self.block_size, }
 
         self.size_list = ['X', 'P', 'N', 'A', 'B', 'XP',
-                          'BP', 'AN', 'NA', 'AA',
+                          'BP', 'BN', 'AN', 'NA', 'AA',
                           'BNP', 'BPA', 'BAA', 'XNP',
                           'NAA', 'NNA', 'ANP',
                           'BANP', 'BPAA', 'NNAA', 'BPAN', ]
@@ -668,32 +1166,73 @@ class BoxData:
         self.beta = constants.beta(self.temperature)
         self.tau = self.beta / self.beads
 
+        if self.seed is None:
+            self.seed = np.random.SeedSequence().entropy
+
+        assert self.bead_product in ["serial", "tree", "auto"], f"invalid bead_product {self.bead_product}"
+        assert self.eigen_solver in ["lapack", "closed_form", "jacobi", "auto"], f"invalid eigen_solver {self.eigen_solver}"
+        assert self.eigen_solver != "closed_form" or self.states <= 3, "closed_form eigen_solver requires 3 or fewer states"
+        assert self.matrix_exponential in ["eigh", "pade", "auto"], f"invalid matrix_exponential {self.matrix_exponential}"
+        kernels = ["dense", "diagonal", "sparse", "low_rank", "auto"]
+        assert self.quadratic_kernel in kernels, f"invalid quadratic_kernel {self.quadratic_kernel}"
+        assert not (self.derivatives and self.log_scale), "derivatives are not supported with log_scale"
+        assert np.dtype(self.dtype) in [np.float32, np.float64], f"invalid dtype {self.dtype}"
+        assert not self.antithetic or self.block_size % 2 == 0, "antithetic pairs need an even block_size"
+        assert not (self.control_variates and self.log_scale), "control variates are not supported with log_scale"
+        self.dtype = np.dtype(self.dtype)
+
+        if self.reweight_temperatures is not None:
+            assert not self.log_scale, "reweighting is not supported with log_scale"
+            self.reweight_temperatures = np.array(self.reweight_temperatures, dtype=F64, ndmin=1)
+            # the taus of beta, beta+ and beta- for each temperature, flattened from (K, 3)
+            shifts = np.array([0.0, constants.delta_beta, -constants.delta_beta])
+            betas = constants.beta(self.reweight_temperatures)[:, NEW] + shifts
+            self.reweight_taus = betas.ravel() / self.beads
+
+        if self.extra_rho_ids is not None:
+            assert not self.log_scale, "extra sampling models are not supported with log_scale"
+            assert len(self.extra_rho_ids) == len(self.path_extra_rho_models), "each extra rho id needs a model path"
+
         # where we store the transformed samples
-        self.qTensor = np.zeros(self.size['BANP'], dtype=F64)
-        # self.qTempTensor = None
+        # a single copy of the surface independent co-ordinates R is shared by all surfaces and models
+        self.qTensor = np.zeros(self.size['BNP'], dtype=self.dtype)
 
-        # storage for the numerator calculation
-        self.coupling_matrix = np.zeros(self.size['BPAA'])
-        self.coupling_eigvals = np.empty(self.size['BPA'])
-        self.coupling_eigvects = np.empty(self.size['BPAA'])
-        self.M_matrix = np.empty(self.size['BPAA'])
-        self.numerator = np.zeros(self.size['BAA'])
+        # storage for the numerator calculation, the bead products are accumulated in double precision
+        self.coupling_matrix = np.zeros(self.size['BPAA'], dtype=self.dtype)
+        self.coupling_eigvals = np.empty(self.size['BPA'], dtype=self.dtype)
+        self.coupling_eigvects = np.empty(self.size['BPAA'], dtype=self.dtype)
+        self.M_matrix = np.empty(self.size['BPAA'], dtype=self.dtype)
+        self.numerator = np.zeros(self.size['BAA'], dtype=F64)
 
-        # construct the circulant matrix
         assert self.beads >= 3, "circulant matrix requires 3 or more beads"  # hard check
-        defining_vector = [0, 1] + [0]*(self.beads-3) + [1]
-        self.circulant_matrix = scipy.linalg.circulant(defining_vector)
-
-        (self.circulant_eigvals,
-         self.circulant_eigvects
-         ) = np.linalg.eigh(self.circulant_matrix, UPLO='L')
+        assert self.normal_mode_transform in ["fft", "dense"], f"invalid normal_mode_transform {self.normal_mode_transform}"
+        if self.normal_mode_transform == "fft":
+            # the eigenvalues are known in closed form so we don't need to build or diagonalize the P x P matrix
+            self.circulant_eigvals = circulant_eigenvalues(self.beads)
+        else:
+            # construct the circulant matrix
+            defining_vector = [0, 1] + [0]*(self.beads-3) + [1]
+            self.circulant_matrix = scipy.linalg.circulant(defining_vector)
+            (self.circulant_eigvals,
+             self.circulant_eigvects
+             ) = np.linalg.eigh(self.circulant_matrix, UPLO='L')
 
         self.initialize_models()
+        self.initialize_extra_sampling_models()
+
+        # temporary storage shared by the kernels of every block
+        self.workspace = BoxWorkspace(self)
+
+        # with log_scale the M matrices are built relative to their lowest eigenvalue so they can't overflow
+        if not self.log_scale:
+            self.assert_exponent_range()
         return
 
 
 class BoxDataPM(BoxData):
     """plus minus version of BoxData"""
+    # tau, tau+ and tau-
+    number_of_taus = 3
     delta_beta = 0.0
     beta_plus = 0.0
     beta_minus = 0.0
@@ -720,21 +1259,101 @@ class BoxDataPM(BoxData):
         self.rho = ModelSampling(self)
         self.rho.load_model(self.path_rho_model)
         self.rho.precompute(self)
-
-        tempSize = [self.block_size, self.rho.states, self.modes, self.beads]
-        self.qTempTensor = np.zeros(tempSize, dtype=F64)
         return
 
     def preprocess(self):
         """"""
-        # compute extra constants
+        # do the usual work
+        super().preprocess()
+
+        # compute extra constants, after beta has been computed from the temperature
         self.beta_plus = self.beta + self.delta_beta
         self.beta_minus = self.beta - self.delta_beta
         self.tau_plus = self.beta_plus / self.beads
         self.tau_minus = self.beta_minus / self.beads
+        return
 
-        # do the usual work
-        super().preprocess()
+    def harmonic_control_means(self):
+        """returns the expected values of h/rho, h+/rho and h-/rho, see BoxData.harmonic_control_means()"""
+        return super().harmonic_control_means([self.beta, self.beta_plus, self.beta_minus])
+
+
+def allocate_array(shape):
+    """returns an array of NaN's used to store the results, shape is the number of samples or a tuple"""
+    return np.full(shape, np.nan, dtype=F64)
+
+
+def allocate_shared_array(shape):
+    """returns an array of NaN's backed by shared memory, shape is the number of samples or a tuple
+    processes forked after its creation write directly into the parent's copy"""
+    buffer = mp.RawArray(ctypes.c_double, int(np.prod(shape)))
+    array = np.frombuffer(buffer, dtype=F64).reshape(shape)
+    array[:] = np.nan
+    return array
+
+
+def write_result_file(path, arrays, compressed=False):
+    """saves the dictionary of arrays to path (a .npz file), compressed if compressed is True
+    the file is written to a temporary path and then renamed so an interrupted write can't corrupt it"""
+    temporary_path = path + ".tmp"
+    save = np.savez_compressed if compressed else np.savez
+    with open(temporary_path, mode='wb') as target_file:
+        save(target_file, **arrays)
+    os.replace(temporary_path, path)
+    return
+
+
+class ResultWriter:
+    """Writes result files on a background thread so the block loop doesn't wait on the file system
+    submit() takes a copy of the arrays, so the caller can keep filling them while the copy is written
+    at most maxsize writes can wait in the queue, after that submit() blocks until one has finished
+    close() (or leaving the with block) waits until every submitted write is on disk"""
+
+    def __init__(self, maxsize=2):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="ResultWriter", daemon=True)
+        self.thread.start()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def run(self):
+        """write each submitted file in order until close() is called"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                write_result_file(*item)
+            except Exception as e:
+                self.error = e
+
+    def raise_error(self):
+        """re-raises any error from the writer thread in the calling thread"""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return
+
+    def submit(self, path, arrays):
+        """queues a snapshot of the arrays to be written to path"""
+        self.raise_error()
+        snapshot = {k: np.array(v, copy=True) for k, v in arrays.items()}
+        self.queue.put((path, snapshot))
+        return
+
+    def close(self):
+        """flush every queued write and stop the thread"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
         return
 
 
@@ -748,12 +1367,54 @@ class BoxResult:
 
     key_list = ["number_of_samples", "s_rho", "s_g"]
 
+    # if True each quantity also has the natural logarithm of its scaling factor (see BoxData.log_scale)
+    log_scale = False
+    log_scale_rho = None
+    log_scale_g = None
+
+    # if True each sample also has the first and second derivatives of g with respect to beta (see BoxData.derivatives)
+    derivatives = False
+    scaled_dg = None
+    scaled_d2g = None
+
+    # the temperatures the samples were reweighted to and g, g+ and g- at each of them (X, K, 3)
+    # see BoxData.reweight_temperatures
+    reweight_temperatures = None
+    scaled_g_reweight = None
+
+    # the ids of the extra sampling models and their denominators (X, J), see BoxData.extra_rho_ids
+    extra_rho_ids = None
+    scaled_rho_extra = None
+
+    # if True the samples are mirrored pairs (2i, 2i+1), see BoxData.antithetic
+    antithetic = False
+
+    # if True each sample also has the harmonic control variate h, see BoxData.control_variates
+    # control_means are the expected values of h/rho (see BoxData.harmonic_control_means())
+    control_variates = False
+    scaled_h = None
+    control_means = None
+
+    # what is needed to regenerate any block of samples (see BoxData.block_rng())
+    seed = None
+    rng_job_key = 0
+    block_size = None
+    block_ids = None
+
     @classmethod
     def read_number_of_samples(cls, path_full):
         """x"""
         with np.load(path_full, mmap_mode='r') as data:
             return data["number_of_samples"]
 
+    @classmethod
+    def read_seed(cls, path_full):
+        """returns the seed entropy and job key stored in the file, (None, 0) for files that don't have them"""
+        with np.load(path_full, mmap_mode='r') as data:
+            if "seed" not in data.keys():
+                return None, 0
+            return int(str(data["seed"])), int(data["rng_job_key"])
+
     @classmethod
     def verify_result_keys_are_present(cls, path, fileObj):
         """x"""
@@ -770,9 +1431,138 @@ class BoxResult:
                 return False
         return True
 
-    def initialize_arrays(self):
-        self.scaled_g = np.full(self.samples, np.nan, dtype=F64)
-        self.scaled_rho = np.full(self.samples, np.nan, dtype=F64)
+    def initialize_arrays(self, shared=False):
+        """if shared is True the arrays are backed by shared memory so forked processes can fill them"""
+        allocate = allocate_shared_array if shared else allocate_array
+        self.scaled_g = allocate(self.samples)
+        self.scaled_rho = allocate(self.samples)
+        if self.log_scale:
+            self.log_scale_g = allocate(self.samples)
+            self.log_scale_rho = allocate(self.samples)
+        if self.derivatives:
+            self.scaled_dg = allocate(self.samples)
+            self.scaled_d2g = allocate(self.samples)
+        if self.reweight_temperatures is not None:
+            self.scaled_g_reweight = allocate((self.samples, len(self.reweight_temperatures), 3))
+        if self.extra_rho_ids is not None:
+            self.scaled_rho_extra = allocate((self.samples, len(self.extra_rho_ids)))
+        if self.control_variates:
+            self.scaled_h = allocate(self.samples)
+        return
+
+    def log_scale_arrays(self):
+        """returns a dictionary of the log scaling factors to be saved alongside the results"""
+        if not self.log_scale:
+            return {}
+        return {"ls_rho": self.log_scale_rho, "ls_g": self.log_scale_g}
+
+    def derivative_arrays(self):
+        """returns a dictionary of the derivatives of g to be saved alongside the results"""
+        if not self.derivatives:
+            return {}
+        return {"s_dg": self.scaled_dg, "s_d2g": self.scaled_d2g}
+
+    def reweight_arrays(self):
+        """returns a dictionary of g at the reweighting temperatures to be saved alongside the results"""
+        if self.reweight_temperatures is None:
+            return {}
+        return {"s_g_rw": self.scaled_g_reweight}
+
+    def extra_rho_arrays(self):
+        """returns a dictionary of the denominators of the extra sampling models to be saved alongside the results"""
+        if self.extra_rho_ids is None:
+            return {}
+        return {"s_rho_x": self.scaled_rho_extra}
+
+    def control_variate_arrays(self):
+        """returns a dictionary of the harmonic control variates to be saved alongside the results"""
+        if not self.control_variates:
+            return {}
+        return {"s_h": self.scaled_h}
+
+    def result_arrays(self):
+        """returns a dictionary of every per sample array, keyed by the name it is saved under"""
+        return {"s_rho": self.scaled_rho, "s_g": self.scaled_g,
+                **self.log_scale_arrays(), **self.derivative_arrays(), **self.reweight_arrays(),
+                **self.extra_rho_arrays(), **self.control_variate_arrays()}
+
+    def reweight_parameters(self):
+        """returns a dictionary of the reweighting temperatures, which are saved once rather than per sample"""
+        if self.reweight_temperatures is None:
+            return {}
+        return {"rw_T": self.reweight_temperatures}
+
+    def extra_rho_parameters(self):
+        """returns a dictionary of the ids of the extra sampling models, which are saved once rather than per sample"""
+        if self.extra_rho_ids is None:
+            return {}
+        return {"rho_x_ids": self.extra_rho_ids}
+
+    def control_variate_parameters(self):
+        """returns a dictionary of the expected values of the control variates, which are saved once rather than per sample"""
+        if not self.control_variates:
+            return {}
+        return {"h_mean": self.control_means}
+
+    def antithetic_parameters(self):
+        """returns a dictionary with the flag that marks the samples as antithetic pairs, only saved when it is set"""
+        if not self.antithetic:
+            return {}
+        return {"antithetic": True}
+
+    def rng_arrays(self, number_of_samples):
+        """returns a dictionary of the seed and the ids of the blocks that make up the first number_of_samples
+        the seed entropy can be larger than 64 bits so it is stored as a string"""
+        if self.seed is None:
+            return {}
+        self.block_ids = np.arange(number_of_samples // self.block_size)
+        return {"seed": str(self.seed),
+                "rng_job_key": self.rng_job_key,
+                "block_size": self.block_size,
+                "block_ids": self.block_ids,
+                }
+
+    def load_rng_arrays(self, fileObj):
+        """copies the seed and block ids from fileObj if they are present"""
+        if "seed" in fileObj.keys():
+            self.seed = int(str(fileObj["seed"]))
+            self.rng_job_key = int(fileObj["rng_job_key"])
+            self.block_size = int(fileObj["block_size"])
+            self.block_ids = np.array(fileObj["block_ids"])
+        return
+
+    def load_log_scale_arrays(self, fileObj, destination=slice(None), source=slice(None)):
+        """copies the log scaling factors from fileObj, files without them have a scaling factor of 1"""
+        for key, array in self.log_scale_arrays().items():
+            array[destination] = fileObj[key][source] if key in fileObj.keys() else 0.0
+        return
+
+    def load_derivative_arrays(self, fileObj, destination=slice(None), source=slice(None)):
+        """copies the derivatives of g from fileObj, they are NaN for files that don't have them"""
+        for key, array in self.derivative_arrays().items():
+            array[destination] = fileObj[key][source] if key in fileObj.keys() else np.nan
+        return
+
+    def load_reweight_arrays(self, fileObj, destination=slice(None), source=slice(None)):
+        """copies g at the reweighting temperatures from fileObj
+        they are NaN for files that don't have them or were reweighted to different temperatures"""
+        for key, array in self.reweight_arrays().items():
+            same_temperatures = "rw_T" in fileObj.keys() and np.array_equal(fileObj["rw_T"], self.reweight_temperatures)
+            array[destination] = fileObj[key][source] if same_temperatures else np.nan
+        return
+
+    def load_extra_rho_arrays(self, fileObj, destination=slice(None), source=slice(None)):
+        """copies the denominators of the extra sampling models from fileObj
+        they are NaN for files that don't have them or evaluated different models"""
+        for key, array in self.extra_rho_arrays().items():
+            same_models = "rho_x_ids" in fileObj.keys() and np.array_equal(fileObj["rho_x_ids"], self.extra_rho_ids)
+            array[destination] = fileObj[key][source] if same_models else np.nan
+        return
+
+    def load_control_variate_arrays(self, fileObj, destination=slice(None), source=slice(None)):
+        """copies the harmonic control variates from fileObj, they are NaN for files that don't have them"""
+        for key, array in self.control_variate_arrays().items():
+            array[destination] = fileObj[key][source] if key in fileObj.keys() else np.nan
         return
 
     def __init__(self, data=None, X=None):
@@ -782,6 +1572,16 @@ class BoxResult:
             self.samples = data.samples
             self.hash_vib = data.hash_vib
             self.hash_rho = data.hash_rho
+            self.log_scale = data.log_scale
+            self.derivatives = data.derivatives
+            self.reweight_temperatures = data.reweight_temperatures
+            self.extra_rho_ids = None if data.extra_rho_ids is None else np.array(data.extra_rho_ids)
+            self.antithetic = data.antithetic
+            self.control_variates = data.control_variates
+            self.control_means = data.harmonic_control_means() if data.control_variates else None
+            self.seed = data.seed
+            self.rng_job_key = data.rng_job_key()
+            self.block_size = data.block_size
         elif X is not None:
             self.samples = X
         else:
@@ -816,24 +1616,71 @@ class BoxResult:
         # result_view = slice(0, number_of_samples)
         return os.path.join(self.path_root, self.name)
 
-    def save_results(self, number_of_samples):
-        """x"""
+    def save_results(self, number_of_samples, writer=None):
+        """saves the first number_of_samples samples, a partially completed run is a valid (smaller) result file
+        if a ResultWriter is provided the file is written in the background, see write_result_file()"""
         path = self.compute_path_to_file()
 
         assert self.hash_vib is not None and self.hash_rho is not None, "we save hash values if they don't exist!"
         # save raw data points
-        np.savez(path,
-                 # TODO - fix the hash situation - this is hacky
-                 hash_vib=self.hash_vib,
-                 hash_rho=self.hash_rho,
-                 number_of_samples=self.samples,
-                 s_rho=self.scaled_rho,
-                 s_g=self.scaled_g,
-                 # s_g=self.scaled_g[result_view],
-                 # s_rho=self.scaled_rho[result_view],
-                 )
+        arrays = dict(
+                      # TODO - fix the hash situation - this is hacky
+                      hash_vib=self.hash_vib,
+                      hash_rho=self.hash_rho,
+                      number_of_samples=number_of_samples,
+                      **{k: v[0:number_of_samples] for k, v in self.result_arrays().items()},
+                      **self.rng_arrays(number_of_samples),
+                      **self.reweight_parameters(),
+                      **self.extra_rho_parameters(),
+                      **self.antithetic_parameters(),
+                      **self.control_variate_parameters(),
+                      )
+
+        if writer is None:
+            write_result_file(path, arrays)
+        else:
+            writer.submit(path, arrays)
         return
 
+    def resume_from_file(self, data):
+        """copies the completed blocks from this job's result file, if it was produced by the same calculation
+        the seed and job key are copied into data so the remaining blocks continue the same streams
+        returns the number of completed blocks, 0 if there is nothing to resume from"""
+        path = self.compute_path_to_file()
+        if not os.path.isfile(path):
+            return 0
+
+        with np.load(path) as fileObj:
+            if "block_ids" not in fileObj.keys() or not self.result_keys_are_present_in(fileObj.keys()):
+                return 0
+
+            same_calculation = (str(fileObj["hash_vib"]) == str(self.hash_vib)
+                                and str(fileObj["hash_rho"]) == str(self.hash_rho)
+                                and int(fileObj["block_size"]) == data.block_size
+                                and ("ls_rho" in fileObj.keys()) == self.log_scale
+                                and ("s_dg" in fileObj.keys()) == self.derivatives
+                                and np.array_equal(fileObj["rw_T"] if "rw_T" in fileObj.keys() else None,
+                                                   self.reweight_temperatures)
+                                and np.array_equal(fileObj["rho_x_ids"] if "rho_x_ids" in fileObj.keys() else None,
+                                                   self.extra_rho_ids)
+                                and ("antithetic" in fileObj.keys()) == self.antithetic
+                                and ("s_h" in fileObj.keys()) == self.control_variates)
+            if not same_calculation:
+                log.warning("The result file {:s} is from a different calculation, it will be overwritten".format(path))
+                return 0
+
+            completed_blocks = min(len(fileObj["block_ids"]), data.blocks)
+            end = completed_blocks * data.block_size
+            for k, v in self.result_arrays().items():
+                v[0:end] = fileObj[k][0:end]
+
+            self.load_rng_arrays(fileObj)
+            data.seed = self.seed
+            data.id_job = self.rng_job_key
+
+        log.info("Resuming from block {:d} of {:s}".format(completed_blocks, path))
+        return completed_blocks
+
     def load_results(self, path):
         """ load results from one file"""
         with np.load(path, mmap_mode="r") as data:
@@ -845,9 +1692,22 @@ class BoxResult:
             elif data["number_of_samples"] is not self.samples:
                 raise AssertionError("BoxResult has a different number of samples that the input file - this should not happen")
 
+            self.log_scale = "ls_rho" in data.keys()
+            self.derivatives = "s_dg" in data.keys()
+            self.reweight_temperatures = np.array(data["rw_T"]) if "rw_T" in data.keys() else None
+            self.extra_rho_ids = np.array(data["rho_x_ids"]) if "rho_x_ids" in data.keys() else None
+            self.antithetic = "antithetic" in data.keys()
+            self.control_variates = "s_h" in data.keys()
+            self.control_means = np.array(data["h_mean"]) if self.control_variates else None
             self.initialize_arrays()
             self.scaled_g = data["s_g"]
             self.scaled_rho = data["s_rho"]
+            self.load_log_scale_arrays(data)
+            self.load_derivative_arrays(data)
+            self.load_reweight_arrays(data)
+            self.load_extra_rho_arrays(data)
+            self.load_control_variate_arrays(data)
+            self.load_rng_arrays(data)
         return
 
     def load_multiple_results(self, list_of_paths, desired_number_of_samples=None):
@@ -858,6 +1718,8 @@ class BoxResult:
         assert not len(list_of_paths) == 0, "list_of_paths cannot be empty"
 
         list_of_bad_paths = []
+        # each file holds whole blocks so the pairs stay aligned, but only if every file has them
+        every_file_antithetic = True
 
         for path in list_of_paths:
             # should verify path is correct?
@@ -874,6 +1736,16 @@ class BoxResult:
                 # should verify file is not empty?
                 if self.__class__.result_keys_are_present_in(data.keys()):
                     number_of_samples += data["number_of_samples"]
+                    self.log_scale = self.log_scale or ("ls_rho" in data.keys())
+                    self.derivatives = self.derivatives or ("s_dg" in data.keys())
+                    if self.reweight_temperatures is None and "rw_T" in data.keys():
+                        self.reweight_temperatures = np.array(data["rw_T"])
+                    if self.extra_rho_ids is None and "rho_x_ids" in data.keys():
+                        self.extra_rho_ids = np.array(data["rho_x_ids"])
+                    every_file_antithetic = every_file_antithetic and ("antithetic" in data.keys())
+                    if self.control_means is None and "h_mean" in data.keys():
+                        self.control_variates = True
+                        self.control_means = np.array(data["h_mean"])
                 else:
                     list_of_bad_paths.append(path)
 
@@ -897,6 +1769,7 @@ class BoxResult:
                 # TODO - choose what the correct procedure in this case is, for now we shall not raise an error
 
         self.samples = number_of_samples
+        self.antithetic = every_file_antithetic
         self.initialize_arrays()
 
         start = 0
@@ -908,6 +1781,11 @@ class BoxResult:
                 assert not np.any(data["s_rho"][0:length] == 0.0), "Zeros in the denominator"
                 self.scaled_g[start:start+length] = data["s_g"][0:length]
                 self.scaled_rho[start:start+length] = data["s_rho"][0:length]
+                self.load_log_scale_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_derivative_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_reweight_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_extra_rho_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_control_variate_arrays(data, slice(start, start+length), slice(0, length))
                 start += length
         return
 
@@ -917,6 +1795,12 @@ class BoxResultPM(BoxResult):
 
     key_list = ["s_gP", "s_gM"] + BoxResult.key_list
 
+    log_scale_gofr_plus = None
+    log_scale_gofr_minus = None
+
+    scaled_h_plus = None
+    scaled_h_minus = None
+
     @classmethod
     def verify_result_keys_are_present(cls, path, fileObj):
         """ x """
@@ -934,34 +1818,46 @@ class BoxResultPM(BoxResult):
                 return False
         return True and super().result_keys_are_present_in(iterable)
 
-    def initialize_arrays(self):
-        super().initialize_arrays()
-        self.scaled_gofr_plus = np.full(self.samples, np.nan, dtype=F64)
-        self.scaled_gofr_minus = np.full(self.samples, np.nan, dtype=F64)
+    def initialize_arrays(self, shared=False):
+        super().initialize_arrays(shared)
+        allocate = allocate_shared_array if shared else allocate_array
+        self.scaled_gofr_plus = allocate(self.samples)
+        self.scaled_gofr_minus = allocate(self.samples)
+        if self.log_scale:
+            self.log_scale_gofr_plus = allocate(self.samples)
+            self.log_scale_gofr_minus = allocate(self.samples)
+        if self.control_variates:
+            self.scaled_h_plus = allocate(self.samples)
+            self.scaled_h_minus = allocate(self.samples)
         return
 
+    def log_scale_arrays(self):
+        """returns a dictionary of the log scaling factors to be saved alongside the results"""
+        dictionary = super().log_scale_arrays()
+        if self.log_scale:
+            dictionary["ls_gP"] = self.log_scale_gofr_plus
+            dictionary["ls_gM"] = self.log_scale_gofr_minus
+        return dictionary
+
+    def control_variate_arrays(self):
+        """returns a dictionary of the harmonic control variates at tau, tau+ and tau- to be saved alongside the results"""
+        dictionary = super().control_variate_arrays()
+        if self.control_variates:
+            dictionary["s_hP"] = self.scaled_h_plus
+            dictionary["s_hM"] = self.scaled_h_minus
+        return dictionary
+
     def __init__(self, data=None, X=None):
         """x"""
         super().__init__(data, X)
         return
 
-    def save_results(self, number_of_samples):
-        """x"""
-        path = self.compute_path_to_file()
-
-        assert self.hash_vib is not None and self.hash_rho is not None, "we save hash values if they don't exist!"
-        # save raw data points
-        np.savez(path,
-                 # TODO - fix the hash situation - this is hacky
-                 hash_vib=self.hash_vib,
-                 hash_rho=self.hash_rho,
-                 number_of_samples=self.samples,
-                 s_rho=self.scaled_rho,
-                 s_g=self.scaled_g,
-                 s_gP=self.scaled_gofr_plus,
-                 s_gM=self.scaled_gofr_minus,
-                 )
-        return
+    def result_arrays(self):
+        """returns a dictionary of every per sample array, keyed by the name it is saved under"""
+        dictionary = super().result_arrays()
+        dictionary["s_gP"] = self.scaled_gofr_plus
+        dictionary["s_gM"] = self.scaled_gofr_minus
+        return dictionary
 
     def load_results(self, path):
         """x"""
@@ -980,6 +1876,8 @@ class BoxResultPM(BoxResult):
         assert not len(list_of_paths) == 0, "list_of_paths cannot be empty"
 
         list_of_bad_paths = []
+        # each file holds whole blocks so the pairs stay aligned, but only if every file has them
+        every_file_antithetic = True
 
         try:
             for path in list_of_paths:
@@ -997,6 +1895,16 @@ class BoxResultPM(BoxResult):
                     # should verify file is not empty?
                     if self.__class__.result_keys_are_present_in(data.keys()):
                         number_of_samples += data["number_of_samples"]
+                        self.log_scale = self.log_scale or ("ls_rho" in data.keys())
+                        self.derivatives = self.derivatives or ("s_dg" in data.keys())
+                        if self.reweight_temperatures is None and "rw_T" in data.keys():
+                            self.reweight_temperatures = np.array(data["rw_T"])
+                        if self.extra_rho_ids is None and "rho_x_ids" in data.keys():
+                            self.extra_rho_ids = np.array(data["rho_x_ids"])
+                        every_file_antithetic = every_file_antithetic and ("antithetic" in data.keys())
+                        if self.control_means is None and "h_mean" in data.keys():
+                            self.control_variates = True
+                            self.control_means = np.array(data["h_mean"])
                     else:
                         list_of_bad_paths.append(path)
         except Exception as err:
@@ -1023,6 +1931,7 @@ class BoxResultPM(BoxResult):
                 # TODO - choose what the correct procedure in this case is, for now we shall not raise an error
 
         self.samples = number_of_samples
+        self.antithetic = every_file_antithetic
         self.initialize_arrays()
 
         start = 0
@@ -1036,10 +1945,117 @@ class BoxResultPM(BoxResult):
                 self.scaled_rho[start:start+length] = data["s_rho"][0:length]
                 self.scaled_gofr_plus[start:start+length] = data["s_gP"][0:length]
                 self.scaled_gofr_minus[start:start+length] = data["s_gM"][0:length]
+                self.load_log_scale_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_derivative_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_reweight_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_extra_rho_arrays(data, slice(start, start+length), slice(0, length))
+                self.load_control_variate_arrays(data, slice(start, start+length), slice(0, length))
                 start += length
         return
 
 
+class Checkpoint:
+    """Decides when a driver saves the blocks it has completed (see BoxData.checkpoint_blocks)
+    use it as a context manager around the block loop, which should iterate over self.blocks()
+    the parallel driver instead calls block_completed() from its parent process every poll_seconds
+    while it is active SIGUSR1 requests a checkpoint and SIGTERM requests a checkpoint followed by an exit"""
+
+    signals = (signal.SIGTERM, signal.SIGUSR1)
+
+    # how often the parent process of block_compute_pm_parallel() checks the workers' progress
+    poll_seconds = 0.5
+
+    def __init__(self, data, result):
+        self.data = data
+        self.result = result
+        self.received = None
+        self.previous_handlers = {}
+        self.writer = None
+        return
+
+    def __enter__(self):
+        self.last_block = -1
+        self.last_time = time.monotonic()
+        # the checkpoints are written in the background while the next blocks are computed
+        self.writer = ResultWriter()
+        # handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            for signum in self.signals:
+                self.previous_handlers[signum] = signal.signal(signum, self.handler)
+        return self
+
+    def __exit__(self, *args):
+        for signum, previous in self.previous_handlers.items():
+            signal.signal(signum, previous)
+        self.previous_handlers = {}
+        # make sure every checkpoint is on disk, even if we are exiting because of SIGTERM
+        self.writer.close()
+        return False
+
+    def handler(self, signum, frame):
+        """remember the signal, the checkpoint is written once the current block is completed"""
+        self.received = signum
+        return
+
+    def is_due(self, block_index):
+        """returns True if any of the triggers have fired since the last checkpoint"""
+        if self.received is not None:
+            return True
+        if self.data.checkpoint_blocks is not None:
+            if block_index - self.last_block >= self.data.checkpoint_blocks:
+                return True
+        if self.data.checkpoint_seconds is not None:
+            if time.monotonic() - self.last_time >= self.data.checkpoint_seconds:
+                return True
+        return False
+
+    def block_completed(self, block_index):
+        """saves blocks 0 through block_index if a checkpoint is due"""
+        if not self.is_due(block_index):
+            return
+
+        self.result.save_results((block_index + 1) * self.data.block_size, self.writer)
+        self.last_block = block_index
+        self.last_time = time.monotonic()
+        log.info("Checkpoint queued after block {:d}".format(block_index))
+
+        received, self.received = self.received, None
+        if received == signal.SIGTERM:
+            raise SystemExit(128 + signal.SIGTERM)
+        return
+
+    def blocks(self, block_indices):
+        """yields each block index, checking for a checkpoint after the caller finishes each block"""
+        for block_index in block_indices:
+            yield block_index
+            self.block_completed(block_index)
+
+
+class CompletedBlocks:
+    """Records which blocks the workers of block_compute_pm_parallel() have completed
+    the flags are backed by shared memory so the parent process sees them as soon as a worker sets them,
+    it has the same blocks() interface as Checkpoint so it can be passed to compute_blocks_pm()"""
+
+    def __init__(self, number_of_blocks, first_block=0):
+        buffer = mp.RawArray(ctypes.c_bool, number_of_blocks)
+        self.flags = np.frombuffer(buffer, dtype=np.bool_)
+        # the blocks before first_block were copied from a previous result file
+        self.flags[0:first_block] = True
+        return
+
+    def blocks(self, block_indices):
+        """yields each block index, marking it as completed once the caller has finished it"""
+        for block_index in block_indices:
+            yield block_index
+            self.flags[block_index] = True
+
+    def prefix(self):
+        """returns the number of blocks completed without a gap from the first block
+        these are the blocks that can be saved, the result files only store the first number_of_samples samples"""
+        incomplete = np.flatnonzero(~self.flags)
+        return len(self.flags) if len(incomplete) == 0 else int(incomplete[0])
+
+
 def pos_sym_assert(tensor):
     """raises error if provided tensor is not positive semi-definite"""
 
@@ -1061,158 +2077,970 @@ def pos_sym_assert(tensor):
 
 def scale_o_matrices(scalingFactor, model_one, model_two):
     """divides the O matrices of the models by the scalingFactor"""
-    model_one.omatrix /= scalingFactor[..., NEW, NEW]
-    model_two.omatrix /= scalingFactor[..., NEW, NEW]
+    model_one.omatrix /= scalingFactor[..., NEW]
+    model_two.omatrix /= scalingFactor[..., NEW]
     return
 
 
 def un_scale_o_matrices(scalingFactor, model_one, model_two):
     """multiples the O matrices of the models by the scalingFactor"""
-    model_one.omatrix *= scalingFactor[..., NEW, NEW]
-    model_two.omatrix *= scalingFactor[..., NEW, NEW]
+    model_one.omatrix *= scalingFactor[..., NEW]
+    model_two.omatrix *= scalingFactor[..., NEW]
     return
 
 
 def build_scaling_factors(S12, model_one, model_two):
     """Calculates the individual and combined scaling factors for both provided models"""
     # compute the individual scaling factors
-    model_one.omatrix_scaling[:] = np.amax(model_one.omatrix, axis=(2, 3))
-    model_two.omatrix_scaling[:] = np.amax(model_two.omatrix, axis=(2, 3))
+    np.amax(model_one.omatrix, axis=2, out=model_one.omatrix_scaling)
+    np.amax(model_two.omatrix, axis=2, out=model_two.omatrix_scaling)
 
     # compute the combined scaling factor
-    S12[:] = np.maximum(model_one.omatrix_scaling, model_two.omatrix_scaling)
+    np.maximum(model_one.omatrix_scaling, model_two.omatrix_scaling, out=S12)
     return
 
 
-def build_o_matrix(data, model, state_shift):
-    """Calculates the O matrix of a model, storing the result inside the model object"""
+def scale_log_o_matrices(logScalingFactor, *models):
+    """exponentiates the O matrices of the models, built with build_o_matrix(log=True), divided by the scaling factor
+    whose natural logarithm is logScalingFactor (see build_log_scaling_factors())
+    the O matrices are only formed after they are scaled, exp(log O - log S) can't overflow even when O itself
+    leaves the range of the dtype, which happens at large tau, for np.float32 when the exponents are beyond about +/- 88"""
+    for model in models:
+        model.omatrix -= logScalingFactor[..., NEW]
+        np.exp(model.omatrix, out=model.omatrix)
+    return
+
+
+def build_log_scaling_factors(logS12, model_one, model_two):
+    """Calculates the natural logarithms of the individual and combined scaling factors for both provided models
+    whose O matrices were built with build_o_matrix(log=True), the logarithm keeps the order of the O matrices
+    so these are the scaling factors of build_scaling_factors() applied to the logarithms"""
+    build_scaling_factors(logS12, model_one, model_two)
+    return
 
-    # add surface dependent normal mode displacement (from model)
-    if state_shift.shape[0] == data.qTensor.shape[1]:
-        data.qTensor -= state_shift[NEW, :, :, NEW]
-        q1 = data.qTensor.view()
-    else:
-        data.qTempTensor -= state_shift[NEW, :, :, NEW]
-        q1 = data.qTempTensor.view()
+
+def build_features(data):
+    """Stores the (BP, 3N) features R1^2 + R2^2, (R1 - R2)^2 and R1 + R2 of the sampled co-ordinates in the workspace
+    where R1 is the co-ordinate of each bead and R2 is the co-ordinate of the next bead"""
+    ws = data.workspace
+    N = data.modes
 
     # name and select the views
-    # q1 = data.qTensor.view()
-    q2 = np.roll(q1.view(), shift=-1, axis=3)
+    R1 = data.qTensor.view()
+    R2 = ws.rolled.view()
+    R2[..., :-1] = R1[..., 1:]
+    R2[..., -1] = R1[..., 0]
+
+    # they are written through (BNP) views so R doesn't need to be transposed
+    features = ws.features.view()
+    difference = features[..., N:2*N].swapaxes(1, 2)
+    np.subtract(R1, R2, out=difference)
+    np.square(difference, out=difference)
+    np.add(R1, R2, out=features[..., 2*N:].swapaxes(1, 2))
+    np.square(R2, out=R2)
+    np.square(R1, out=features[..., :N].swapaxes(1, 2))
+    features[..., :N] += R2.swapaxes(1, 2)
+    return
 
-    coth = model.cothBANP.view()
-    csch = model.cschBANP.view()
 
-    # compute the omatrix
-    o_matrix = -0.5 * np.sum(coth * (q1**2. + q2**2.) - 2.*csch*q1*q2, axis=2).swapaxes(1, 2)
+def contract_features(data, coth, csch, state_shift, out):
+    """Stores -0.5 * sum over modes of coth*(q1^2 + q2^2) - 2*csch*q1*q2 in out (BPA), where q = R - d
+    the surface dependent co-ordinates q are never stored,
+    instead the quadratic form is written as (coth - csch)*(q1^2 + q2^2) + csch*(q1 - q2)^2 and expanded in powers
+    of the displacement d, which is a single (BP, 3N) x (3N, A) product of the features (see build_features())
+    plus a constant, coth and csch are nearly equal for small tau so this avoids cancelling them
+    stacked coth and csch (K leading axis) give K products that share the same features"""
+    N = data.modes
+    features = data.workspace.features
+    coefficients = np.concatenate((-0.5 * (coth - csch), -0.5 * csch, (coth - csch) * state_shift), axis=-1).swapaxes(-1, -2)
+    coefficients = coefficients.astype(out.dtype, copy=False)
+    constant = -np.sum((coth - csch) * state_shift**2., axis=-1)
+
+    K, A = out.shape[:-3], out.shape[-1]
+    np.matmul(features.reshape(-1, 3*N), coefficients, out=out.reshape(*K, -1, A))
+    out += constant[..., NEW, NEW, :]
+    return
 
-    np.exp(o_matrix, out=o_matrix)
 
-    for a in range(data.states):
-        model.omatrix[:, :, a, a] = o_matrix[:, :, a]
+def build_o_matrix(data, model, state_shift, log=False):
+    """Calculates the O matrix of a model, storing the result inside the model object
+    the O matrices are diagonal in the surfaces so only the diagonal (BPA) is stored
+    if log is True the natural logarithm of the O matrices is stored instead
 
-    temp_states = model.omatrix.shape[2]
-    # asserts that the tensor is diagonal along axis (2,3)
-    for a, b in it.product(range(temp_states), range(temp_states)):
-        if a == b:
-            continue
-        assert(np.all(model.omatrix[:, :, a, b] == 0.0))
+    only the (BNP) co-ordinates R held in data.qTensor are needed, see contract_features()"""
+    build_features(data)
 
-    # this only works because omatrix is filled with zeros already
-    model.omatrix *= model.omatrix_prefactor[..., NEW]
+    # the exponent is -0.5 * sum over modes of coth*(q1^2 + q2^2) - 2*csch*q1*q2
+    o_matrix = model.omatrix.view()
+    contract_features(data, model.cothAN, model.cschAN, state_shift, o_matrix)
 
-    # remove surface dependent normal mode displacement (from model)
-    if state_shift.shape[0] == data.qTensor.shape[1]:
-        data.qTensor += state_shift[NEW, :, :, NEW]
+    if log:
+        o_matrix += model.log_omatrix_prefactor
     else:
-        data.qTempTensor += state_shift[NEW, :, :, NEW]
+        np.exp(o_matrix, out=o_matrix)
+        o_matrix *= model.omatrix_prefactor
 
     return
 
 
-def build_denominator(rho_model, outputArray, idx):
-    """Calculates the state trace over the bead product of the o matrices of the rho model"""
-    # outputArray[idx] = rho_model.omatrix.prod(axis=1).sum(axis=1)
-    outputArray[idx] = rho_model.omatrix.prod(axis=1).trace(axis1=1, axis2=2)
+def build_o_matrix_derivatives(data, model, state_shift):
+    """Calculates the first and second derivatives of the O matrices with respect to tau
+    relative to the O matrices themselves, O'/O and O''/O, storing them inside the model object
+    the O matrix is exp(L) so O'/O = L' and O''/O = L'' + L'^2, where the derivatives of the exponent L
+    are the same quadratic forms as L with the derivatives of coth and csch (see contract_features())
+    they don't depend on the scaling of the O matrices so they can be used after scale_log_o_matrices()"""
+    build_features(data)
+
+    d1 = model.omatrix_d1.view()
+    contract_features(data, model.dcothAN, model.dcschAN, state_shift, d1)
+    d1 += model.dlog_prefactor[..., NEW, NEW, :]
+
+    d2 = model.omatrix_d2.view()
+    contract_features(data, model.d2cothAN, model.d2cschAN, state_shift, d2)
+    d2 += model.d2log_prefactor[..., NEW, NEW, :]
+    d2 += d1**2.
     return
 
 
-def diagonalize_coupling_matrix(data):
+def pairwise_bead_product(tensor, multiply=np.matmul, buffers=None):
+    """Returns the ordered product of the tensor along the bead axis (axis 1)
+    Adjacent pairs of beads are multiplied together in a single batched call, which halves the number of beads.
+    This is repeated until one bead is left, so only log2(P) dependent passes are needed instead of P-1.
+    Use multiply=np.multiply for diagonal matrices. The input tensor is not modified.
+    Each pass writes into the other of the two buffers, which must hold at least ceil(P/2) beads,
+    if they are not provided they are allocated. The returned array is a view into one of the buffers.
+    The products are computed in the precision of the buffers, by default at least double precision."""
+    P = tensor.shape[1]
+    if buffers is None:
+        shape = (tensor.shape[0], P - P // 2, *tensor.shape[2:])
+        dtype = np.promote_types(tensor.dtype, F64)
+        buffers = (np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype))
+
+    source = tensor
+    step = 0
+    while P > 1:
+        half = P // 2
+        target = buffers[step % 2]
+        multiply(source[:, 0:2*half:2, ...], source[:, 1:2*half:2, ...], out=target[:, 0:half, ...], dtype=target.dtype)
+        if P % 2 == 1:
+            target[:, half, ...] = source[:, P-1, ...]
+        P -= half
+        source = target
+        step += 1
+
+    return source[:, 0, ...]
+
+
+def build_denominator(rho_model, outputArray, idx, tree=False, buffers=None):
+    """Calculates the state trace over the bead product of the o matrices of the rho model
+    given the vib model's O matrices it is the harmonic control variate h instead (see BoxData.control_variates)"""
+    # the trace of a product of diagonal matrices is the sum of the products of their diagonals
+    if tree:
+        outputArray[idx] = pairwise_bead_product(rho_model.omatrix, multiply=np.multiply, buffers=buffers).sum(axis=1)
+    else:
+        outputArray[idx] = rho_model.omatrix.prod(axis=1, dtype=F64).sum(axis=1)
+    return
+
+
+def build_extra_denominators(data, logScalingFactor, outputArray, idx):
+    """Calculates the denominators of the extra sampling models (see BoxData.extra_rho_ids) for the current block
+    saving the j-th model's denominator to outputArray[idx, j]
+    their O matrices are divided by the same scaling factor as rho's (its logarithm is logScalingFactor)
+    so the ratios rho_j / rho and g / rho_j are unchanged"""
+    for j, model in enumerate(data.extra_rhos):
+        build_o_matrix(data, model.const, model.state_shift, log=True)
+        scale_log_o_matrices(logScalingFactor, model.const)
+        build_denominator(model.const, outputArray[:, j], idx, data.use_tree_product())
+    return
+
 
-    # ------------------------------------------------------------------------
-    # shift to surface independent co-ordinates
-    # data.qTensor += data.vib.state_shift[NEW, :, :, NEW]
+def _eigh_2x2_components(a, b, c):
+    """closed form eigendecomposition of the symmetric 2x2 matrices [[a, b], [b, c]] given as arrays
+    returns the ascending eigenvalues and the cosine and sine of the rotation that diagonalizes them"""
+    mean = 0.5 * (a + c)
+    half_difference = 0.5 * (a - c)
+    radius = np.hypot(half_difference, b)
+    theta = 0.5 * np.arctan2(b, half_difference)
+    return mean - radius, mean + radius, np.cos(theta), np.sin(theta)
+
+
+def _eigh_output(matrices, out):
+    """returns out, the pair of arrays the eigenvalues (...A) and eigenvectors (...AA) are written to
+    or a new pair if out is None"""
+    if out is not None:
+        return out
+    return np.empty(matrices.shape[:-1], dtype=matrices.dtype), np.empty(matrices.shape, dtype=matrices.dtype)
+
+
+def symmetric_eigh_2x2(matrices, out=None):
+    """closed form equivalent of np.linalg.eigh(matrices, UPLO='L') for a stack of symmetric 2x2 matrices
+    the results are written to out (a pair of arrays) if it is provided"""
+    low, high, cos, sin = _eigh_2x2_components(matrices[..., 0, 0], matrices[..., 1, 0], matrices[..., 1, 1])
+    eigvals, eigvects = _eigh_output(matrices, out)
+    eigvals[..., 0] = low
+    eigvals[..., 1] = high
+    eigvects[..., 0, 0] = -sin
+    eigvects[..., 1, 0] = cos
+    eigvects[..., 0, 1] = cos
+    eigvects[..., 1, 1] = sin
+    return eigvals, eigvects
+
+
+def symmetric_eigh_3x3(matrices, out=None):
+    """closed form equivalent of np.linalg.eigh(matrices, UPLO='L') for a stack of symmetric 3x3 matrices
+    the results are written to out (a pair of C contiguous arrays) if it is provided
+
+    the eigenvalues come from the trigonometric solution of the characteristic cubic,
+    only the eigenvector of the most isolated eigenvalue is taken from a cross product (of two rows of A - lambda I)
+    and the remaining 2x2 block in its orthogonal complement is solved with _eigh_2x2_components()
+    so (near) degenerate pairs of eigenvalues still give orthonormal eigenvectors
+    every matrix element is a contiguous array over the stack, numpy is very slow at tiny trailing axes
+    """
+    stack = matrices.reshape(-1, 3, 3)
+    a, b, c = stack[:, 0, 0], stack[:, 1, 1], stack[:, 2, 2]
+    d, e, f = stack[:, 1, 0], stack[:, 2, 0], stack[:, 2, 1]
+
+    def cross(u, v):
+        return (u[1]*v[2] - u[2]*v[1], u[2]*v[0] - u[0]*v[2], u[0]*v[1] - u[1]*v[0])
+
+    def dot(u, v):
+        return u[0]*v[0] + u[1]*v[1] + u[2]*v[2]
+
+    def apply(u):
+        return (a*u[0] + d*u[1] + e*u[2], d*u[0] + b*u[1] + f*u[2], e*u[0] + f*u[1] + c*u[2])
+
+    # eigenvalues of the traceless matrix B = A - qI are 2p cos(phi + 2 pi k / 3)
+    q = (a + b + c) / 3.
+    a_q, b_q, c_q = a - q, b - q, c - q
+    p = np.sqrt((a_q**2 + b_q**2 + c_q**2 + 2. * (d**2 + e**2 + f**2)) / 6.)
+    det = a_q*(b_q*c_q - f**2) - d*(d*c_q - f*e) + e*(d*f - b_q*e)
+    safe_p = np.where(p > 0., p, 1.)
+    phi = np.arccos(np.clip(det / (2. * safe_p**3), -1., 1.)) / 3.
+    largest = q + 2. * p * np.cos(phi)
+    smallest = q + 2. * p * np.cos(phi + 2. * np.pi / 3.)
+    middle = 3. * q - largest - smallest
+    lowest_isolated = (middle - smallest) > (largest - middle)
+    isolated = np.where(lowest_isolated, smallest, largest)
+
+    # the longest cross product of two rows of A - lambda I is the best conditioned eigenvector
+    rows = ((a - isolated, d, e), (d, b - isolated, f), (e, f, c - isolated))
+    v = cross(rows[0], rows[1])
+    v_norm = dot(v, v)
+    for candidate in (cross(rows[0], rows[2]), cross(rows[1], rows[2])):
+        norm = dot(candidate, candidate)
+        longer = norm > v_norm
+        v = tuple(np.where(longer, new, old) for new, old in zip(candidate, v))
+        v_norm = np.where(longer, norm, v_norm)
+
+    # a multiple of the identity has no preferred direction, any unit vector will do
+    degenerate = v_norm == 0.
+    v_norm = np.sqrt(np.where(degenerate, 1., v_norm))
+    v = (np.where(degenerate, 1., v[0] / v_norm), v[1] / v_norm, v[2] / v_norm)
+
+    # orthonormal basis (u1, u2) of the complement, u1 = v x e_k with e_k the axis v is least aligned with
+    x, y, z = np.abs(v[0]), np.abs(v[1]), np.abs(v[2])
+    use_x = (x <= y) & (x <= z)
+    use_y = ~use_x & (y <= z)
+    u1 = (np.where(use_x, 0., np.where(use_y, -v[2], v[1])),
+          np.where(use_x, v[2], np.where(use_y, 0., -v[0])),
+          np.where(use_x, -v[1], np.where(use_y, v[0], 0.)))
+    u1_norm = np.sqrt(dot(u1, u1))
+    u1 = tuple(component / u1_norm for component in u1)
+    u2 = cross(v, u1)
+
+    # diagonalize the projection of A onto the complement
+    Au1 = apply(u1)
+    mu_low, mu_high, cos, sin = _eigh_2x2_components(dot(u1, Au1), dot(u2, Au1), dot(u2, apply(u2)))
+    w_low = tuple(-sin*i + cos*j for i, j in zip(u1, u2))
+    w_high = tuple(cos*i + sin*j for i, j in zip(u1, u2))
+    # the Rayleigh quotient is more accurate than the trigonometric eigenvalue
+    isolated = dot(v, apply(v))
+
+    # sort into ascending order, the results are written directly to the (flattened) output arrays
+    eigvals, eigvects = _eigh_output(matrices, out)
+    flat_eigvals, flat_eigvects = eigvals.reshape(-1, 3), eigvects.reshape(-1, 3, 3)
+    assert np.shares_memory(flat_eigvects, eigvects), "the output arrays must be C contiguous"
+    ordered = ((isolated, mu_low), (mu_low, mu_high), (mu_high, isolated))
+    columns = ((v, w_low), (w_low, w_high), (w_high, v))
+    for j, ((value_low, value_high), (if_low, if_high)) in enumerate(zip(ordered, columns)):
+        np.copyto(flat_eigvals[:, j], np.where(lowest_isolated, value_low, value_high))
+        for i in range(3):
+            np.copyto(flat_eigvects[:, i, j], if_high[i])
+            np.copyto(flat_eigvects[:, i, j], if_low[i], where=lowest_isolated)
+    return eigvals, eigvects
+
+
+def batched_jacobi_eigh(matrices, tolerance=1e-14, max_sweeps=30):
+    """cyclic Jacobi equivalent of np.linalg.eigh(matrices) for a stack of small symmetric matrices
+
+    every matrix in the stack is rotated by the same sequence of (p, q) plane rotations
+    until the off diagonal elements are below tolerance times the norm of each matrix
+    the stack is moved to the last axis so each rotation acts on contiguous arrays
+    """
+    shape = matrices.shape
+    n = shape[-1]
+    A = np.ascontiguousarray(np.moveaxis(matrices.reshape(-1, n, n), 0, -1), dtype=F64)
+    V = np.zeros_like(A)
+    for i in range(n):
+        V[i, i] = 1.
+
+    pairs = [(p, q) for p in range(n - 1) for q in range(p + 1, n)]
+    threshold = tolerance**2 * np.sum(A**2, axis=(0, 1))
+    for sweep in range(max_sweeps):
+        # summing the off diagonal elements directly avoids the cancellation in |A|^2 - sum(diagonal^2)
+        if np.all(2. * sum(A[p, q]**2 for p, q in pairs) <= threshold):
+            break
+        for p, q in pairs:
+            # tan(2 theta) = 2 a_pq / (a_qq - a_pp), taking the smaller angle |theta| <= pi/4 so the sweeps converge
+            difference = A[q, q] - A[p, p]
+            sign = np.where(difference < 0., -1., 1.)
+            theta = 0.5 * np.arctan2(2. * sign * A[p, q], np.abs(difference))
+            cos, sin = np.cos(theta), np.sin(theta)
+            for T in (A, V):
+                column_p, column_q = T[:, p].copy(), T[:, q].copy()
+                T[:, p] = cos*column_p - sin*column_q
+                T[:, q] = sin*column_p + cos*column_q
+            row_p, row_q = A[p].copy(), A[q].copy()
+            A[p] = cos*row_p - sin*row_q
+            A[q] = sin*row_p + cos*row_q
+
+    eigvals = np.stack([A[i, i] for i in range(n)], axis=-1)
+    eigvects = np.moveaxis(V, -1, 0)
+    order = np.argsort(eigvals, axis=-1)
+    eigvals = np.take_along_axis(eigvals, order, axis=-1)
+    eigvects = np.take_along_axis(eigvects, order[:, NEW, :], axis=-1)
+    return eigvals.reshape(shape[:-1]), eigvects.reshape(shape)
+
+
+def symmetric_eigh(matrices, method="auto", out=None):
+    """eigendecomposition of a stack of symmetric matrices (...AA), reading only their lower triangles
+    method is one of "lapack", "closed_form", "jacobi" or "auto"
+    "auto" uses the closed form kernels for 3 or fewer surfaces and np.linalg.eigh otherwise
+    the results are written to out (a pair of C contiguous arrays) if it is provided,
+    the closed form kernels write to it directly, the other methods' results are copied into it"""
+    A = matrices.shape[-1]
+    if method == "auto":
+        method = "closed_form" if A <= 3 else "lapack"
+
+    if method in ["lapack", "jacobi"]:
+        results = np.linalg.eigh(matrices, UPLO='L') if method == "lapack" else batched_jacobi_eigh(matrices)
+        if out is None:
+            return results
+        for destination, source in zip(out, results):
+            np.copyto(destination, source)
+        return out
+
+    assert method == "closed_form", f"invalid eigen solver {method}"
+    assert A <= 3, f"there are no closed form kernels for {A} surfaces"
+    if A == 1:
+        eigvals, eigvects = _eigh_output(matrices, out)
+        np.copyto(eigvals, matrices[..., 0])
+        eigvects.fill(1.)
+        return eigvals, eigvects
+    elif A == 2:
+        return symmetric_eigh_2x2(matrices, out)
+    return symmetric_eigh_3x3(matrices, out)
+
+
+# coefficients b_k of the [m/m] Pade approximants to exp(x) and the largest norms theta_m
+# for which they are accurate to double precision, from Higham, SIAM J. Matrix Anal. Appl. 26, 1179 (2005)
+pade_coefficients = {
+    3: (120., 60., 12., 1.),
+    5: (30240., 15120., 3360., 420., 30., 1.),
+    7: (17297280., 8648640., 1995840., 277200., 25200., 1512., 56., 1.),
+    9: (17643225600., 8821612800., 2075673600., 302702400., 30270240., 2162160., 110880., 3960., 90., 1.),
+    13: (64764752532480000., 32382376266240000., 7771770303897600., 1187353796428800., 129060195264000.,
+         10559470521600., 670442572800., 33522128640., 1323241920., 40840800., 960960., 16380., 182., 1.),
+}
+pade_theta = {3: 1.495585217958292e-2,
+              5: 2.539398330063230e-1,
+              7: 9.504178996162932e-1,
+              9: 2.097847961257068e0,
+              13: 5.371920351148152e0, }
+
+
+def gershgorin_bounds(matrices, out=None, scratch=None):
+    """returns the lower and upper bounds (...) on the eigenvalues of each symmetric matrix (...AA)
+    given by the Gershgorin circle theorem, no eigenvalue lies outside [a_ii - r_i, a_ii + r_i] for every row i
+    the bounds are stored in out (a pair of arrays) and the absolute values in scratch (...AA) if they are provided"""
+    lower, upper = (None, None) if out is None else out
+    diagonal = np.diagonal(matrices, axis1=-2, axis2=-1)
+    radius = np.abs(matrices, out=scratch).sum(axis=-1)
+    radius -= np.abs(diagonal)
+    return np.amin(diagonal - radius, axis=-1, out=lower), np.amax(diagonal + radius, axis=-1, out=upper)
+
+
+# expm_pade() solves for the approximant with gauss_jordan_solve() up to this many surfaces and np.linalg.solve() above
+# see tests/speed_tests/matrix_exponential_backend.py
+gauss_jordan_limit = 5
+
+
+class PadeWorkspace:
+    """Preallocated storage for the temporaries of expm_pade() for a stack of matrices of the given shape (...AA)"""
+
+    def __init__(self, shape, dtype):
+        # X and its even powers, the odd (U) and even (V) parts of the approximant and two scratch matrices
+        self.X, self.X2, self.X4, self.X6, self.U, self.V, self.S, self.T = np.empty((8, *shape), dtype=dtype)
+        # the Gershgorin bounds and the column and reciprocal pivot of gauss_jordan_solve()
+        self.lower, self.upper, self.pivot = np.empty((3, *shape[:-2]), dtype=dtype)
+        self.column = np.empty(shape[:-1], dtype=dtype)
+
+
+def diagonal_view(matrices):
+    """returns a writeable view of the diagonals (...A) of a C contiguous stack of matrices (...AA)"""
+    A = matrices.shape[-1]
+    return matrices.reshape(*matrices.shape[:-2], A*A)[..., ::A+1]
+
+
+def gauss_jordan_solve(Q, R, scratch, column, pivot):
+    """Solves Q X = R for a stack of matrices (...AA) in place, R is replaced by X and Q is overwritten
+    there is no pivoting so Q has to be positive definite, as the denominators of the Pade approximants are
+    scratch (...AA), column (...A) and pivot (...) are overwritten"""
+    A = Q.shape[-1]
+    for k in range(A):
+        column[:] = Q[..., :, k]
+        np.reciprocal(column[..., k], out=pivot)
+        Q[..., k, k+1:] *= pivot[..., NEW]
+        R[..., k, :] *= pivot[..., NEW]
+        # eliminate the k-th column from every other row, only the columns of Q after k are still needed
+        column[..., k] = 0.
+        np.multiply(column[..., :, NEW], Q[..., NEW, k, k+1:], out=scratch[..., k+1:])
+        Q[..., k+1:] -= scratch[..., k+1:]
+        np.multiply(column[..., :, NEW], R[..., NEW, k, :], out=scratch)
+        R -= scratch
+    return
+
+
+def expm_pade(matrices, tau, lowest=None, out=None, workspace=None):
+    """Returns exp(-tau V) for a stack of symmetric matrices V (...AA) without diagonalizing them
+    if lowest (...) is provided the exponent is taken relative to it, giving exp(-tau (V - lowest))
+    the temporaries are stored in workspace (a PadeWorkspace) if one is provided
+
+    each V is first shifted by the centre c of its Gershgorin bounds, exp(-tau V) = exp(-tau c) exp(-tau (V - c))
+    which makes the norm of the exponent as small as those bounds allow
+    then the scaling and squaring method is applied to the whole block at once:
+    the degree of the Pade approximant and the number of squarings are chosen from the largest norm in the block"""
+    ws = PadeWorkspace(matrices.shape, matrices.dtype) if workspace is None else workspace
+    X, X2, X4, X6, U, V, S, T = ws.X, ws.X2, ws.X4, ws.X6, ws.U, ws.V, ws.S, ws.T
+
+    gershgorin_bounds(matrices, out=(ws.lower, ws.upper), scratch=S)
+    centre = np.add(ws.lower, ws.upper, out=ws.upper)
+    centre *= 0.5
+    X[:] = matrices
+    diagonal_view(X)[:] -= centre[..., NEW]
+    X *= -tau
+
+    # the 1-norm bounds the spectral radius
+    norm = np.amax(np.abs(X, out=S).sum(axis=-2), initial=0.)
+    squarings = 0
+    for m in (3, 5, 7, 9, 13):
+        if norm <= pade_theta[m]:
+            break
+    else:
+        squarings = int(np.ceil(np.log2(norm / pade_theta[13])))
+        X /= 2.**squarings
+
+    def accumulate(target, coefficients, powers):
+        """target += sum of coefficient * power, using T as scratch"""
+        for coefficient, power in zip(coefficients, powers):
+            np.multiply(power, coefficient, out=T)
+            target += T
+
+    # r_m(X) = (V - U)^-1 (V + U) where U holds the odd and V the even powers of X
+    b = pade_coefficients[m]
+    np.matmul(X, X, out=X2)
+    if m == 13:
+        np.matmul(X2, X2, out=X4)
+        np.matmul(X4, X2, out=X6)
+        np.multiply(X6, b[13], out=U)
+        accumulate(U, (b[11], b[9]), (X4, X2))
+        np.matmul(X6, U, out=S)
+        accumulate(S, (b[7], b[5], b[3]), (X6, X4, X2))
+        diagonal_view(S)[:] += b[1]
+        np.matmul(X, S, out=U)
+        np.multiply(X6, b[12], out=S)
+        accumulate(S, (b[10], b[8]), (X4, X2))
+        np.matmul(X6, S, out=V)
+        accumulate(V, (b[6], b[4], b[2]), (X6, X4, X2))
+        diagonal_view(V)[:] += b[0]
+    else:
+        np.multiply(X2, b[3], out=S)
+        diagonal_view(S)[:] += b[1]
+        np.multiply(X2, b[2], out=V)
+        diagonal_view(V)[:] += b[0]
+        # the even powers alternate between X4 and X6
+        power, following = X2, X4
+        for k in range(2, (m + 1) // 2):
+            np.matmul(power, X2, out=following)
+            power, following = following, (X6 if following is X4 else X4)
+            accumulate(S, (b[2*k+1], ), (power, ))
+            accumulate(V, (b[2*k], ), (power, ))
+        np.matmul(X, S, out=U)
+
+    # the solution replaces V + U in S
+    np.subtract(V, U, out=T)
+    np.add(V, U, out=S)
+    if matrices.shape[-1] <= gauss_jordan_limit:
+        gauss_jordan_solve(T, S, X2, ws.column, ws.pivot)
+    else:
+        # LAPACK is faster for larger matrices, its solution is the only temporary
+        S[:] = np.linalg.solve(T, S)
+
+    R, spare = S, T
+    for _ in range(squarings):
+        np.matmul(R, R, out=spare)
+        R, spare = spare, R
+
+    # undo the shift
+    shift = centre if lowest is None else np.subtract(centre, lowest, out=centre)
+    shift *= -tau
+    np.exp(shift, out=shift)
+    return np.multiply(R, shift[..., NEW, NEW], out=out)
+
+
+def collect_monomials(tensor):
+    """Returns the monomials (a tuple of n arrays of M mode indices, in ascending order) of an order n coupling tensor
+    (N...NAA) and their terms (M, A*A), each element of the tensor is the coefficient of the product of its modes'
+    co-ordinates as written in the .op files (see model_op.extract_cubic_couplings()), so C3 at [j, j, j] is C3 q_j^3
+    and the terms of every ordering of a monomial's modes are summed
+    only the nonzero elements of the tensor are kept, so contracting the monomials costs M A^2 rather than N^n A^2"""
+    A = tensor.shape[-1]
+    indices = np.nonzero(np.any(tensor != 0., axis=(-2, -1)))
+    terms = tensor[indices].reshape(-1, A*A)
+
+    # every permutation of the same modes is the same monomial
+    monomials, inverse = np.unique(np.sort(np.stack(indices, axis=1), axis=1), axis=0, return_inverse=True)
+    summed = np.zeros((len(monomials), A*A), dtype=F64)
+    np.add.at(summed, inverse.ravel(), terms)
+
+    nonzero = np.any(summed != 0., axis=1)
+    return tuple(monomials[nonzero].T), summed[nonzero]
+
+
+def build_coupling_matrix(data):
+    """Builds the coupling matrix V (BPAA) from the surface independent co-ordinates R
+    the quadratic terms are contracted by the kernel ModelVibronic.analyse_coupling_structure() picked
+    and the cubic and quartic terms (if the model has any) as lists of monomials, see collect_monomials()"""
+    vib, ws = data.vib, data.workspace
+    B, P, A = data.block_size, data.beads, data.states
+
+    # each kernel is a single (BP, terms) x (terms, AA) matrix product
+    # the co-ordinates are copied once into a contiguous (N, BP) matrix so the modes can be gathered as rows
+    q = ws.coupling_coordinates
+    q.reshape(-1, B, P)[:] = data.qTensor.transpose(1, 0, 2)
+    V = data.coupling_matrix.reshape(B*P, A*A)
+    products = ws.coupling_products
 
-    # build the coupling matrix
     # quadratic terms
-    data.coupling_matrix[:] = np.einsum('acef, debc, abdf->afbc',
-                                        data.qTensor,
-                                        0.5*data.vib.quadratic,
-                                        data.qTensor,
-                                        # optimize='optimal',  # not clear if this is faster
-                                        )
+    if vib.quadratic_kernel == "dense":
+        np.einsum('aef, debc, adf->afbc',
+                  data.qTensor,
+                  vib.quadratic_terms,
+                  data.qTensor,
+                  out=data.coupling_matrix,
+                  # optimize='optimal',  # not clear if this is faster
+                  )
+    elif vib.quadratic_kernel == "diagonal":
+        np.square(q, out=products)
+        np.matmul(products.T, vib.quadratic_terms, out=V)
+    elif vib.quadratic_kernel == "sparse":
+        j1, j2 = vib.quadratic_pairs
+        np.take(q, j1, axis=0, out=products[0])
+        np.take(q, j2, axis=0, out=products[1])
+        products[0] *= products[1]
+        np.matmul(products[0].T, vib.quadratic_terms, out=V)
+    elif vib.quadratic_kernel == "low_rank":
+        projections, weights = vib.quadratic_terms
+        np.matmul(q.T, projections, out=products)
+        np.square(products, out=products)
+        products *= weights
+        np.sum(products.reshape(B*P, -1, A*A), axis=1, out=V)
+
+    # cubic and quartic terms, the product of each monomial's co-ordinates contracted with its terms
+    linear = ws.coupling_linear.reshape(B*P, A*A)
+    for (modes, terms), products in zip(vib.anharmonic_terms, ws.anharmonic_products):
+        np.take(q, modes[0], axis=0, out=products)
+        for index in modes[1:]:
+            products *= q[index]
+        np.matmul(products.T, terms, out=linear)
+        V += linear
+
     # linear terms
-    data.coupling_matrix += np.einsum('dbc, abdf->afbc',
-                                      data.vib.linear,
-                                      data.qTensor,
-                                      # optimize='optimal',  # not clear if this is faster
-                                      )
+    if ws.linear_coordinates is not None:
+        q = np.take(q, vib.linear_modes, axis=0, out=ws.linear_coordinates)
+    np.matmul(q.T, vib.linear_terms, out=linear)
+    V += linear
     # reference Hamiltonian (energy shifts)
-    data.coupling_matrix += data.vib.energy[NEW, NEW, :, :]
+    data.coupling_matrix += vib.energy[NEW, NEW, :, :]
+    return
 
+
+def diagonalize_coupling_matrix(data):
+
+    build_coupling_matrix(data)
     # print("V\n", data.coupling_matrix[0, 0, :, :])
+    # the coupling matrix is symmetric in surfaces because its terms are, see ModelVibronic.analyse_coupling_structure()
+
+    # build_M_matrix() exponentiates the coupling matrix directly so it doesn't need to be diagonalized
+    if data.use_pade_exponential():
+        return
+
+    symmetric_eigh(data.coupling_matrix, data.eigen_solver, out=(data.coupling_eigvals, data.coupling_eigvects))
+    return
+
+
+def assert_exponents_in_range(exponents, dtype):
+    """checks that the M matrices exp(exponents) (BPA) can be represented in the given dtype
+    each bead's largest exponent must neither overflow nor leave the whole matrix to underflow to zero
+    at large tau this fails first in float32 (beyond about +/-88), the log_scale option avoids it
+    by building the M matrices relative to their lowest eigenvalue (see build_log_numerator())"""
+    largest = np.amax(exponents, axis=-1)
+    limits = float(np.log(np.finfo(dtype).tiny)), float(np.log(np.finfo(dtype).max))
+    assert np.all((limits[0] < largest) & (largest < limits[1])), (
+        f"the exponents of the M matrices (largest {np.amax(largest):.1f}) "
+        f"exceed the range of {np.dtype(dtype).name} ({limits[0]:.1f}, {limits[1]:.1f}), enable log_scale"
+        )
+    return
+
+
+def build_M_matrix(data, tau, lowest=None):
+    """Calculates the M matrices exp(-tau V) from the eigendecomposition of the coupling matrix
+    or with expm_pade() if the data object uses the Pade approximant (see BoxData.matrix_exponential)
+    if lowest (BP) is provided the eigenvalues are taken relative to it, giving exp(-tau (V - lowest))"""
+    ws = data.workspace
+
+    if data.use_pade_exponential():
+        expm_pade(data.coupling_matrix, tau, lowest, out=data.M_matrix, workspace=ws.pade)
+        if lowest is None:
+            # the Gershgorin lower bound gives the largest exponent that exp(-tau V) could have
+            assert_exponents_in_range(-tau * ws.pade.lower[..., NEW], data.dtype)
+        return
 
-    # shift back to surface dependent co-ordinates
-    # data.qTensor -= data.vib.state_shift[NEW, :, :, NEW]
-    # ------------------------------------------------------------------------
+    # exp(-tau * eigenvalues)
+    if lowest is None:
+        np.multiply(data.coupling_eigvals, -tau, out=ws.diagonal)
+        assert_exponents_in_range(ws.diagonal, data.dtype)
+    else:
+        np.subtract(data.coupling_eigvals, lowest[..., NEW], out=ws.diagonal)
+        ws.diagonal *= -tau
+    np.exp(ws.diagonal, out=ws.diagonal)  # replace this part to salis
+
+    # U exp(-tau D) U^T
+    np.multiply(data.coupling_eigvects, ws.diagonal[:, :, NEW, :], out=ws.scaled_eigvects)
+    np.matmul(ws.scaled_eigvects, data.coupling_eigvects.swapaxes(2, 3), out=data.M_matrix)
+    return
 
-    # check that the coupling matrix is symmetric in surfaces
-    assert(np.allclose(data.coupling_matrix.transpose(0, 1, 3, 2), data.coupling_matrix))
 
-    (data.coupling_eigvals,
-     data.coupling_eigvects
-     ) = np.linalg.eigh(data.coupling_matrix, UPLO='L')
+def build_M_matrices(eigvals, eigvects, taus, out=None):
+    """Returns the M matrices exp(-tau V) (K, B, P, A, A) for each of the K taus
+    built from the eigendecomposition of the coupling matrix, eigvals (BPr) and eigvects (BPAr)
+    the eigendecomposition only depends on the co-ordinates so any number of taus can be built without diagonalizing again
+    it can be truncated to the lowest r eigenpairs, see save_coupling_eigendecomposition()"""
+    diagonal = -np.multiply.outer(np.asarray(taus, dtype=F64), eigvals)
+    assert_exponents_in_range(diagonal, eigvals.dtype)
+    np.exp(diagonal, out=diagonal)
+    scaled_eigvects = eigvects[NEW, ...] * diagonal[..., NEW, :]
+    return np.matmul(scaled_eigvects, eigvects.swapaxes(-1, -2), out=out)
+
+
+def save_coupling_eigendecomposition(data, path, block_index, rank=None):
+    """Saves the eigendecomposition of the coupling matrix of the current block (see diagonalize_coupling_matrix())
+    to path (a compressed .npz file) along with what is needed to regenerate the block's co-ordinates
+    the eigenvalues are in ascending order, if rank is given only the lowest rank eigenpairs are kept
+    the others contribute exp(-tau (lambda - lambda_lowest)) relative to the lowest one to M
+    so they can be dropped when they are far enough above it for every tau of interest
+    when M is built with expm_pade() the coupling matrix isn't diagonalized by the block loop, so it is diagonalized here"""
+    if data.use_pade_exponential():
+        eigvals, eigvects = symmetric_eigh(data.coupling_matrix, data.eigen_solver)
+    else:
+        eigvals, eigvects = data.coupling_eigvals, data.coupling_eigvects
+
+    rank = data.states if rank is None else rank
+    arrays = {"block_index": block_index,
+              "seed": str(data.seed),
+              "rng_job_key": data.rng_job_key(),
+              "block_size": data.block_size,
+              "eigvals": eigvals[..., :rank],
+              "eigvects": eigvects[..., :rank],
+              }
+    write_result_file(path, arrays, compressed=True)
     return
 
 
+def load_coupling_eigendecomposition(data, path):
+    """Loads an eigendecomposition saved by save_coupling_eigendecomposition(), returning the eigvals and eigvects
+    the block's co-ordinates are regenerated in data.qTensor so its O matrices can be built for any tau
+    data needs the same seed, id_job and block_size as the run that saved it"""
+    with np.load(path) as fileObj:
+        same_samples = (int(str(fileObj["seed"])) == data.seed
+                        and int(fileObj["rng_job_key"]) == data.rng_job_key()
+                        and int(fileObj["block_size"]) == data.block_size)
+        assert same_samples, f"the eigendecomposition in {path:} was computed from different samples"
+
+        data.regenerate_block(int(fileObj["block_index"]))
+        return np.array(fileObj["eigvals"]), np.array(fileObj["eigvects"])
+
+
 def build_numerator(data, vib, outputArray, idx):
     """Calculates the numerator and saves it to the outputArray"""
 
     # build the M matrix
-    np.einsum('abcd, abd, abed->abce',
-              data.coupling_eigvects,
-              np.exp(-data.tau*data.coupling_eigvals),  # replace this part to salis
-              data.coupling_eigvects,
-              out=data.M_matrix,
-              optimize='optimal'
-              )
-
-    # data.numerator = np.broadcast_to(   np.identity(data.states),
-    #                                     data.size['BAA']
-    #                                     )
-
-    # reset numerator 'storage' to be identity(in the AA dimension)
-    data.numerator = np.empty(data.size['BAA'], dtype=F64)
-    for b in range(data.block_size):
-        data.numerator[b, :, :] = np.identity(data.states)
-
-    for b in range(data.block_size):
-        for p in range(data.beads):
-            # this is correct
-            # data.numerator[b, ...].dot(np.diagflat(vib.omatrix[b, p, :]))
-            # this is twice as fast
-            # data.numerator[b, ...].dot(np.diag(vib.omatrix[b, p, :]))
-            # this is even faster
-            data.numerator[b, ...].dot(data.M_matrix[b, p, ...], out=data.numerator[b, :, :])
-            data.numerator[b, ...].dot(vib.omatrix[b, p, :, :], out=data.numerator[b, :, :])
+    build_M_matrix(data, data.tau)
 
-    # trace over the surfaces
-    outputArray[idx] = np.trace(data.numerator, axis1=1, axis2=2)
+    # the O matrices are diagonal so M O is just M with its columns scaled
+    # we fold them into M so each bead only contributes one matrix to the product
+    data.M_matrix *= vib.omatrix[:, :, NEW, :]
+
+    ws = data.workspace
+    outputArray[idx] = trace_of_bead_product(data.M_matrix, data.use_tree_product(),
+                                             ws.bead_pairs, (data.numerator, ws.numerator))
     # if np.any(outputArray[idx] < 0.):
     #     log.warning("g(R) had negative values!!!")
     # assert np.all(outputArray[idx] >= 0.), "g(R) must always be positive"
     return
 
 
+def build_stacked_numerator(data, vib_stack, outputArrays, idx):
+    """Same as build_numerator() for each tau of the stacked vib constants (see TemperatureDependentClass)
+    the K numerators share one M matrix (built with data.tau) and their bead products are computed together
+    the numerator of the k-th tau is saved to outputArrays[k]"""
+
+    # build the M matrix
+    build_M_matrix(data, data.tau)
+
+    # fold each tau's O matrices into its own copy of M, (K, B, P, A, A)
+    folded = data.workspace.folded_stack
+    np.multiply(data.M_matrix[NEW, ...], vib_stack.omatrix[..., NEW, :], out=folded)
+
+    # the K blocks are multiplied as one block of K*B samples
+    ws = data.workspace
+    K, B = folded.shape[:2]
+    traces = trace_of_bead_product(folded.reshape(K*B, *folded.shape[2:]), data.use_tree_product(),
+                                   ws.stack_bead_pairs, ws.stack_numerators).reshape(K, B)
+    for k, outputArray in enumerate(outputArrays):
+        outputArray[idx] = traces[k]
+    return
+
+
+def build_reweighted_numerator(data, vib, logScalingFactor, outputArray, idx):
+    """Calculates the numerator at each of the reweighting taus (see BoxData.reweight_temperatures)
+    for the samples drawn at data.tau, saving the numerators at the k-th temperature's beta, beta+ and beta-
+    to outputArray[idx, k, 0:3]
+    the O matrices are divided by the same scaling factor as the denominator (its logarithm is logScalingFactor)
+    so g_k / rho is unchanged
+    each tau has its own M matrix but they are all built from the same eigendecomposition of the coupling matrix"""
+    ws = data.workspace
+    reweight = vib.const_reweight
+
+    # the O matrices for every tau in one pass
+    build_o_matrix(data, reweight, vib.state_shift, log=True)
+    scale_log_o_matrices(logScalingFactor, reweight)
+
+    # fold each tau's O matrices into its own M matrices, (K, B, P, A, A)
+    folded = ws.reweight_stack
+    for k, tau in enumerate(data.reweight_taus):
+        build_M_matrix(data, tau)
+        np.multiply(data.M_matrix, reweight.omatrix[k][:, :, NEW, :], out=folded[k])
+
+    # the K blocks are multiplied as one block of K*B samples
+    K, B = folded.shape[:2]
+    traces = trace_of_bead_product(folded.reshape(K*B, *folded.shape[2:]), data.use_tree_product(),
+                                   ws.reweight_bead_pairs, ws.reweight_numerators).reshape(K, B)
+    outputArray[idx] = traces.T.reshape(B, -1, 3)
+    return
+
+
+def build_derivative_numerator(data, vib, outputArrays, idx):
+    """Calculates the numerator g and its first and second derivatives with respect to beta
+    saving them to the three outputArrays, the O matrices and build_o_matrix_derivatives() must already be built
+
+    each bead contributes A = M O, A' = M' O + M O' and A'' = M'' O + 2 M' O' + M O''
+    the product of the beads is computed on the (A, A', A''/2) triples,
+    where (X0, X1, X2)(Y0, Y1, Y2) = (X0 Y0, X0 Y1 + X1 Y0, X0 Y2 + X1 Y1 + X2 Y0) applies the product rule
+    so the traces of the product are g, g' and g''/2 with respect to tau, and d/d beta = (1/P) d/d tau"""
+    ws = data.workspace
+    U, eigvals = data.coupling_eigvects, data.coupling_eigvals
+
+    # build the M matrix, this leaves exp(-tau * eigenvalues) in ws.diagonal
+    build_M_matrix(data, data.tau)
+    M = data.M_matrix
+    dM1, dM2 = ws.derivative_M
+
+    if data.use_pade_exponential():
+        # V commutes with M = exp(-tau V) so M' = -V M and M'' = V^2 M
+        np.matmul(data.coupling_matrix, M, out=dM1)
+        dM1 *= -1.
+        np.matmul(data.coupling_matrix, dM1, out=dM2)
+        dM2 *= -1.
+    else:
+        # M' = U (-D exp(-tau D)) U^T and M'' = U (D^2 exp(-tau D)) U^T
+        for dM in ws.derivative_M:
+            ws.diagonal *= -eigvals
+            np.multiply(U, ws.diagonal[:, :, NEW, :], out=ws.scaled_eigvects)
+            np.matmul(ws.scaled_eigvects, U.swapaxes(2, 3), out=dM)
+
+    # the O matrices are diagonal so they scale the columns
+    O = vib.omatrix[:, :, NEW, :]
+    dO1 = vib.omatrix_d1[:, :, NEW, :]
+    dO2 = vib.omatrix_d2[:, :, NEW, :]
+    A0, A1, A2 = ws.derivative_chain
+
+    # A''/2 = 0.5 (M'' + 2 M' O'/O + M O''/O) O
+    np.multiply(dM1, dO1, out=A1)
+    np.multiply(M, dO2, out=A2)
+    A2 += dM2
+    A2 += A1
+    A2 += A1
+    A2 *= O
+    A2 *= 0.5
+    # A' = (M' + M O'/O) O
+    np.multiply(M, dO1, out=A1)
+    A1 += dM1
+    A1 *= O
+    # A = M O
+    np.multiply(M, O, out=A0)
+
+    # the serial chain alternates between the two triples so matmul never writes over its input
+    product, spare = ws.derivative_numerators
+    temporary = ws.numerator
+    for n, A in zip(product, ws.derivative_chain):
+        np.copyto(n, A[:, 0, ...])
+
+    for p in range(1, data.beads):
+        n0, n1, n2 = product
+        s0, s1, s2 = spare
+        np.matmul(n0, A0[:, p, ...], out=s0)
+        np.matmul(n0, A1[:, p, ...], out=s1)
+        s1 += np.matmul(n1, A0[:, p, ...], out=temporary)
+        np.matmul(n0, A2[:, p, ...], out=s2)
+        s2 += np.matmul(n1, A1[:, p, ...], out=temporary)
+        s2 += np.matmul(n2, A0[:, p, ...], out=temporary)
+        product, spare = spare, product
+
+    g, dg, d2g = outputArrays
+    traces = np.trace(product, axis1=2, axis2=3)
+    g[idx] = traces[0]
+    dg[idx] = traces[1] / data.beads
+    d2g[idx] = 2. * traces[2] / data.beads**2.
+    return
+
+
+def trace_of_bead_product(tensor, tree, pair_buffers, numerators):
+    """Returns the trace over the surfaces of the ordered product along the bead axis of tensor (XPAA)
+    if tree is True the product is computed with pairwise_bead_product() using the pair_buffers
+    otherwise it is a serial chain that alternates between the two (XAA) numerators
+    so matmul never writes over its input"""
+
+    # multiply the beads together, every sample in the block at once
+    if tree:
+        product = pairwise_bead_product(tensor, buffers=pair_buffers)
+        return np.trace(product, axis1=1, axis2=2)
+
+    product, spare = numerators
+    np.copyto(product, tensor[:, 0, ...])
+    for p in range(1, tensor.shape[1] - 1):
+        np.matmul(product, tensor[:, p, ...], out=spare)
+        product, spare = spare, product
+
+    # trace over the surfaces, we only need the diagonal of the last product
+    return np.einsum('acd, adc->a', product, tensor[:, -1, ...])
+
+
+def log_scaled_bead_product(tensor, tree=False, pair_buffers=None, numerators=None):
+    """Returns the ordered product of the matrices along the bead axis (axis 1) as a mantissa and
+    the natural logarithm of its scaling factor, product = mantissa * exp(log_scale)
+    After every multiplication each sample's matrix is divided by its largest element
+    so the running product can't leave the range of a float
+    Like trace_of_bead_product() the tree reduces into the pair_buffers and the serial chain alternates between
+    the two (XAA) numerators, they are allocated if not provided. The beads of tensor are rescaled in place
+    and the returned mantissa is a view into one of the buffers."""
+
+    def rescale(matrices, log_scale):
+        # the largest magnitude without building the (..AA) array of absolute values
+        scale = np.amax(matrices, axis=(-2, -1))
+        np.maximum(scale, -np.amin(matrices, axis=(-2, -1)), out=scale)
+        matrices /= scale[..., NEW, NEW]
+        log_scale += np.log(scale).reshape(scale.shape[0], -1).sum(axis=1, dtype=F64)
+        return
+
+    X, P = tensor.shape[0:2]
+    log_scale = np.zeros(X, dtype=F64)
+    rescale(tensor, log_scale)
+
+    if tree:
+        if pair_buffers is None:
+            shape = (X, P - P // 2, *tensor.shape[2:])
+            pair_buffers = (np.empty(shape, dtype=F64), np.empty(shape, dtype=F64))
+
+        # the same passes as pairwise_bead_product(), rescaling the beads left after each one
+        source = tensor
+        step = 0
+        while P > 1:
+            half = P // 2
+            target = pair_buffers[step % 2]
+            np.matmul(source[:, 0:2*half:2, ...], source[:, 1:2*half:2, ...], out=target[:, 0:half, ...],
+                      dtype=target.dtype)
+            if P % 2 == 1:
+                target[:, half, ...] = source[:, P-1, ...]
+            P -= half
+            rescale(target[:, 0:P, ...], log_scale)
+            source = target
+            step += 1
+        return source[:, 0, ...], log_scale
+
+    if numerators is None:
+        numerators = tuple(np.empty((X, *tensor.shape[2:]), dtype=F64) for _ in range(2))
+
+    mantissa, spare = numerators
+    np.copyto(mantissa, tensor[:, 0, ...])
+    for p in range(1, P):
+        np.matmul(mantissa, tensor[:, p, ...], out=spare)
+        mantissa, spare = spare, mantissa
+        rescale(mantissa[:, NEW, ...], log_scale)
+    return mantissa, log_scale
+
+
+def build_log_denominator(rho_model, outputArray, outputScale, idx):
+    """Same as build_denominator() but the O matrices of the rho model hold their natural logarithm
+    the mantissa is stored in outputArray and the logarithm of the scaling factor in outputScale"""
+    # the log of the bead product of each diagonal element
+    log_product = rho_model.omatrix.sum(axis=1, dtype=F64)
+    outputScale[idx] = np.amax(log_product, axis=1)
+    outputArray[idx] = np.exp(log_product - outputScale[idx, NEW]).sum(axis=1)
+    return
+
+
+def build_log_numerator(data, vib, outputArray, outputScale, idx):
+    """Same as build_numerator() but the O matrices of the vib model hold their natural logarithm
+    the mantissa is stored in outputArray and the logarithm of the scaling factor in outputScale"""
+
+    # build the M matrix relative to its largest eigenvalue exp(-tau * lowest)
+    # without the eigenvalues the Gershgorin lower bound keeps the eigenvalues of M at or below 1
+    if data.use_pade_exponential():
+        lowest, _ = gershgorin_bounds(data.coupling_matrix)
+    else:
+        lowest = np.amin(data.coupling_eigvals, axis=2)
+    build_M_matrix(data, data.tau, lowest)
+    log_scale = -data.tau * lowest.sum(axis=1, dtype=F64)
+
+    # fold in the O matrices relative to their largest element
+    ws = data.workspace
+    largest = np.amax(vib.omatrix, axis=2)
+    np.subtract(vib.omatrix, largest[..., NEW], out=ws.diagonal)
+    np.exp(ws.diagonal, out=ws.diagonal)
+    data.M_matrix *= ws.diagonal[:, :, NEW, :]
+    log_scale += largest.sum(axis=1, dtype=F64)
+
+    # the beads of M are rescaled in place
+    mantissa, chain_scale = log_scaled_bead_product(data.M_matrix, data.use_tree_product(),
+                                                    ws.bead_pairs, (data.numerator, ws.numerator))
+
+    # trace over the surfaces
+    outputArray[idx] = np.trace(mantissa, axis1=1, axis2=2)
+    outputScale[idx] = log_scale + chain_scale
+    return
+
+
 def block_compute_gR(data, result):
     """ Compute and save only g(R) for building data_set to train ML algorithm
      for block_size # of sampled points in each loop"""
@@ -1223,18 +3051,14 @@ def block_compute_gR(data, result):
     # store results here (these results are not! scaled)
     g = result.scaled_g.view()  # should think about renaming scaled_g?
 
-    for block_index in range(0, data.blocks):
+    for block_index in data.sampled_blocks(range(0, data.blocks)):
 
         # indices
         start = block_index * data.block_size
         end = (block_index + 1) * data.block_size
         sample_view = slice(start, end)
 
-        # generate sample points in collective co-ordinates
-        data.draw_sample(sample_view)
-
-        # process the sampled points
-        data.transform_sampled_coordinates(sample_view)
+        # the sampled points were drawn and transformed by data.sampled_blocks()
 
         # build O matrices for system distribution
         build_o_matrix(data, vib.const, vib.state_shift)
@@ -1247,26 +3071,26 @@ def block_compute_gR(data, result):
     return
 
 
-def save_gR_with_samples(data, result, input_R_values):
+def save_gR_with_samples(data, result, input_R_values, writer=None):
     """ temporary function to save g(R) results with R values
     don't want to pollute BoxResult with extra functions that might not be necessary in the future
-    so this will go here for now"""
+    so this will go here for now
+    if a ResultWriter is provided the files are written in the background"""
+    save = write_result_file if writer is None else writer.submit
 
     result.partial_name = partial(file_name.training_data_g_output().format, P=data.beads, T=data.temperature)
     path = result.compute_path_to_file()
 
-    np.savez(path,
-             number_of_samples=result.samples,
-             g=result.scaled_g,
-             )
+    save(path, dict(number_of_samples=result.samples,
+                    g=result.scaled_g,
+                    ))
 
     result.partial_name = partial(file_name.training_data_input().format, P=data.beads, T=data.temperature)
     path = result.compute_path_to_file()
 
-    np.savez(path,
-             number_of_samples=result.samples,
-             input_R_values=input_R_values,
-             )
+    save(path, dict(number_of_samples=result.samples,
+                    input_R_values=input_R_values,
+                    ))
     return
 
 
@@ -1290,13 +3114,12 @@ def block_compute_rhoR_from_input_samples(data, result, input_R_values):
         sample_view = slice(start, end)
 
         # we copy in the data values that we read in from load_R_samples
-        data.qTensor[:] = input_R_view[sample_view, NEW, ...]
-        # we transform the dimensionless co-ordinates to surface dependent co-ordinates q = R - d
-        data.qTensor -= data.vib.state_shift[NEW, :, :, NEW]
+        # the surface dependent co-ordinates q = R - d are formed inside build_o_matrix()
+        data.qTensor[:] = input_R_view[sample_view, ...]
 
         # build O matrices for system distribution
         build_o_matrix(data, rho.const, rho.state_shift)
-        build_denominator(rho.const, rho_of_R, sample_view)
+        build_denominator(rho.const, rho_of_R, sample_view, data.use_tree_product(), data.workspace.diagonal_pairs)
 
     # return and let the caller of the function save the results appropriately
     return
@@ -1324,7 +3147,7 @@ def block_compute_gR_from_raw_samples(data, result):
 
         # generate sample points in surface dependent co-ordinates q = R - d
         # but which were not sampled from
-        data.generate_random_R_values(result, input_view, sample_view)
+        data.generate_random_R_values(result, input_view, sample_view, block_index)
 
         # build O matrices for system distribution
         build_o_matrix(data, vib.const, vib.state_shift)
@@ -1344,6 +3167,19 @@ def block_compute(data, result):
     # block_index_list = [1e1, 1e2, 1e3, 1e4]
     # log.info("Block index list: " + str(block_index_list))
 
+    first_block = result.resume_from_file(data) if data.resume else 0
+
+    with Checkpoint(data, result) as checkpoint:
+        compute_blocks(data, result, range(first_block, data.blocks), checkpoint)
+
+    result.save_results(data.blocks * data.block_size)
+    return
+
+
+def compute_blocks(data, result, block_indices, checkpoint=None):
+    """Compute g and rho for each block in block_indices, storing them in the result arrays
+    the blocks are sampled by data.sampled_blocks(), checkpoint (see Checkpoint) is told when each block is done"""
+
     # labels for clarity
     rho = data.rho
     vib = data.vib
@@ -1351,49 +3187,68 @@ def block_compute(data, result):
     # store results here
     y_rho = result.scaled_rho.view()
     y_g = result.scaled_g.view()
+    if data.derivatives:
+        y_dg = result.scaled_dg.view()
+        y_d2g = result.scaled_d2g.view()
 
-    # store the combined scaling factor in here
-    S12 = np.zeros(data.size['BP'])
+    # store the logarithm of the combined scaling factor in here
+    S12 = np.zeros(data.size['BP'], dtype=data.dtype)
 
-    for block_index in range(0, data.blocks):
+    blocks = data.sampled_blocks(block_indices)
+    if checkpoint is not None:
+        blocks = checkpoint.blocks(blocks)
+
+    for block_index in blocks:
         # indices
         start = block_index * data.block_size
         end = (block_index + 1) * data.block_size
         sample_view = slice(start, end)
 
-        # generate sample points in collective co-ordinates
-        data.draw_sample(sample_view)
+        # the sampled points were drawn and transformed by data.sampled_blocks()
 
-        # process the sampled points
-        data.transform_sampled_coordinates(sample_view)
+        if data.log_scale:
+            # every sample keeps its own scaling factors so we don't need S12
+            build_o_matrix(data, rho.const, rho.state_shift, log=True)
+            build_o_matrix(data, vib.const, vib.state_shift, log=True)
+            build_log_denominator(rho.const, y_rho, result.log_scale_rho, sample_view)
+            diagonalize_coupling_matrix(data)
+            build_log_numerator(data, vib.const, y_g, result.log_scale_g, sample_view)
+            continue
 
-        # build O matrices for sampling distribution
-        build_o_matrix(data, rho.const, rho.state_shift)
-        # build O matrices for system distribution
-        build_o_matrix(data, vib.const, vib.state_shift)
+        # build the logarithms of the O matrices for sampling distribution
+        build_o_matrix(data, rho.const, rho.state_shift, log=True)
+        # build the logarithms of the O matrices for system distribution
+        build_o_matrix(data, vib.const, vib.state_shift, log=True)
 
-        # compute parts with normal scaling factor
-        build_scaling_factors(S12, rho.const, vib.const)
-        scale_o_matrices(S12, rho.const, vib.const)
+        # compute parts with normal scaling factor, the O matrices are only exponentiated once they are scaled
+        build_log_scaling_factors(S12, rho.const, vib.const)
+        scale_log_o_matrices(S12, rho.const, vib.const)
 
-        build_denominator(rho.const, y_rho, sample_view)
+        build_denominator(rho.const, y_rho, sample_view, data.use_tree_product(), data.workspace.diagonal_pairs)
+        if data.extra_rho_ids is not None:
+            build_extra_denominators(data, S12, result.scaled_rho_extra, sample_view)
+        if data.control_variates:
+            build_denominator(vib.const, result.scaled_h, sample_view, data.use_tree_product(), data.workspace.control_pairs)
         diagonalize_coupling_matrix(data)
-        build_numerator(data, vib.const, y_g, sample_view)
 
-    result.save_results(end)
-
-    return
+        if data.reweight_taus is not None:
+            build_reweighted_numerator(data, vib, S12, result.scaled_g_reweight, sample_view)
 
+        if data.derivatives:
+            # the derivatives are relative to the O matrices so they are unaffected by S12
+            build_o_matrix_derivatives(data, vib.const, vib.state_shift)
+            build_derivative_numerator(data, vib.const, (y_g, y_dg, y_d2g), sample_view)
+            continue
 
-def block_compute_pm(data, result):
+        build_numerator(data, vib.const, y_g, sample_view)
+    return
 
-    assert isinstance(data, BoxDataPM), "incorrect object type"
-    assert isinstance(result, BoxResultPM), "incorrect object type"
 
-    np.set_printoptions(suppress=False)
-    # for blockIdx, block in enumerate(range(0, block_size*blocks, block_size)):
-    # block_index_list = [1e1, 1e2, 1e3, 1e4, 2e4, 3e4, 4e4, 5e4, 6e4, 7e4, 8e4, 9e4, 1e5]
-    # log.info("Block index list: " + str(block_index_list))
+def compute_blocks_pm(data, result, block_indices, checkpoint=None):
+    """Compute g, g+, g- and rho for each block in block_indices, storing them in the result arrays
+    each block only writes to its own slice of the result arrays
+    the blocks are sampled by data.sampled_blocks(), checkpoint (see Checkpoint) is told when each block is done"""
+    assert not data.derivatives, "the derivatives of g replace g+ and g-, they are computed by block_compute()"
 
     # labels for clarity
     rho = data.rho
@@ -1406,49 +3261,60 @@ def block_compute_pm(data, result):
     y_gp = result.scaled_gofr_plus.view()
     y_gm = result.scaled_gofr_minus.view()
 
-    # store the combined scaling factor in here
-    S12 = np.zeros(data.size['BP'])
+    # store the logarithm of the combined scaling factor in here
+    S12 = np.zeros(data.size['BP'], dtype=data.dtype)
     # startTime = time.process_time()
     # log.info("Start: {:f}".format(startTime))
-    for block_index in range(0, data.blocks):
+    blocks = data.sampled_blocks(block_indices)
+    if checkpoint is not None:
+        blocks = checkpoint.blocks(blocks)
+
+    for block_index in blocks:
 
         # indices
         start = block_index * data.block_size
         end = (block_index + 1) * data.block_size
         sample_view = slice(start, end)
 
-        # generate sample points in collective co-ordinates
-        data.draw_sample(sample_view)
-
-        # process the sampled points
-        # print(data.qTensor.shape)
-        data.transform_sampled_coordinates(sample_view)
-        # print(np.allclose(data.qTensor[:,0,:,:],data.qTensor[:,1,:,:]))
+        # the sampled points were drawn and transformed by data.sampled_blocks()
         # print(data.qTensor.shape)
 
-        # build O matrices for sampling distribution
-        build_o_matrix(data, rho.const, rho.state_shift)
-        # build O matrices for system distribution
-        build_o_matrix(data, vib.const, vib.state_shift)
+        if data.log_scale:
+            # every sample keeps its own scaling factors so we don't need S12
+            build_o_matrix(data, rho.const, rho.state_shift, log=True)
+            # the system's O matrices at tau, tau+ and tau- in one pass
+            build_o_matrix(data, vib.const_stack, vib.state_shift, log=True)
+            build_log_denominator(rho.const, y_rho, result.log_scale_rho, sample_view)
+            diagonalize_coupling_matrix(data)
+            build_log_numerator(data, vib.const, y_g, result.log_scale_g, sample_view)
+            build_log_numerator(data, vib.const_plus, y_gp, result.log_scale_gofr_plus, sample_view)
+            build_log_numerator(data, vib.const_minus, y_gm, result.log_scale_gofr_minus, sample_view)
+            continue
 
-        # compute parts with normal scaling factor
-        build_scaling_factors(S12, rho.const, vib.const)
-        scale_o_matrices(S12, rho.const, vib.const)
-        build_denominator(rho.const, y_rho, sample_view)
+        # build the logarithms of the O matrices for sampling distribution
+        build_o_matrix(data, rho.const, rho.state_shift, log=True)
+        # build the logarithms of the O matrices for system distribution at tau, tau+ and tau- in one pass
+        build_o_matrix(data, vib.const_stack, vib.state_shift, log=True)
+
+        # compute parts with normal scaling factor, the O matrices are only exponentiated once they are scaled
+        build_log_scaling_factors(S12, rho.const, vib.const)
+        # Plus and Minus use the same scaling factor
+        scale_log_o_matrices(S12, rho.const, vib.const_stack)
+        build_denominator(rho.const, y_rho, sample_view, data.use_tree_product(), data.workspace.diagonal_pairs)
+        if data.extra_rho_ids is not None:
+            build_extra_denominators(data, S12, result.scaled_rho_extra, sample_view)
+        if data.control_variates:
+            controls = zip((vib.const, vib.const_plus, vib.const_minus),
+                           (result.scaled_h, result.scaled_h_plus, result.scaled_h_minus))
+            for const, y_h in controls:
+                build_denominator(const, y_h, sample_view, data.use_tree_product(), data.workspace.control_pairs)
         diagonalize_coupling_matrix(data)
-        build_numerator(data, vib.const, y_g, sample_view)
-
-        # Plus
-        build_o_matrix(data, vib.const_plus, vib.state_shift)
-        vib.const_plus.omatrix /= S12[..., NEW, NEW]
-        build_numerator(data, vib.const_plus, y_gp, sample_view)
+        build_stacked_numerator(data, vib.const_stack, (y_g, y_gp, y_gm), sample_view)
 
-        # Minus
-        build_o_matrix(data, vib.const_minus, vib.state_shift)
-        vib.const_minus.omatrix /= S12[..., NEW, NEW]
-        build_numerator(data, vib.const_minus, y_gm, sample_view)
+        if data.reweight_taus is not None:
+            build_reweighted_numerator(data, vib, S12, result.scaled_g_reweight, sample_view)
 
-        # periodically save results to file
+        # periodically save results to file (now handled by Checkpoint)
         # if (block_index + 1) in block_index_list:
         #     curTime = time.process_time()
         #     timeElapsed = curTime - startTime
@@ -1457,14 +3323,109 @@ def block_compute_pm(data, result):
         #     s = "Block index: {:d}\nNumber of samples: {:d}"
         #     log.info(s.format(block_index + 1, end))
         #     result.save_results(end)
+    return
 
-    result.save_results(end)
+
+def block_compute_pm(data, result):
+
+    assert isinstance(data, BoxDataPM), "incorrect object type"
+    assert isinstance(result, BoxResultPM), "incorrect object type"
+
+    np.set_printoptions(suppress=False)
+    # for blockIdx, block in enumerate(range(0, block_size*blocks, block_size)):
+    # block_index_list = [1e1, 1e2, 1e3, 1e4, 2e4, 3e4, 4e4, 5e4, 6e4, 7e4, 8e4, 9e4, 1e5]
+    # log.info("Block index list: " + str(block_index_list))
+
+    first_block = result.resume_from_file(data) if data.resume else 0
+
+    with Checkpoint(data, result) as checkpoint:
+        compute_blocks_pm(data, result, range(first_block, data.blocks), checkpoint)
+
+    result.save_results(data.blocks * data.block_size)
+    return
+
+
+def compute_blocks_pm_worker(data, result, block_indices, completed):
+    """the target of each worker process of block_compute_pm_parallel()
+    the parent process writes the checkpoints, so the workers exit on SIGTERM and ignore SIGUSR1
+    the workers already keep every core busy, so they do not prefetch on a helper thread"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    data.prefetch = False
+    compute_blocks_pm(data, result, block_indices, completed)
+    return
+
+
+def available_cpus():
+    """returns the number of cpus this process may run on
+    os.sched_getaffinity() is not available on every platform (macOS), there we fall back to os.cpu_count()"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def block_compute_pm_parallel(data, result, number_of_processes=None):
+    """Same as block_compute_pm() but the blocks are split over number_of_processes forked processes
+    Each block draws from its own random stream (see BoxData.block_rng()) and the workers
+    write into result arrays backed by shared memory, therefore the saved file is identical
+    to the one block_compute_pm() produces for the same data.seed
+    It resumes and checkpoints like block_compute_pm(), the parent process saves the blocks that have been
+    completed without a gap from the first block (see CompletedBlocks), so when a job is stopped
+    at most the few blocks the other workers finished ahead of the slowest one are computed again
+    Each worker should use a single BLAS thread, the job scripts set OMP_NUM_THREADS=1 (and the like)
+    before python starts, setting them afterwards has no effect"""
+
+    assert isinstance(data, BoxDataPM), "incorrect object type"
+    assert isinstance(result, BoxResultPM), "incorrect object type"
+
+    if number_of_processes is None:
+        number_of_processes = available_cpus()
+    number_of_processes = max(1, min(number_of_processes, data.blocks))
+
+    # the workers inherit these arrays when they are forked
+    result.initialize_arrays(shared=True)
+    first_block = result.resume_from_file(data) if data.resume else 0
+    completed = CompletedBlocks(data.blocks, first_block)
+
+    # each worker takes every n'th of the remaining blocks
+    context = mp.get_context("fork")
+    workers = [context.Process(target=compute_blocks_pm_worker,
+                               args=(data, result, range(first_block + i, data.blocks, number_of_processes), completed),
+                               )
+               for i in range(number_of_processes)]
+
+    # the workers are forked before Checkpoint starts its writer thread and installs its signal handlers
+    # forking a process that has other threads running can leave locks held in the child
+    try:
+        for worker in workers:
+            worker.start()
+
+        with Checkpoint(data, result) as checkpoint:
+            while any(worker.is_alive() for worker in workers):
+                mp.connection.wait([w.sentinel for w in workers], timeout=checkpoint.poll_seconds)
+                finished = completed.prefix()
+                if finished > 0 or checkpoint.received is not None:
+                    checkpoint.block_completed(finished - 1)
+
+            failed = [w.exitcode for w in workers if w.exitcode != 0]
+            if len(failed) > 0:
+                # keep whatever was completed so the job can be resumed
+                result.save_results(completed.prefix() * data.block_size, checkpoint.writer)
+                raise Exception(f"{len(failed):d} of {number_of_processes:d} worker processes failed, exit codes {failed}")
+    finally:
+        # only reached with workers still running if we are exiting early (SIGTERM or an error)
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            if worker.pid is not None:
+                worker.join()
+
+    result.save_results(data.blocks * data.block_size)
     return
 
 
 def simple_wrapper(id_data, id_rho=0):
     """Just do simple expval(Z) calculation"""
-    np.random.seed(232942)  # pick our seed
     samples = int(1e2)
     Bsize = int(1e2)
 
@@ -1485,6 +3446,7 @@ def simple_wrapper(id_data, id_rho=0):
     data.temperature = 300.0
     data.blocks = samples // Bsize
     data.block_size = Bsize
+    data.seed = 232942  # pick our seed
 
     # setup empty tensors, models, and constants
     data.preprocess()
@@ -1499,7 +3461,6 @@ def simple_wrapper(id_data, id_rho=0):
 
 def plus_minus_wrapper(id_data, id_rho=0):
     """Calculate all the possible temp +/- approaches"""
-    np.random.seed(232942)  # pick our seed
     samples = int(1e2)
     Bsize = int(1e2)
 
@@ -1522,6 +3483,7 @@ def plus_minus_wrapper(id_data, id_rho=0):
     data.temperature = 300.00
     data.blocks = samples // Bsize
     data.block_size = Bsize
+    data.seed = 232942  # pick our seed
 
     # setup empty tensors, models, and constants
     data.preprocess()
@@ -24,6 +24,11 @@ echo
 # should check if we still need to disable the MKL FAST MM
 # export MKL_DISABLE_FAST_MM=true
 
+# block_compute_pm_parallel() runs one worker process per cpu, so each worker gets a single BLAS thread
+export OMP_NUM_THREADS=1
+export OPENBLAS_NUM_THREADS=1
+export MKL_NUM_THREADS=1
+
 # execute the job - 100% necessary for execution_parameters to be interpreted as a string
 python3 ${SAMPLING_SCRIPT} "${EXECUTION_PARAMETERS}" ${SCRATCH_DIR} ${SLURM_JOB_ID}
 # ${PYTHON3_PATH} ${SAMPLING_SCRIPT} "${EXECUTION_PARAMETERS}" ${SCRATCH_DIR} ${SLURM_JOB_ID}
@@ -525,6 +525,10 @@ class PimcSubmissionClass(SubmissionClass):
         "cores_per_socket": 4,
         "wait_param": "",
         "script_name": "pimc.py",
+        # each job also reweights its samples to these temperatures, see BoxData.reweight_temperatures
+        "reweight_temperatures": None,
+        # each job also evaluates the denominators of these sampling models, see BoxData.extra_rho_ids
+        "extra_rho_ids": None,
     }
 
     def prepare_paths(self):
@@ -22,6 +22,11 @@ if (__name__ == '__main__'):
 
     """do a plus minus calculation"""
     data = engine.BoxDataPM.from_json_string(input_parameters)
+    # each job spawns its own random streams from the seed
+    data.id_job = id_job
+    # preemptible jobs save their progress and continue from it when they are restarted
+    data.resume = True
+    data.checkpoint_seconds = 30 * 60
     print(data.hash_vib)
     print(data.hash_rho)
     data.preprocess()
@@ -34,4 +39,10 @@ if (__name__ == '__main__'):
     result.path_root = FS.path_rho_results
     result.id_job = id_job
 
-    engine.block_compute_pm(data, result)
+    # use every core slurm gave us
+    number_of_processes = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+
+    if number_of_processes > 1:
+        engine.block_compute_pm_parallel(data, result, number_of_processes)
+    else:
+        engine.block_compute_pm(data, result)
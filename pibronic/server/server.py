@@ -21,3 +21,6 @@ class ServerExecutionParameters(Enum):
     R = "id_rho"
     beta = "beta"
     tau = "tau"
+    seed = "seed"
+    rwT = "reweight_temperatures"
+    xR = "extra_rho_ids"
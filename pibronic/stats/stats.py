@@ -19,22 +19,154 @@ from . import jackknife as jk
 from ..data import file_structure as fs
 from ..data import file_name
 from ..data import postprocessing as pp
-from ..pimc import BoxResultPM
+from ..pimc import BoxResult, BoxResultPM
 from .. import constants
 from ..constants import boltzman
 
 
 __all__ = [
+           "extract_scaled_data",
            "calculate_alpha_terms",
            "add_harmonic_contribution",
            "estimate_basic_properties",
            "calculate_basic_property_terms",
+           "extract_derivative_data",
+           "calculate_derivative_property_terms",
+           "estimate_derivative_properties",
+           "extract_reweighted_data",
+           "calculate_reweighted_terms",
+           "estimate_effective_sample_size",
+           "estimate_reweighted_properties",
+           "extract_multiple_rho_data",
+           "calculate_multiple_rho_terms",
+           "estimate_multiple_rho_properties",
+           "pair_antithetic_terms",
+           "extract_control_variate_data",
+           "apply_control_variates",
+           "calculate_control_variate_terms",
            ]
 
 
 __number_of_processes = 12
 
 
+def extract_scaled_data(pimc_result):
+    """ returns a list of rho, g, g+ and g- from a BoxResultPM object
+    if the results were computed with BoxData.log_scale each quantity is a mantissa with its own log scaling factor,
+    in that case rho's scaling factor is divided out of every quantity so they all share the same scale
+    and the ratios g/rho, g+/rho, g-/rho are unchanged
+    """
+    data = [pimc_result.scaled_rho.view(),         # rho
+            pimc_result.scaled_g.view(),           # g
+            pimc_result.scaled_gofr_plus.view(),   # g+
+            pimc_result.scaled_gofr_minus.view(),  # g-
+            ]
+
+    if pimc_result.log_scale_rho is None:
+        return data
+
+    log_scales = [pimc_result.log_scale_g,
+                  pimc_result.log_scale_gofr_plus,
+                  pimc_result.log_scale_gofr_minus,
+                  ]
+
+    for index, log_scale in enumerate(log_scales, start=1):
+        data[index] = data[index] * np.exp(log_scale - pimc_result.log_scale_rho)
+
+    return data
+
+
+def extract_derivative_data(pimc_result):
+    """ returns a list of rho, g, dg/dbeta and d^2g/dbeta^2 from a BoxResult object computed with BoxData.derivatives
+    the derivatives have the same scaling as g
+    """
+    assert pimc_result.derivatives, "the results don't have the derivatives of g, they need BoxData.derivatives"
+
+    data = [pimc_result.scaled_rho.view(),   # rho
+            pimc_result.scaled_g.view(),     # g
+            pimc_result.scaled_dg.view(),    # dg/dbeta
+            pimc_result.scaled_d2g.view(),   # d^2g/dbeta^2
+            ]
+    return data
+
+
+def calculate_derivative_property_terms(*args):
+    """calculate g/rho, d1, d2 given the per sample analytic derivatives of g with respect to beta
+    they take the place of g/rho, sym_d1 and sym_d2 from calculate_basic_property_terms()"""
+    rho, g, dg, d2g = args
+
+    ret = [g / rho,
+           dg / rho,
+           d2g / rho]
+
+    return ret
+
+
+def extract_reweighted_data(pimc_result):
+    """ returns a list of rho and g, g+ and g- at each of the reweighting temperatures (X, K, 3)
+    from a BoxResult object computed with BoxData.reweight_temperatures
+    """
+    assert pimc_result.reweight_temperatures is not None, "the results weren't reweighted, they need BoxData.reweight_temperatures"
+
+    data = [pimc_result.scaled_rho.view(),         # rho
+            pimc_result.scaled_g_reweight.view(),  # g at each reweighting temperature
+            ]
+    return data
+
+
+def calculate_reweighted_terms(*args):
+    """calculate g/rho, sym_d1, sym_d2 at each reweighting temperature (X, K)
+    the g/rho are the importance weights of the samples"""
+    delta_beta, rho, g_reweight = args
+    g, g_plus, g_minus = np.moveaxis(g_reweight, -1, 0)
+    return calculate_basic_property_terms(delta_beta, rho[:, np.newaxis], g, g_plus, g_minus)
+
+
+def estimate_effective_sample_size(weights):
+    """ returns the effective sample size (sum w)^2 / sum w^2 of the importance weights along the first axis
+    g can be negative so the magnitudes of the weights are used
+    when it is a small fraction of the number of samples the reweighting has broken down
+    """
+    magnitude = np.abs(weights)
+    return np.sum(magnitude, axis=0)**2. / np.sum(magnitude**2., axis=0)
+
+
+def extract_multiple_rho_data(pimc_result):
+    """ returns a list of rho, g and the denominators of the extra sampling models (X, J)
+    from a BoxResult object computed with BoxData.extra_rho_ids
+    """
+    assert pimc_result.extra_rho_ids is not None, "the results don't have extra sampling models, they need BoxData.extra_rho_ids"
+
+    data = [pimc_result.scaled_rho.view(),        # rho
+            pimc_result.scaled_g.view(),          # g
+            pimc_result.scaled_rho_extra.view(),  # rho_j
+            ]
+    return data
+
+
+def calculate_multiple_rho_terms(*args):
+    """calculate g/rho and the importance weights rho_j/rho of each extra sampling model"""
+    rho, g, rho_extra = args
+    return [g / rho, rho_extra / rho[:, np.newaxis]]
+
+
+def extract_control_variate_data(pimc_result):
+    """ returns a list of rho, h, h+ and h- from a BoxResultPM object computed with BoxData.control_variates
+    h is the trace of the product of the O matrices of the coupled model without its off-diagonal terms,
+    it has the same scaling as g and the expected values of h/rho, h+/rho, h-/rho are pimc_result.control_means
+    """
+    assert pimc_result.control_variates, "the results don't have the control variates, they need BoxData.control_variates"
+
+    data = [pimc_result.scaled_rho.view(),      # rho
+            pimc_result.scaled_h.view(),        # h
+            pimc_result.scaled_h_plus.view(),   # h+
+            pimc_result.scaled_h_minus.view(),  # h-
+            ]
+
+    assert not any(np.isnan(h).any() for h in data[1:]), "some of the loaded files don't have the control variates"
+    return data
+
+
 def calculate_basic_property_terms(*args):
     """calculate g/rho, sym_d1, sym_d2 given the estimation of the exact property"""
     delta_beta, rho, g, g_plus, g_minus = args
@@ -81,8 +213,66 @@ def calculate_alpha_terms(*args):
     return ret
 
 
+def apply_control_variates(terms, controls, means):
+    """ returns the terms with their control variates subtracted, y - c (x - E[x]), and the coefficients c
+    each term y is paired with the control x at the same index and means holds the known expected values E[x]
+    c = cov(y, x) / var(x) minimizes the variance of the adjusted term, a control without any variance gets c = 0
+    fitting c from the same samples only introduces a bias of order 1/X
+    """
+    adjusted_terms, coefficients = [], []
+    for y, x, mean in zip(terms, controls, means):
+        variance = np.var(x)
+        c = np.mean((y - np.mean(y)) * (x - np.mean(x))) / variance if variance > 0. else 0.
+        adjusted_terms.append(y - c * (x - mean))
+        coefficients.append(float(c))
+    return adjusted_terms, coefficients
+
+
+def calculate_control_variate_terms(pimc_result, delta_beta):
+    """ returns the number of independent samples, the basic property terms with the harmonic control variates applied
+    (see apply_control_variates()) and the coefficient of each control variate
+    the controls are the same terms computed from h, h+ and h- (see extract_control_variate_data())
+    """
+    rho, *controls = extract_control_variate_data(pimc_result)
+
+    terms = calculate_basic_property_terms(delta_beta, *extract_scaled_data(pimc_result))
+    control_terms = calculate_basic_property_terms(delta_beta, rho, *controls)
+    # the expected values of the control terms, rho is replaced by 1 because control_means are already E[h/rho]
+    means = calculate_basic_property_terms(delta_beta, 1., *pimc_result.control_means)
+
+    # the coefficients are fitted to the independent samples
+    X, paired_terms = pair_antithetic_terms(pimc_result, terms + control_terms)
+    terms, control_terms = paired_terms[:len(terms)], paired_terms[len(terms):]
+
+    terms, coefficients = apply_control_variates(terms, control_terms, means)
+    return X, terms, coefficients
+
+
+def pair_antithetic_terms(pimc_result, terms):
+    """ returns the number of independent samples and the terms, averaged over each pair if the samples are antithetic
+    with BoxData.antithetic the samples (2i, 2i+1) are mirrored pairs, which are correlated,
+    so the estimators and the jackknife have to treat the average of each pair as one sample
+    only the per sample terms (whose first axis has the length of the samples) are averaged, constants are unchanged
+    an unpaired last sample (if the samples were truncated to an odd number) is dropped
+    """
+    X = pimc_result.samples
+    if not pimc_result.antithetic:
+        return X, terms
+
+    pairs = X // 2
+
+    def average(term):
+        if np.ndim(term) == 0 or len(term) != X:
+            return term
+        term = np.asarray(term)[0:2*pairs]
+        return term.reshape(pairs, 2, *term.shape[1:]).mean(axis=1)
+
+    return pairs, [average(term) for term in terms]
+
+
 def basic_estimate_Z_monte_carlo(g_over_rho, number_of_samples):
-    """ estimates the normalization of the quasi-probability disribution g(R) and its standard deviation """
+    """ estimates the normalization of the quasi-probability disribution g(R) and its standard deviation
+    the samples have to be independent, antithetic pairs are combined by pair_antithetic_terms() first """
     ""
     Z_MC = np.mean(g_over_rho)
     Z_err = np.std(g_over_rho, ddof=0)
@@ -123,6 +313,83 @@ def estimate_basic_properties(*args):
     return return_dictionary
 
 
+def estimate_derivative_properties(*args):
+    """ calculates the Z_MC, E, Cv, and their respective errors and returns a dictionary with 6 corresponding entries
+    the estimates are the same as estimate_basic_properties() but because each sample has its own derivatives
+    the errors of E and Cv can be propagated from the per sample terms to first order (the delta method)
+    """
+    X, T, g_r, d1, d2 = args
+
+    Z_MC, Z_err = basic_estimate_Z_monte_carlo(g_r, X)
+    E, _ = basic_estimate_internal_energy(d1, Z_MC)
+    Cv, _ = basic_estimate_heat_capacity(d2, Z_MC, E, T)
+
+    # the first order change in E and Cv due to each sample
+    kBT = boltzman * pow(T, 2.)
+    E_terms = -1. * (d1 + E * g_r) / Z_MC
+    Cv_terms = (d2 - (np.mean(d2) / Z_MC) * g_r) / Z_MC
+    Cv_terms -= 2. * E * E_terms
+    Cv_terms /= kBT
+
+    E_err = np.std(E_terms, ddof=0) / np.sqrt(X - 1)
+    Cv_err = np.std(Cv_terms, ddof=0) / np.sqrt(X - 1)
+
+    return_dictionary = {"Z": Z_MC, "Z error": Z_err,
+                         "E": E,    "E error": E_err,
+                         "Cv": Cv,  "Cv error": Cv_err,
+                         }
+    return return_dictionary
+
+
+def estimate_reweighted_properties(*args):
+    """ calculates the Z_MC, E, Cv, their errors and the effective sample size at each reweighting temperature
+    returns a dictionary of lists with an entry for each temperature
+    Z_MC is relative to the partition function of the sampling distribution at the reference temperature
+    so it has to be multiplied by Z_sampling(reference) / Z_sampling(T) to compare with the basic Z_MC at T
+    like estimate_basic_properties() the harmonic contribution at each temperature still has to be added to E and Cv
+    """
+    X, temperatures, g_r, sym1, sym2 = args
+
+    properties = [estimate_basic_properties(X, T, g_r[:, k], sym1[:, k], sym2[:, k])
+                  for k, T in enumerate(temperatures)]
+
+    return_dictionary = {key: [float(p[key]) for p in properties] for key in properties[0]}
+    return_dictionary["temperatures"] = list(temperatures)
+    return_dictionary["ESS"] = estimate_effective_sample_size(g_r).tolist()
+    return return_dictionary
+
+
+def estimate_multiple_rho_properties(*args):
+    """ estimates what each extra sampling model would give if the samples had been drawn from it
+    returns a dictionary of lists with an entry for each extra sampling model:
+        - Z, the Z_MC relative to that model's partition function
+        - ESS, the effective sample size of its importance weights
+        - relative variance, the variance of g/rho_j over Z^2 for samples drawn from rho_j
+        - relative cost, the number of samples it needs for the same error as rho, less than 1 is better
+    the relative variance of rho itself is included for comparison
+    """
+    X, rho_ids, g_r, weights = args
+
+    # the mean weight is the ratio of the partition functions of rho_j and rho
+    Z_ratio = np.mean(weights, axis=0)
+    Z_MC = np.mean(g_r) / Z_ratio
+    ESS = estimate_effective_sample_size(weights)
+
+    # the second moment of g/rho_j under rho_j is the mean of w (g/(rho w))^2 = g_r^2 / w under rho
+    second_moment = np.mean(g_r[:, np.newaxis]**2. / weights, axis=0) / Z_ratio
+    relative_variance = second_moment / Z_MC**2. - 1.
+    proposal_relative_variance = np.var(g_r) / np.mean(g_r)**2.
+
+    return_dictionary = {"rho ids": [int(i) for i in rho_ids],
+                         "Z": Z_MC.tolist(),
+                         "ESS": ESS.tolist(),
+                         "relative variance": relative_variance.tolist(),
+                         "relative cost": (relative_variance / proposal_relative_variance).tolist(),
+                         "proposal relative variance": float(proposal_relative_variance),
+                         }
+    return return_dictionary
+
+
 def add_harmonic_contribution(input_dict, E_sampling, Cv_sampling):
     """ adds the constant harmonic contribution to the energy and the heat capacity """
     input_dict["E"] += E_sampling  # add the harmonic contribution to the energy
@@ -145,16 +412,16 @@ def apply_parameter_restrictions(args):
     # return
 
 
-def starmap_wrapper(FS, P, T, statistical_operation):
+def starmap_wrapper(FS, P, T, statistical_operation, result_type=BoxResultPM):
     """ this function allows us to use the multiprocessing starmap in a convient way inside basic_statistical_analysis_of_pimc() and basic_jackknife_analysis_of_pimc()
     input is a FileStructure object, a bead value, a temperature value, and a function which preforms the calculation
-    it loads all appropriate files
+    it loads all appropriate files into a result_type object
     it then calls the statistical_operation() function with these parameters
     finally it saves the returned dictionary to the appropriate *_thermo file
     """
 
     # create the empty data structs which we fill with data
-    pimc_results = BoxResultPM()
+    pimc_results = result_type()
     rhoData = {}
 
     # load the data
@@ -183,14 +450,11 @@ def basic_statistical_analysis(temperature, pimc_result, analytic_data):
     """ takes a temperature, a BoxResult object type, and a dictionary of analytical data and calculates the basic statistical properties, Z, E, Cv and returns them in a dictionary"""
 
     # these names need to be cross referenced with the naming scheme in pimc.py
-    data = [pimc_result.scaled_rho.view(),         # rho
-            pimc_result.scaled_g.view(),           # g
-            pimc_result.scaled_gofr_plus.view(),   # g+
-            pimc_result.scaled_gofr_minus.view(),  # g-
-            ]
+    data = extract_scaled_data(pimc_result)  # rho, g, g+, g-
 
     terms = calculate_basic_property_terms(constants.delta_beta, *data)
-    basic_dict = estimate_basic_properties(pimc_result.samples, temperature, *terms)
+    X, terms = pair_antithetic_terms(pimc_result, terms)
+    basic_dict = estimate_basic_properties(X, temperature, *terms)
     add_harmonic_contribution(basic_dict, analytic_data["E"], analytic_data["Cv"])
 
     return basic_dict
@@ -200,24 +464,83 @@ def alpha_statistical_analysis(temperature, pimc_result, analytic_data):
     """ takes a temperature, a BoxResult object type, and a dictionary of analytical data and calculates the basic statistical properties, Z, E, Cv and returns them in a dictionary"""
 
     # these names need to be cross referenced with the naming scheme in pimc.py
-    data = [pimc_result.scaled_rho.view(),         # rho
-            pimc_result.scaled_g.view(),           # g
-            pimc_result.scaled_gofr_plus.view(),   # g+
-            pimc_result.scaled_gofr_minus.view(),  # g-
+    data = [*extract_scaled_data(pimc_result),     # rho, g, g+, g-
             analytic_data["alpha_plus"],
             analytic_data["alpha_minus"],
             ]
 
     terms = calculate_alpha_terms(constants.delta_beta, *data)
     terms = terms[:-4]  # we don't need the last four things
-    alpha_dict = estimate_basic_properties(pimc_result.samples, temperature, *terms)
+    X, terms = pair_antithetic_terms(pimc_result, terms)
+    alpha_dict = estimate_basic_properties(X, temperature, *terms)
     add_harmonic_contribution(alpha_dict, analytic_data["E"], analytic_data["Cv"])
 
     return alpha_dict
 
 
+def derivative_statistical_analysis(temperature, pimc_result, analytic_data):
+    """ takes a temperature, a BoxResult object type computed with BoxData.derivatives, and a dictionary of analytical data and calculates the statistical properties, Z, E, Cv and their errors, and returns them in a dictionary"""
+
+    data = extract_derivative_data(pimc_result)  # rho, g, dg, d2g
+
+    terms = calculate_derivative_property_terms(*data)
+    X, terms = pair_antithetic_terms(pimc_result, terms)
+    derivative_dict = estimate_derivative_properties(X, temperature, *terms)
+    add_harmonic_contribution(derivative_dict, analytic_data["E"], analytic_data["Cv"])
+
+    return derivative_dict
+
+
+def control_variate_statistical_analysis(temperature, pimc_result, analytic_data):
+    """ takes a temperature, a BoxResult object type computed with BoxData.control_variates, and a dictionary of analytical data and calculates the basic statistical properties, Z, E, Cv and their errors with the harmonic control variates applied, and returns them in a dictionary"""
+
+    X, terms, coefficients = calculate_control_variate_terms(pimc_result, constants.delta_beta)
+    control_dict = estimate_basic_properties(X, temperature, *terms)
+    add_harmonic_contribution(control_dict, analytic_data["E"], analytic_data["Cv"])
+    control_dict["control coefficients"] = coefficients
+
+    return control_dict
+
+
+def reweighted_statistical_analysis(temperature, pimc_result, analytic_data):
+    """ takes the reference temperature, a BoxResult object type computed with BoxData.reweight_temperatures, and a dictionary of analytical data and calculates Z, E, Cv and the effective sample size at each reweighting temperature, and returns them in a dictionary
+    the effective sample size of the samples at the reference temperature is included for comparison
+    antithetic pairs count as one sample in the effective sample sizes"""
+
+    rho, g_reweight = extract_reweighted_data(pimc_result)
+
+    terms = calculate_reweighted_terms(constants.delta_beta, rho, g_reweight)
+    X, (*terms, reference) = pair_antithetic_terms(pimc_result, [*terms, pimc_result.scaled_g / rho])
+    reweighted_dict = estimate_reweighted_properties(X, pimc_result.reweight_temperatures, *terms)
+    for k, T in enumerate(reweighted_dict["temperatures"]):
+        key = f"{T:.2f}"
+        assert key in analytic_data["temperatures"], f"no analytical results for the reweighting temperature {key:s}"
+        reweighted_dict["E"][k] += analytic_data["temperatures"][key]["E_sampling"]
+        reweighted_dict["Cv"][k] += analytic_data["temperatures"][key]["Cv_sampling"]
+    reweighted_dict["reference temperature"] = temperature
+    reweighted_dict["reference ESS"] = float(estimate_effective_sample_size(reference))
+    reweighted_dict["Z_sampling"] = analytic_data["Z"]
+
+    return reweighted_dict
+
+
+def multiple_rho_statistical_analysis(temperature, pimc_result, analytic_data):
+    """ takes a temperature, a BoxResult object type computed with BoxData.extra_rho_ids, and a dictionary of analytical data and compares the sampling model the samples were drawn from with each extra sampling model, and returns the comparison in a dictionary
+    antithetic pairs count as one sample, for the sampling model and for each extra sampling model"""
+
+    terms = calculate_multiple_rho_terms(*extract_multiple_rho_data(pimc_result))
+    X, terms = pair_antithetic_terms(pimc_result, terms)
+    multiple_rho_dict = estimate_multiple_rho_properties(X, pimc_result.extra_rho_ids, *terms)
+    multiple_rho_dict["temperature"] = temperature
+
+    return multiple_rho_dict
+
+
 def statistical_analysis_of_pimc(FS, method="basic", location="local", samples=None):
-    """ preform calculation of Z, E, Cv for the given model, using either basic or alpha/difference terms """
+    """ preform calculation of Z, E, Cv for the given model, using either basic or alpha/difference terms,
+    the analytic derivatives (BoxData.derivatives), the harmonic control variates (BoxData.control_variates)
+    or the samples reweighted to several temperatures (BoxData.reweight_temperatures),
+    the multiple_rho method instead compares the extra sampling models (BoxData.extra_rho_ids) """
     FS.generate_model_hashes()  # build the hashes so that we can check against them
     list_pimc = pp.retrive_pimc_file_list(FS)
 
@@ -235,21 +558,36 @@ def statistical_analysis_of_pimc(FS, method="basic", location="local", samples=N
                 ]
 
     # choose what statistical analysis we are going to preform
-    if method is "basic":
+    result_type = BoxResultPM
+    if method == "basic":
         operation = basic_statistical_analysis
-    elif method is "alpha":
+    elif method == "alpha":
         operation = alpha_statistical_analysis
+    elif method == "control_variate":
+        operation = control_variate_statistical_analysis
+    elif method == "derivative":
+        # the derivative results don't have g+ or g-
+        operation = derivative_statistical_analysis
+        result_type = BoxResult
+    elif method == "reweighted":
+        # the reweighted results have their own g+ and g- at each temperature
+        operation = reweighted_statistical_analysis
+        result_type = BoxResult
+    elif method == "multiple_rho":
+        # compares the sampling model with the extra sampling models, it doesn't estimate E or Cv
+        operation = multiple_rho_statistical_analysis
+        result_type = BoxResult
     else:
         raise Exception(f"Invalid value for parameter method:({method})")
 
     # dispatch multiple processes to execute the analyze concurrently
-    if location is "local":
-        basic_wrapper = partial(starmap_wrapper, statistical_operation=operation)
+    if location == "local":
+        basic_wrapper = partial(starmap_wrapper, statistical_operation=operation, result_type=result_type)
 
         with mp.Pool(__number_of_processes) as p:
             p.starmap(basic_wrapper, arg_list)
 
-    elif location is "server":
+    elif location == "server":
         assert False, "Need to write this code"
 
         # TODO - add a simple command to check that slurm is installed
@@ -272,17 +610,14 @@ def basic_jackknife_analysis(temperature, pimc_result, analytic_data):
     """ takes a temperature, a BoxResult object type, and a dictionary of analytical data and calculates the basic statistical properties, Z, E, Cv and returns them in a dictionary"""
 
     # these names need to be cross referenced with the naming scheme in pimc.py
-    data = [pimc_result.scaled_rho.view(),         # rho
-            pimc_result.scaled_g.view(),           # g
-            pimc_result.scaled_gofr_plus.view(),   # g+
-            pimc_result.scaled_gofr_minus.view(),  # g-
-            ]
+    data = extract_scaled_data(pimc_result)  # rho, g, g+, g-
 
     T = temperature
-    X = pimc_result.samples
     dB = constants.delta_beta
 
     terms = calculate_basic_property_terms(dB, *data)
+    # the jackknife leaves out one independent sample at a time, which is a whole antithetic pair
+    X, terms = pair_antithetic_terms(pimc_result, terms)
     jk_terms = jk.calculate_jackknife_terms(X, terms)
 
     basic_dict = estimate_basic_properties(X, T, *terms)
@@ -303,19 +638,16 @@ def alpha_jackknife_analysis(temperature, pimc_result, analytic_data):
     """ takes a temperature, a BoxResult object type, and a dictionary of analytical data and calculates the basic statistical properties, Z, E, Cv and returns them in a dictionary"""
 
     # these names need to be cross referenced with the naming scheme in pimc.py
-    data = [pimc_result.scaled_rho.view(),         # rho
-            pimc_result.scaled_g.view(),           # g
-            pimc_result.scaled_gofr_plus.view(),   # g+
-            pimc_result.scaled_gofr_minus.view(),  # g-
+    data = [*extract_scaled_data(pimc_result),     # rho, g, g+, g-
             analytic_data["alpha_plus"],
             analytic_data["alpha_minus"],
             ]
 
     T = temperature
-    X = pimc_result.samples
     dB = constants.delta_beta
 
     terms = calculate_alpha_terms(dB, *data)
+    X, terms = pair_antithetic_terms(pimc_result, terms)
     # we don't need the 1sym or 2sym for the jackknife terms
     jk_terms = jk.calculate_alpha_jackknife_terms(X, dB, terms[0], *terms[3:7])
     terms = terms[:-4]  # we don't need the last four things
@@ -333,6 +665,31 @@ def alpha_jackknife_analysis(temperature, pimc_result, analytic_data):
     return output_dict
 
 
+def control_variate_jackknife_analysis(temperature, pimc_result, analytic_data):
+    """ takes a temperature, a BoxResult object type computed with BoxData.control_variates, and a dictionary of analytical data and calculates the basic statistical properties, Z, E, Cv with the harmonic control variates applied and returns them in a dictionary"""
+
+    T = temperature
+    dB = constants.delta_beta
+
+    # the coefficients are fitted once to all the samples, the jackknife doesn't refit them
+    X, terms, coefficients = calculate_control_variate_terms(pimc_result, dB)
+    jk_terms = jk.calculate_jackknife_terms(X, terms)
+
+    control_dict = estimate_basic_properties(X, T, *terms)
+    jk_dict = jk.estimate_jackknife(X, T, dB, control_dict, *jk_terms)
+
+    add_harmonic_contribution(control_dict, analytic_data["E"], analytic_data["Cv"])
+    add_harmonic_contribution(jk_dict, analytic_data["E"], analytic_data["Cv"])
+
+    # create the output dictionary and rename the jackknife terms
+    output_dict = control_dict.copy()
+    for key in jk_dict.keys():
+        output_dict["jk_" + key] = jk_dict[key]
+    output_dict["control coefficients"] = coefficients
+
+    return output_dict
+
+
 def jackknife_analysis_of_pimc(FS, method="basic", location="local", samples=None):
     """ preform calculation of Z, E, Cv for the given model, using either basic or alpha/difference terms with the jackknife method"""
     FS.generate_model_hashes()  # build the hashes so that we can check against them
@@ -351,18 +708,22 @@ def jackknife_analysis_of_pimc(FS, method="basic", location="local", samples=Non
                 for T in args["temperatures"]
                 ]
     # choose what statistical analysis we are going to preform
-    if method is "basic":
+    if method == "basic":
         operation = basic_jackknife_analysis
-    elif method is "alpha":
+    elif method == "alpha":
         operation = alpha_jackknife_analysis
+    elif method == "control_variate":
+        operation = control_variate_jackknife_analysis
+    else:
+        raise Exception(f"Invalid value for parameter method:({method})")
 
     # dispatch multiple processes to execute the analyze concurrently
-    if location is "local":
+    if location == "local":
         jackknife_wrapper = partial(starmap_wrapper, statistical_operation=operation)
         with mp.Pool(__number_of_processes) as p:
             p.starmap(jackknife_wrapper, arg_list)
 
-    elif location is "server":
+    elif location == "server":
         assert False, "Need to write this code"
 
         # TODO - add a simple command to check that slurm is installed
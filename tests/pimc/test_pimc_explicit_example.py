@@ -10,6 +10,7 @@ from os.path import dirname, join, abspath
 # third party imports
 import pytest
 import numpy as np
+import scipy.linalg
 # from numpy import float64 as F64
 
 # local imports
@@ -58,7 +59,7 @@ def FS(root, path_src):
 
 
 @pytest.fixture(scope="module")
-def data(FS):
+def data(FS, temperature_fixture):
     data = pimc.BoxData.from_FileStructure(FS)
 
     err_str = "data didn't build correctly"
@@ -76,7 +77,7 @@ def data(FS):
 
     data.samples = n_samples
     data.beads = 5
-    data.temperature = temperature_fixture()
+    data.temperature = temperature_fixture
     data.blocks = data.samples // block_size
     data.block_size = block_size
 
@@ -115,7 +116,8 @@ def test_multivariate_normal_distributions(data, path_src):
     # build the un-diagonalized covariance matrix
     from numpy import newaxis as NEW
     left = 2. * data.rho.const.cothAN[..., NEW, NEW] * np.eye(5)
-    right = data.rho.const.cschAN[..., NEW, NEW] * data.circulant_matrix[NEW, NEW, ...]
+    circulant_matrix = scipy.linalg.circulant([0, 1] + [0]*(data.beads-3) + [1])
+    right = data.rho.const.cschAN[..., NEW, NEW] * circulant_matrix[NEW, NEW, ...]
     inverse_covariance = left - right
     cov = np.linalg.inv(inverse_covariance)
 
@@ -189,22 +191,24 @@ def test_block_compute(FS, data, results, path_src):
         end = (block_index + 1) * data.block_size
         sample_view = slice(start, end)
 
-        data.qTensor = np.zeros(data.size['BANP'])
-
-        data.qTensor = samples[sample_view, ...]
+        # the samples are identical along the surface axis, only one copy of R is used
+        data.qTensor = samples[sample_view, 0, ...]
 
         # build O matrices for sampling distribution
+        # the O matrices are stored as their diagonals
         build_o_matrix(data, rho.const, rho.state_shift)
         assert np.allclose(rho.const.omatrix,
-                           rho_oMatricies[sample_view, ...], rtol=RTOL, atol=ATOL)
+                           np.diagonal(rho_oMatricies[sample_view, ...], axis1=2, axis2=3), rtol=RTOL, atol=ATOL)
         build_o_matrix(data, vib.const, vib.state_shift)
         assert np.allclose(vib.const.omatrix,
-                           vib_oMatricies[sample_view, ...], rtol=RTOL, atol=ATOL)
+                           np.diagonal(vib_oMatricies[sample_view, ...], axis1=2, axis2=3), rtol=RTOL, atol=ATOL)
 
         build_denominator(rho.const, y_rho, sample_view)
         diagonalize_coupling_matrix(data)
         build_numerator(data, vib.const, y_g, sample_view)
-        assert np.allclose(data.M_matrix, vib_mMatricies[sample_view, ...], rtol=RTOL, atol=ATOL)
+        # the diagonal O matrices are folded into the M matrices
+        folded = vib_mMatricies[sample_view, ...] * vib.const.omatrix[:, :, np.newaxis, :]
+        assert np.allclose(data.M_matrix, folded, rtol=RTOL, atol=ATOL)
 
     assert np.allclose(y_rho, denominator, rtol=RTOL, atol=ATOL)
     assert np.allclose(y_g, numerator, rtol=RTOL, atol=ATOL)
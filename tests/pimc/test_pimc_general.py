@@ -4,6 +4,8 @@
 # system imports
 import inspect
 import os
+import signal
+import time
 from os.path import dirname, join
 
 
@@ -11,11 +13,13 @@ from os.path import dirname, join
 from ..context import pibronic
 from pibronic import pimc
 import pibronic.data.file_structure as fs
+from pibronic.vibronic import vIO, VMK
 
 # third party imports
 import pytest
 import numpy as np
 from numpy import float64 as F64
+from numpy import newaxis as NEW
 
 
 @pytest.fixture()
@@ -58,6 +62,20 @@ def test_TemperatureDependentClass(FS, random_model):
     return
 
 
+def test_stacked_TemperatureDependentClass(random_model):
+    """the constants of a stack of taus should match those computed for each tau separately"""
+    taus = pibronic.constants.beta(np.array([300.00, 290.00, 310.00])) / 15
+    stack = pibronic.pimc.pimc.TemperatureDependentClass(random_model, taus)
+    for k, tau in enumerate(taus):
+        single = pibronic.pimc.pimc.TemperatureDependentClass(random_model, tau)
+        view = stack.select(k)
+        for name in ["cothAN", "cschAN", "omatrix_prefactor", "log_omatrix_prefactor"]:
+            assert np.allclose(getattr(view, name), getattr(single, name))
+        # the views share memory with the stack
+        assert np.shares_memory(view.omatrix, stack.omatrix)
+    return
+
+
 @pytest.fixture(params=[(0, 0), (0, 1), (1, 0), (1, 1)])
 def data(request):
     data = pimc.BoxData()
@@ -71,6 +89,29 @@ def FS(path, data):
     return fs.FileStructure.from_boxdata(path, data)
 
 
+@pytest.fixture()
+def block_data(FS, data):
+    """data with the settings most of the block_compute tests share
+    each test sets the flags it varies and then calls preprocess()"""
+    data.path_vib_model = FS.path_vib_model
+    data.path_rho_model = FS.path_rho_model
+
+    FS.generate_model_hashes()
+    data.hash_vib = FS.hash_vib
+    data.hash_rho = FS.hash_rho
+
+    data.states = 2
+    data.modes = 2
+
+    data.samples = 20
+    data.beads = 12
+    data.temperature = 300.0
+    data.block_size = 10
+    data.blocks = 2
+    data.seed = 242351
+    return data
+
+
 def test_simple_block_compute(FS, data):
     samples = int(1e1)
     block_size = int(1e1)
@@ -116,6 +157,28 @@ def FS_pm(path, dataPM):
     return fs.FileStructure.from_boxdata(path, dataPM)
 
 
+@pytest.fixture()
+def block_dataPM(FS_pm, dataPM):
+    """dataPM with the settings most of the block_compute_pm tests share, see block_data()"""
+    dataPM.path_vib_model = FS_pm.path_vib_model
+    dataPM.path_rho_model = FS_pm.path_rho_model
+
+    FS_pm.generate_model_hashes()
+    dataPM.hash_vib = FS_pm.hash_vib
+    dataPM.hash_rho = FS_pm.hash_rho
+
+    dataPM.states = 2
+    dataPM.modes = 2
+
+    dataPM.samples = 20
+    dataPM.beads = 12
+    dataPM.temperature = 300.0
+    dataPM.block_size = 10
+    dataPM.blocks = 2
+    dataPM.seed = 242351
+    return dataPM
+
+
 @pytest.fixture(params=range(0, 10))  # this creates 10 different output files for this test case
 def job_id(request):
     return request.param
@@ -158,3 +221,1011 @@ def test_simple_block_compute_pm(FS_pm, dataPM, job_id):
 # def test_simple_jackknife(FS_pm):
 #     pibronic.jackknife.calculate_estimators_and_variance(FS_pm)
 #     return
+
+
+def test_block_compute_pm_parallel(FS_pm, block_dataPM):
+    samples = int(4e1)
+    block_size = int(1e1)
+
+    block_dataPM.samples = samples
+    block_dataPM.blocks = samples // block_size
+    block_dataPM.block_size = block_size
+
+    # setup empty tensors, models, and constants
+    block_dataPM.preprocess()
+
+    serial = pimc.BoxResultPM(data=block_dataPM)
+    serial.path_root = FS_pm.path_rho_results
+    serial.id_job = 0
+    pimc.block_compute_pm(block_dataPM, serial)
+
+    parallel = pimc.BoxResultPM(data=block_dataPM)
+    parallel.path_root = FS_pm.path_rho_results
+    parallel.id_job = 1
+    pimc.block_compute_pm_parallel(block_dataPM, parallel, number_of_processes=3)
+
+    # every block draws from its own stream so the order of execution doesn't matter
+    for name in ["scaled_rho", "scaled_g", "scaled_gofr_plus", "scaled_gofr_minus"]:
+        assert not np.any(np.isnan(getattr(parallel, name)))
+        assert np.array_equal(getattr(serial, name), getattr(parallel, name))
+    return
+
+
+def test_checkpoint_and_resume_parallel(monkeypatch, FS_pm, block_dataPM):
+    samples = int(6e1)
+    block_size = int(1e1)
+
+    block_dataPM.samples = samples
+    block_dataPM.blocks = samples // block_size
+    block_dataPM.block_size = block_size
+
+    # setup empty tensors, models, and constants
+    block_dataPM.preprocess()
+
+    full = pimc.BoxResultPM(data=block_dataPM)
+    full.path_root = FS_pm.path_rho_results
+    full.id_job = 7
+    pimc.block_compute_pm(block_dataPM, full)
+
+    # the job is preempted while a worker is computing the fourth block
+    numerator = pimc.pimc.build_stacked_numerator
+
+    def preempted(data, vib_stack, outputArrays, idx):
+        if idx.start == 3 * block_size:
+            os.kill(os.getppid(), signal.SIGTERM)
+            time.sleep(60)
+        return numerator(data, vib_stack, outputArrays, idx)
+
+    monkeypatch.setattr(pimc.pimc, "build_stacked_numerator", preempted)
+    stopped = pimc.BoxResultPM(data=block_dataPM)
+    stopped.path_root = FS_pm.path_rho_results
+    stopped.id_job = 7
+    with pytest.raises(SystemExit):
+        pimc.block_compute_pm_parallel(block_dataPM, stopped, number_of_processes=2)
+
+    # the parent saved the blocks that were completed before the fourth one
+    saved_blocks = pimc.BoxResultPM.read_number_of_samples(stopped.compute_path_to_file()) // block_size
+    assert 1 <= saved_blocks <= 3
+
+    # restarting the job only computes the blocks that weren't saved
+    def resumed_numerator(data, vib_stack, outputArrays, idx):
+        assert idx.start >= saved_blocks * block_size, "a completed block was computed again"
+        return numerator(data, vib_stack, outputArrays, idx)
+
+    monkeypatch.setattr(pimc.pimc, "build_stacked_numerator", resumed_numerator)
+    block_dataPM.seed = 1
+    block_dataPM.resume = True
+    resumed = pimc.BoxResultPM(data=block_dataPM)
+    resumed.path_root = FS_pm.path_rho_results
+    resumed.id_job = 7
+    pimc.block_compute_pm_parallel(block_dataPM, resumed, number_of_processes=2)
+
+    assert block_dataPM.seed == 242351
+    loaded = pimc.BoxResultPM()
+    loaded.load_results(resumed.compute_path_to_file())
+    for name in ["scaled_rho", "scaled_g", "scaled_gofr_plus", "scaled_gofr_minus"]:
+        assert np.array_equal(getattr(full, name), getattr(loaded, name))
+    return
+
+
+def test_regenerate_block(FS, block_data):
+    samples = int(3e1)
+    block_size = int(1e1)
+
+    block_data.samples = samples
+    block_data.blocks = samples // block_size
+    block_data.block_size = block_size
+    block_data.id_job = 3
+
+    # setup empty tensors, models, and constants
+    block_data.preprocess()
+
+    results = pimc.BoxResult(data=block_data)
+    results.path_root = FS.path_rho_results
+    results.id_job = 0
+    pimc.block_compute(block_data, results)
+
+    # the seed and block ids are stored with the results
+    seed, job_key = pimc.BoxResult.read_seed(results.compute_path_to_file())
+    assert (seed, job_key) == (block_data.seed, 3)
+    loaded = pimc.BoxResult()
+    loaded.load_results(results.compute_path_to_file())
+    assert np.array_equal(loaded.block_ids, np.arange(block_data.blocks))
+
+    # a block is the same no matter when it is drawn
+    R_last, sources_last = block_data.regenerate_block(2)
+    block_data.regenerate_block(0)
+    R_again, sources_again = block_data.regenerate_block(2)
+    assert np.array_equal(R_last, R_again)
+    assert np.array_equal(sources_last, sources_again)
+
+    # but other jobs draw different samples from the same seed
+    block_data.id_job = 4
+    R_other, _ = block_data.regenerate_block(2)
+    assert not np.allclose(R_last, R_other)
+    return
+
+
+def test_checkpoint_and_resume(FS, block_data):
+    samples = int(4e1)
+    block_size = int(1e1)
+
+    block_data.samples = samples
+    block_data.blocks = samples // block_size
+    block_data.block_size = block_size
+
+    # setup empty tensors, models, and constants
+    block_data.preprocess()
+
+    full = pimc.BoxResult(data=block_data)
+    full.path_root = FS.path_rho_results
+    full.id_job = 5
+    pimc.block_compute(block_data, full)
+
+    # SIGTERM saves the completed blocks and then exits
+    with pimc.pimc.Checkpoint(block_data, full) as checkpoint:
+        checkpoint.handler(signal.SIGTERM, None)
+        with pytest.raises(SystemExit):
+            checkpoint.block_completed(1)
+    assert pimc.BoxResult.read_number_of_samples(full.compute_path_to_file()) == 2 * block_size
+
+    # restarting the job continues the same streams from the third block
+    block_data.seed = 1
+    block_data.resume = True
+    resumed = pimc.BoxResult(data=block_data)
+    resumed.path_root = FS.path_rho_results
+    resumed.id_job = 5
+    pimc.block_compute(block_data, resumed)
+
+    assert block_data.seed == 242351
+    assert np.array_equal(full.scaled_rho, resumed.scaled_rho)
+    assert np.array_equal(full.scaled_g, resumed.scaled_g)
+    return
+
+
+def test_prefetch_block_compute(FS, block_data):
+    samples = int(4e1)
+    block_size = int(1e1)
+
+    block_data.samples = samples
+    block_data.blocks = samples // block_size
+    block_data.block_size = block_size
+
+    # setup empty tensors, models, and constants
+    block_data.preprocess()
+
+    # preparing the next block on the helper thread shouldn't change the samples
+    results = {}
+    for prefetch in [False, True]:
+        block_data.prefetch = prefetch
+        results[prefetch] = pimc.BoxResult(data=block_data)
+        results[prefetch].path_root = FS.path_rho_results
+        results[prefetch].id_job = 0
+        pimc.block_compute(block_data, results[prefetch])
+
+    assert np.array_equal(results[False].scaled_rho, results[True].scaled_rho)
+    assert np.array_equal(results[False].scaled_g, results[True].scaled_g)
+    return
+
+
+def test_antithetic_block_compute(FS, block_data):
+    samples = int(4e1)
+    block_size = int(1e1)
+
+    block_data.samples = samples
+    block_data.blocks = samples // block_size
+    block_data.block_size = block_size
+    block_data.antithetic = True
+
+    # setup empty tensors, models, and constants
+    block_data.preprocess()
+
+    results = pimc.BoxResult(data=block_data)
+    results.path_root = FS.path_rho_results
+    results.id_job = 6
+    pimc.block_compute(block_data, results)
+
+    # the flag is stored with the results
+    loaded = pimc.BoxResult()
+    loaded.load_results(results.compute_path_to_file())
+    assert loaded.antithetic
+    assert np.array_equal(loaded.scaled_g, results.scaled_g)
+
+    # each pair is drawn from the same surface and mirrored about its mean
+    R, sources = block_data.regenerate_block(1)
+    assert np.array_equal(sources[0::2], sources[1::2])
+    mean = block_data.rho.sample_shift[0::2, :, NEW]
+    assert np.allclose(R[0::2] - mean, mean - R[1::2])
+    assert not np.allclose(R[0::2], R[1::2])
+
+    # the pairs can't be split across blocks
+    block_data.block_size = 5
+    with pytest.raises(AssertionError, match="even block_size"):
+        block_data.preprocess()
+    return
+
+
+def test_result_writer(tmpdir):
+    array = np.arange(10, dtype=F64)
+    paths = [str(tmpdir.join("snapshot_{:d}.npz".format(i))) for i in range(5)]
+
+    # the writer copies the arrays so changing them after submitting doesn't affect the files
+    with pimc.pimc.ResultWriter(maxsize=1) as writer:
+        for i, path in enumerate(paths):
+            writer.submit(path, {"s_g": array})
+            array += 1.
+
+    for i, path in enumerate(paths):
+        with np.load(path) as fileObj:
+            assert np.array_equal(fileObj["s_g"], np.arange(10) + i)
+
+    # errors in the writer thread are raised in the caller's thread
+    writer = pimc.pimc.ResultWriter()
+    writer.submit(str(tmpdir.join("missing", "directory.npz")), {"s_g": array})
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+    return
+
+
+@pytest.mark.parametrize("P", [1, 2, 3, 8, 13])
+def test_pairwise_bead_product(P):
+    B, A = 4, 3
+    tensor = np.random.rand(B, P, A, A)
+    original = tensor.copy()
+
+    serial = np.broadcast_to(np.eye(A), (B, A, A)).copy()
+    for p in range(P):
+        serial = np.matmul(serial, tensor[:, p, ...])
+
+    assert np.allclose(pimc.pimc.pairwise_bead_product(tensor), serial)
+    assert np.array_equal(tensor, original), "the input should not be modified"
+
+    # the preallocated buffers should give the same product
+    buffers = tuple(np.empty((B, P - P // 2, A, A)) for _ in range(2))
+    assert np.allclose(pimc.pimc.pairwise_bead_product(tensor, buffers=buffers), serial)
+
+    # diagonal matrices
+    diagonal = np.random.rand(B, P, A)
+    tree = pimc.pimc.pairwise_bead_product(diagonal, multiply=np.multiply)
+    assert np.allclose(tree, diagonal.prod(axis=1))
+    return
+
+
+def test_tree_bead_product_block_compute(FS, block_data):
+    results = {}
+    for mode in ["serial", "tree"]:
+        block_data.bead_product = mode
+
+        block_data.preprocess()
+
+        results[mode] = pimc.BoxResult(data=block_data)
+        results[mode].path_root = FS.path_rho_results
+        pimc.block_compute(block_data, results[mode])
+
+    assert np.allclose(results["serial"].scaled_rho, results["tree"].scaled_rho)
+    assert np.allclose(results["serial"].scaled_g, results["tree"].scaled_g)
+    return
+
+
+def _symmetric_stacks(A):
+    """random, diagonal and (nearly) degenerate stacks of symmetric AxA matrices"""
+    random = np.random.normal(size=(6, 5, A, A))
+    random += random.swapaxes(-1, -2)
+    diagonal = np.zeros((2, 3, A, A))
+    diagonal[..., range(A), range(A)] = np.random.normal(size=(2, 3, A))
+    Q = np.linalg.qr(np.random.normal(size=(4, A, A)))[0]
+    spectrum = np.zeros((4, A))
+    spectrum[:, -1] = 1.  # all but one eigenvalue are degenerate
+    spectrum[1, 0] = 1e-9  # nearly degenerate
+    degenerate = np.einsum('xij, xj, xkj->xik', Q, spectrum, Q)
+    identity = np.broadcast_to(2.5 * np.eye(A), (3, A, A)).copy()
+    return [random, diagonal, degenerate, identity]
+
+
+@pytest.mark.parametrize("method, A", [("closed_form", 1), ("closed_form", 2), ("closed_form", 3),
+                                       ("jacobi", 2), ("jacobi", 4), ("jacobi", 6),
+                                       ("auto", 3), ("auto", 5)])
+def test_symmetric_eigh(method, A):
+    for matrices in _symmetric_stacks(A):
+        original = matrices.copy()
+        lapack_vals, lapack_vects = np.linalg.eigh(matrices, UPLO='L')
+        eigvals, eigvects = pimc.pimc.symmetric_eigh(matrices, method)
+
+        assert np.array_equal(matrices, original), "the input should not be modified"
+        assert eigvals.shape == lapack_vals.shape and eigvects.shape == lapack_vects.shape
+        assert np.allclose(eigvals, lapack_vals, rtol=1e-12, atol=1e-12)
+
+        # the eigenvectors are only unique up to sign (and rotations within degenerate subspaces)
+        # so compare the orthonormality, the reconstruction and the M matrices exp(-V) instead
+        identity = np.broadcast_to(np.eye(A), matrices.shape)
+        assert np.allclose(eigvects.swapaxes(-1, -2) @ eigvects, identity, atol=1e-12)
+        reconstructed = (eigvects * eigvals[..., NEW, :]) @ eigvects.swapaxes(-1, -2)
+        assert np.allclose(reconstructed, matrices, atol=1e-12)
+        M = (eigvects * np.exp(-eigvals)[..., NEW, :]) @ eigvects.swapaxes(-1, -2)
+        lapack_M = (lapack_vects * np.exp(-lapack_vals)[..., NEW, :]) @ lapack_vects.swapaxes(-1, -2)
+        assert np.allclose(M, lapack_M, rtol=1e-12, atol=1e-12)
+
+        # the results can be written to preallocated arrays
+        out = (np.empty_like(eigvals), np.empty_like(eigvects))
+        returned = pimc.pimc.symmetric_eigh(matrices, method, out=out)
+        assert all(r is o for r, o in zip(returned, out))
+        assert np.array_equal(out[0], eigvals) and np.array_equal(out[1], eigvects)
+    return
+
+
+def test_symmetric_eigh_invalid():
+    with pytest.raises(AssertionError):
+        pimc.pimc.symmetric_eigh(np.eye(4)[NEW], "closed_form")
+    with pytest.raises(AssertionError):
+        pimc.pimc.symmetric_eigh(np.eye(2)[NEW], "cholesky")
+    return
+
+
+def test_eigen_solver_block_compute(FS, block_data):
+    results = {}
+    for method in ["lapack", "closed_form", "jacobi"]:
+        block_data.eigen_solver = method
+
+        block_data.preprocess()
+
+        results[method] = pimc.BoxResult(data=block_data)
+        results[method].path_root = FS.path_rho_results
+        pimc.block_compute(block_data, results[method])
+
+    for method in ["closed_form", "jacobi"]:
+        assert np.array_equal(results["lapack"].scaled_rho, results[method].scaled_rho)
+        assert np.allclose(results["lapack"].scaled_g, results[method].scaled_g, rtol=1e-12)
+    return
+
+
+def _structured_quadratic_terms(N, A):
+    """random quadratic terms (NNAA) which are dense, diagonal in the modes, sparse, low rank or zero"""
+    dense = np.random.normal(size=(N, N, A, A))
+    dense += dense.transpose(0, 1, 3, 2)
+    diagonal = np.zeros((N, N, A, A))
+    diagonal[range(N), range(N)] = dense[range(N), range(N)]
+    sparse = np.zeros((N, N, A, A))
+    sparse[1, 3] = dense[1, 3]  # not symmetric in the modes
+    sparse[2, 2] = dense[2, 2]
+    vectors = np.random.normal(size=(2, N, A, A))
+    vectors += vectors.transpose(0, 1, 3, 2)
+    low_rank = np.einsum('rjab, rkab->jkab', vectors, vectors)  # rank 2 for each pair of surfaces
+    zero = np.zeros((N, N, A, A))
+    return {"dense": dense, "diagonal": diagonal, "sparse": sparse, "low_rank": low_rank, "zero": zero}
+
+
+def _coupling_data(B, P, N, A, kernel="auto"):
+    """a minimal data object for build_coupling_matrix() with random energies and linear terms"""
+    data = pimc.BoxData()
+    data.block_size, data.beads, data.modes, data.states = B, P, N, A
+    data.size = {key: tuple(dict(B=B, P=P, N=N, A=A)[letter] for letter in key)
+                 for key in ['A', 'N', 'AA', 'AN', 'NAA', 'NNAA', 'BNP', 'BPA', 'BPAA', 'BAA']}
+    data.quadratic_kernel = kernel
+
+    data.vib = pimc.ModelVibronic(data)
+    data.vib.energy = np.random.normal(size=(A, A))
+    data.vib.energy += data.vib.energy.T
+    data.vib.linear = np.random.normal(size=(N, A, A))
+    data.vib.linear[[0, 4, 5]] = 0.  # only some modes are linearly coupled
+    data.vib.linear += data.vib.linear.transpose(0, 2, 1)
+    data.qTensor = np.random.normal(size=(B, N, P))
+    data.coupling_matrix = np.empty((B, P, A, A))
+    return data
+
+
+def _reference_coupling_matrix(data):
+    """the coupling matrix from dense einsums over every term of the model"""
+    q, vib = data.qTensor, data.vib
+    V = np.einsum('bjp, jkxy, bkp->bpxy', q, 0.5*vib.quadratic, q)
+    V += np.einsum('jxy, bjp->bpxy', vib.linear, q)
+    V += vib.energy
+    if vib.cubic is not None:
+        V += np.einsum('bip, bjp, bkp, ijkxy->bpxy', q, q, q, vib.cubic)
+    if vib.quartic is not None:
+        V += np.einsum('bip, bjp, bkp, blp, ijklxy->bpxy', q, q, q, q, vib.quartic)
+    return V
+
+
+@pytest.mark.parametrize("kernel", ["dense", "diagonal", "sparse", "low_rank", "auto"])
+@pytest.mark.parametrize("structure", ["dense", "diagonal", "sparse", "low_rank", "zero"])
+def test_build_coupling_matrix(kernel, structure):
+    B, P, N, A = 4, 5, 12, 3
+    data = _coupling_data(B, P, N, A, kernel)
+    data.vib.quadratic = _structured_quadratic_terms(N, A)[structure]
+
+    # only the diagonal kernel needs the quadratic terms to have a particular structure
+    if kernel == "diagonal" and structure not in ["diagonal", "zero"]:
+        with pytest.raises(AssertionError):
+            data.vib.analyse_coupling_structure(data)
+        return
+
+    data.vib.analyse_coupling_structure(data)
+    if kernel == "auto":
+        # the dense einsum is only a reference, a full set of pairs or eigenpairs is always cheaper
+        expected = {"dense": ["sparse", "low_rank"], "diagonal": ["diagonal"], "sparse": ["sparse"],
+                    "low_rank": ["low_rank"], "zero": ["sparse", "low_rank"]}
+        assert data.vib.quadratic_kernel in expected[structure]
+    assert np.array_equal(data.vib.linear_modes, [m for m in range(N) if m not in [0, 4, 5]])
+
+    data.workspace = pimc.pimc.BoxWorkspace(data)
+    # only some of the modes have linear terms so their co-ordinates are gathered into the workspace
+    assert data.workspace.linear_coordinates.shape == (N - 3, B*P)
+    pimc.pimc.build_coupling_matrix(data)
+    assert np.allclose(data.coupling_matrix, _reference_coupling_matrix(data), rtol=1e-12, atol=1e-12)
+    return
+
+
+def test_asymmetric_coupling_terms():
+    """the symmetry of the coupling matrix is checked once, on the model's terms, rather than every block"""
+    B, P, N, A = 2, 3, 6, 3
+    data = _coupling_data(B, P, N, A)
+    data.vib.quadratic = _structured_quadratic_terms(N, A)["dense"]
+    data.vib.analyse_coupling_structure(data)
+
+    data.vib.linear[1, 0, 2] += 1.
+    with pytest.raises(AssertionError, match="symmetric in the surfaces"):
+        data.vib.analyse_coupling_structure(data)
+    return
+
+
+def test_collect_monomials():
+    N, A = 5, 2
+    cubic = np.zeros((N, N, N, A, A))
+    cubic[0, 1, 1] = [[1., 2.], [2., 3.]]
+    cubic[1, 0, 1] = [[5., 0.], [0., 1.]]  # the same monomial q_0 q_1 q_1
+    cubic[4, 2, 3] = [[1., 0.], [0., 0.]]
+    cubic[2, 2, 2] = [[1., 1.], [1., -1.]]
+    cubic[3, 3, 4] = [[1., 0.], [0., 1.]]
+    cubic[4, 3, 3] = [[-1., 0.], [0., -1.]]  # cancels the previous term so the monomial is dropped
+
+    modes, terms = pimc.pimc.collect_monomials(cubic)
+    assert np.array_equal(np.stack(modes, axis=1), [[0, 1, 1], [2, 2, 2], [2, 3, 4]])
+    assert np.allclose(terms[0], [6., 2., 2., 4.])
+    assert np.allclose(terms[1], [1., 1., 1., -1.])
+    assert np.allclose(terms[2], [1., 0., 0., 0.])
+
+    modes, terms = pimc.pimc.collect_monomials(np.zeros((N, N, N, N, A, A)))
+    assert len(terms) == 0 and len(modes) == 4
+    return
+
+
+@pytest.mark.parametrize("kernel", ["dense", "sparse", "low_rank"])
+def test_anharmonic_coupling_matrix(kernel):
+    B, P, N, A = 4, 5, 7, 3
+    data = _coupling_data(B, P, N, A, kernel)
+    data.vib.quadratic = _structured_quadratic_terms(N, A)["low_rank"]
+
+    # a few sparse cubic and quartic terms, symmetric in the surfaces
+    data.vib.cubic = np.zeros((N, N, N, A, A))
+    data.vib.quartic = np.zeros((N, N, N, N, A, A))
+    for tensor, count in [(data.vib.cubic, 10), (data.vib.quartic, 15)]:
+        for _ in range(count):
+            terms = np.random.normal(size=(A, A))
+            tensor[tuple(np.random.randint(N, size=tensor.ndim - 2))] += terms + terms.T
+
+    data.vib.analyse_coupling_structure(data)
+    assert len(data.vib.anharmonic_terms) == 2
+    assert len(data.vib.anharmonic_terms[0][1]) <= 10 and len(data.vib.anharmonic_terms[1][1]) <= 15
+
+    data.workspace = pimc.pimc.BoxWorkspace(data)
+    pimc.pimc.build_coupling_matrix(data)
+    assert np.allclose(data.coupling_matrix, _reference_coupling_matrix(data), rtol=1e-12, atol=1e-12)
+    assert np.allclose(data.coupling_matrix, data.coupling_matrix.swapaxes(-1, -2))
+    return
+
+
+def test_op_file_quadratic_couplings(path):
+    # the .op file has C2_s01s01_v01v01 = -0.009123, C2_s02s02_v01v01 = 0.009442 and C2_s01s03_v01v01 = 0.005576
+    model = vIO.read_model_op_file(join(path, "fake_vibron.op"))
+    quadratic = model[VMK.G2]
+    assert np.isclose(quadratic[0, 0, 0, 0], -0.009123)
+    assert np.isclose(quadratic[0, 0, 1, 1], 0.009442)
+    assert np.isclose(quadratic[0, 0, 0, 2], 0.005576)
+    assert np.isclose(quadratic[0, 0, 2, 0], 0.005576)
+    return
+
+
+def test_op_file_cubic_coupling_matrix(tmpdir, path):
+    # the .op file has C3_s01_s02_v05 = -0.001084 and C3_s02_s02_v01 = -0.005460 as the coefficients of q^3
+    model = vIO.read_model_op_file(join(path, "fake_vibron.op"))
+    path_json = str(tmpdir.join("fake_vibron.json"))
+    vIO.save_model_to_JSON(path_json, model)
+
+    B, P, N, A = 2, 1, model[VMK.N], model[VMK.A]
+    data = _coupling_data(B, P, N, A)
+    data.vib.load_model(path_json)
+    assert data.vib.cubic is not None and data.vib.quartic is not None
+
+    # only keep the cubic terms
+    data.vib.energy[:] = data.vib.linear[:] = data.vib.quadratic[:] = 0.
+    data.vib.quartic = None
+    data.vib.analyse_coupling_structure(data)
+    data.workspace = pimc.pimc.BoxWorkspace(data)
+
+    # the first sample is only displaced along mode 5 and the second only along mode 1
+    data.qTensor = np.zeros((B, N, P))
+    data.qTensor[0, 4] = data.qTensor[1, 0] = 2.0
+    pimc.pimc.build_coupling_matrix(data)
+    assert np.isclose(data.coupling_matrix[0, 0, 0, 1], -0.001084 * 2.0**3)
+    assert np.isclose(data.coupling_matrix[0, 0, 1, 0], -0.001084 * 2.0**3)
+    assert np.isclose(data.coupling_matrix[1, 0, 1, 1], -0.005460 * 2.0**3)
+    return
+
+
+def test_anharmonic_block_compute(tmpdir, FS, block_data):
+    # the same vibronic model with zero, and then small quartic, terms added to its json file
+    model = vIO.load_model_from_JSON(FS.path_vib_model)
+    quartic = np.zeros((2, 2, 2, 2, 2, 2))
+    results = {}
+    for name, scale in [("harmonic", None), ("zero", 0.), ("quartic", 1e-3)]:
+        path = str(tmpdir.join(f"{name}.json"))
+        if scale is not None:
+            quartic[0, 0, 0, 0] = quartic[1, 1, 1, 1] = scale * np.eye(2)
+            model[VMK.G4] = quartic
+        vIO.save_model_to_JSON(path, model)
+        block_data.path_vib_model = path
+        block_data.hash_vib = name
+        block_data.preprocess()
+
+        results[name] = pimc.BoxResult(data=block_data)
+        results[name].path_root = str(tmpdir)
+        pimc.block_compute(block_data, results[name])
+
+    assert block_data.vib.quartic is not None and len(block_data.vib.anharmonic_terms) == 1
+    assert np.array_equal(results["harmonic"].scaled_g, results["zero"].scaled_g)
+    assert np.array_equal(results["harmonic"].scaled_rho, results["quartic"].scaled_rho)
+    # a confining quartic term lowers every g(R)
+    assert np.all(results["quartic"].scaled_g < results["harmonic"].scaled_g)
+    return
+
+
+def test_gershgorin_bounds():
+    matrices = np.random.normal(size=(5, 4, 6, 6))
+    matrices += matrices.swapaxes(-1, -2)
+    lower, upper = pimc.pimc.gershgorin_bounds(matrices)
+    eigvals = np.linalg.eigvalsh(matrices)
+    assert np.all(lower <= eigvals[..., 0]) and np.all(eigvals[..., -1] <= upper)
+    return
+
+
+@pytest.mark.parametrize("A", [1, 2, 5, 12])
+@pytest.mark.parametrize("tau", [1e-3, 0.3, 4.0, 40.0])
+def test_expm_pade(A, tau):
+    # the spread of tau values covers every Pade degree and the squaring
+    V = np.random.normal(size=(3, 4, A, A))
+    V += V.swapaxes(-1, -2)
+    V += np.linspace(0., 1., A)[:, NEW] * np.eye(A)
+    original = V.copy()
+    eigvals, eigvects = np.linalg.eigh(V)
+
+    M = pimc.pimc.expm_pade(V, tau)
+    expected = (eigvects * np.exp(-tau * eigvals)[..., NEW, :]) @ eigvects.swapaxes(-1, -2)
+    assert np.array_equal(V, original), "the input should not be modified"
+    assert np.allclose(M, expected, rtol=1e-10, atol=1e-12 * np.abs(expected).max())
+
+    # relative to the lowest eigenvalue
+    lowest = eigvals[..., 0]
+    M = pimc.pimc.expm_pade(V, tau, lowest)
+    expected = (eigvects * np.exp(-tau * (eigvals - lowest[..., NEW]))[..., NEW, :]) @ eigvects.swapaxes(-1, -2)
+    assert np.allclose(M, expected, rtol=1e-10, atol=1e-12)
+
+    # a reused workspace gives the same results
+    workspace, out = pimc.pimc.PadeWorkspace(V.shape, V.dtype), np.empty_like(V)
+    for _ in range(2):
+        pimc.pimc.expm_pade(V, tau, lowest, out=out, workspace=workspace)
+        assert np.array_equal(out, M)
+    return
+
+
+def test_gauss_jordan_solve():
+    A = 5
+    Q = np.random.normal(size=(3, 4, A, A))
+    Q = Q @ Q.swapaxes(-1, -2) + np.eye(A)
+    R = np.random.normal(size=(3, 4, A, A))
+    expected = np.linalg.solve(Q, R)
+
+    pimc.pimc.gauss_jordan_solve(Q, R, np.empty_like(Q), np.empty(Q.shape[:-1]), np.empty(Q.shape[:-2]))
+    assert np.allclose(R, expected)
+    return
+
+
+@pytest.mark.parametrize("attributes", [{}, {"derivatives": True}, {"log_scale": True}])
+def test_pade_exponential_block_compute(FS, block_data, attributes):
+    results = {}
+    for method in ["eigh", "pade"]:
+        block_data.matrix_exponential = method
+        for key, value in attributes.items():
+            setattr(block_data, key, value)
+
+        block_data.preprocess()
+        assert block_data.use_pade_exponential() is (method == "pade")
+
+        results[method] = pimc.BoxResult(data=block_data)
+        results[method].path_root = FS.path_rho_results
+        pimc.block_compute(block_data, results[method])
+
+    eigh, pade = results["eigh"], results["pade"]
+    assert np.array_equal(eigh.scaled_rho, pade.scaled_rho)
+    if "log_scale" in attributes:
+        # the M matrices are scaled by different lower bounds so only the scaled products agree
+        assert np.allclose(eigh.scaled_g * np.exp(eigh.log_scale_g - pade.log_scale_g), pade.scaled_g, rtol=1e-10)
+    else:
+        assert np.allclose(eigh.scaled_g, pade.scaled_g, rtol=1e-10)
+    if "derivatives" in attributes:
+        assert np.allclose(eigh.scaled_dg, pade.scaled_dg, rtol=1e-10)
+        assert np.allclose(eigh.scaled_d2g, pade.scaled_d2g, rtol=1e-10)
+    return
+
+
+@pytest.mark.parametrize("attributes", [{}, {"bead_product": "tree"}, {"matrix_exponential": "pade"},
+                                        {"derivatives": True}, {"log_scale": True}])
+def test_single_precision_block_compute(FS, block_data, attributes):
+    block_data.beads = 16
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        block_data.dtype = dtype
+        for key, value in attributes.items():
+            setattr(block_data, key, value)
+
+        block_data.preprocess()
+        assert block_data.qTensor.dtype == dtype and block_data.M_matrix.dtype == dtype
+        assert block_data.vib.const.omatrix.dtype == dtype and block_data.rho.const.omatrix.dtype == dtype
+
+        results[dtype] = pimc.BoxResult(data=block_data)
+        results[dtype].path_root = FS.path_rho_results
+        pimc.block_compute(block_data, results[dtype])
+
+    # the products and traces are accumulated in double precision so only the per bead rounding remains
+    double, single = results[np.float64], results[np.float32]
+    assert single.scaled_g.dtype == F64 and single.scaled_rho.dtype == F64
+    assert np.allclose(double.scaled_rho, single.scaled_rho, rtol=1e-5)
+    assert np.allclose(double.scaled_g, single.scaled_g, rtol=1e-5)
+    if "log_scale" in attributes:
+        assert np.allclose(double.log_scale_g, single.log_scale_g, rtol=1e-5)
+    if "derivatives" in attributes:
+        assert np.allclose(double.scaled_dg, single.scaled_dg, rtol=1e-3)
+        assert np.allclose(double.scaled_d2g, single.scaled_d2g, rtol=1e-3)
+    return
+
+
+def test_single_precision_invalid_dtype(data):
+    data.dtype = np.float16
+    with pytest.raises(AssertionError, match="invalid dtype"):
+        data.preprocess()
+    return
+
+
+def test_scale_log_o_matrices():
+    """O matrices far outside the range of float32 can be scaled as long as their ratios are within it"""
+    class Const:
+        pass
+
+    models = [Const(), Const()]
+    for model, shift in zip(models, [-200., -195.]):
+        model.omatrix = (shift + np.random.normal(size=(4, 5, 3))).astype(np.float32)
+        model.omatrix_scaling = np.empty((4, 5), dtype=np.float32)
+    expected = [np.exp(model.omatrix.astype(F64)) for model in models]
+
+    S12 = np.empty((4, 5), dtype=np.float32)
+    pimc.pimc.build_log_scaling_factors(S12, *models)
+    pimc.pimc.scale_log_o_matrices(S12, *models)
+    for model, O in zip(models, expected):
+        assert np.all(np.isfinite(model.omatrix))
+        assert np.allclose(model.omatrix, O / np.exp(S12.astype(F64))[..., NEW], rtol=1e-5, atol=0.)
+    return
+
+
+def test_single_precision_large_tau(path):
+    """at T = 10K with 3 beads the M matrix exponents are far beyond +/-88
+    float32 can't represent them without log_scale, which is rejected before any block is computed"""
+    FS = fs.FileStructure(path, 1, id_rho=1)
+    FS.generate_model_hashes()
+
+    def compute(dtype, log_scale):
+        data = pimc.BoxData()
+        data.id_data, data.id_rho = 1, 1
+        data.path_vib_model = FS.path_vib_model
+        data.path_rho_model = FS.path_rho_model
+        data.hash_vib = FS.hash_vib
+        data.hash_rho = FS.hash_rho
+        data.states = 2
+        data.modes = 2
+        data.samples = 20
+        data.beads = 3
+        data.temperature = 10.0
+        data.block_size = 10
+        data.blocks = 2
+        data.seed = 242351
+        data.dtype = dtype
+        data.log_scale = log_scale
+        data.preprocess()
+        result = pimc.BoxResult(data=data)
+        result.path_root = FS.path_rho_results
+        pimc.block_compute(data, result)
+        return result
+
+    double = compute(F64, False)
+    assert np.all(np.isfinite(double.scaled_g)) and np.all(np.isfinite(double.scaled_rho))
+
+    with pytest.raises(AssertionError, match="enable log_scale"):
+        compute(np.float32, False)
+
+    double = compute(F64, True)
+    single = compute(np.float32, True)
+    assert np.allclose(double.scaled_rho, single.scaled_rho, rtol=1e-5)
+    assert np.allclose(double.scaled_g, single.scaled_g, rtol=1e-5)
+    assert np.allclose(double.log_scale_g, single.log_scale_g, rtol=1e-5)
+    return
+
+
+@pytest.mark.parametrize("tree", [False, True])
+def test_log_scaled_bead_product(tree):
+    B, P, A = 3, 500, 3
+    c = 1e-3
+    tensor = np.random.rand(B, P, A, A)
+
+    # the plain product of c * tensor underflows but the product of tensor does not
+    reference = np.broadcast_to(np.eye(A), (B, A, A)).copy()
+    for p in range(P):
+        reference = np.matmul(reference, tensor[:, p, ...])
+    log_reference = np.log(np.trace(reference, axis1=1, axis2=2)) + P * np.log(c)
+
+    mantissa, log_scale = pimc.pimc.log_scaled_bead_product(c * tensor, tree=tree)
+    assert np.all(np.isfinite(mantissa)) and np.all(np.isfinite(log_scale))
+    assert np.allclose(np.log(np.trace(mantissa, axis1=1, axis2=2)) + log_scale, log_reference)
+
+    # the same product reduced in preallocated buffers
+    half = P - P // 2
+    pair_buffers = tuple(np.empty((B, half, A, A)) for _ in range(2))
+    numerators = tuple(np.empty((B, A, A)) for _ in range(2))
+    buffered, buffered_scale = pimc.pimc.log_scaled_bead_product(c * tensor, tree, pair_buffers, numerators)
+    assert any(np.shares_memory(buffered, buffer) for buffer in pair_buffers + numerators)
+    assert np.array_equal(buffered, mantissa) and np.array_equal(buffered_scale, log_scale)
+    return
+
+
+def test_log_scale_block_compute_pm(FS_pm, block_dataPM):
+    from pibronic.stats import stats
+
+    results = {}
+    for log_scale in [False, True]:
+        block_dataPM.log_scale = log_scale
+
+        block_dataPM.preprocess()
+
+        result = pimc.BoxResultPM(data=block_dataPM)
+        result.path_root = FS_pm.path_rho_results
+        result.id_job = int(log_scale)
+        pimc.block_compute_pm(block_dataPM, result)
+
+        # the log scaling factors must survive a round trip through the result file
+        loaded = pimc.BoxResultPM()
+        loaded.load_multiple_results([result.compute_path_to_file()])
+        assert loaded.log_scale is log_scale
+        results[log_scale] = stats.extract_scaled_data(loaded)
+
+    plain, scaled = results[False], results[True]
+    for index in range(1, 4):
+        assert np.allclose(plain[index] / plain[0], scaled[index] / scaled[0])
+    return
+
+
+def test_control_variate_block_compute_pm(FS_pm, block_dataPM):
+    from pibronic.stats import stats
+
+    block_dataPM.control_variates = True
+
+    block_dataPM.preprocess()
+
+    result = pimc.BoxResultPM(data=block_dataPM)
+    result.path_root = FS_pm.path_rho_results
+    result.id_job = 2
+    pimc.block_compute_pm(block_dataPM, result)
+
+    # the control variates and their expected values must survive a round trip through the result file
+    loaded = pimc.BoxResultPM()
+    loaded.load_multiple_results([result.compute_path_to_file()])
+    assert loaded.control_variates
+    assert np.array_equal(loaded.control_means, result.control_means)
+    rho, h, h_plus, h_minus = stats.extract_control_variate_data(loaded)
+    assert np.array_equal(h_minus, result.scaled_h_minus)
+
+    # rho_0 is the harmonic part of the coupled model, so h is rho and E[h/rho] = 1
+    if block_dataPM.id_rho == 0:
+        assert np.allclose(h, rho)
+        assert np.isclose(result.control_means[0], 1.0)
+
+    # data_set_0 has no off-diagonal couplings, so h is g and the control variate removes all of the error
+    if block_dataPM.id_data == 0:
+        assert np.allclose(h, result.scaled_g)
+        assert np.allclose(h_plus, result.scaled_gofr_plus)
+
+    X, terms, coefficients = stats.calculate_control_variate_terms(loaded, block_dataPM.delta_beta)
+    assert X == block_dataPM.samples and len(coefficients) == 3
+
+    # control variates need the O matrices without any log scaling
+    block_dataPM.log_scale = True
+    with pytest.raises(AssertionError, match="log_scale"):
+        block_dataPM.preprocess()
+    return
+
+
+def test_derivative_block_compute(FS, block_data):
+    block_data.beads = 8
+    block_data.derivatives = True
+
+    block_data.preprocess()
+
+    result = pimc.BoxResult(data=block_data)
+    result.path_root = FS.path_rho_results
+    pimc.block_compute(block_data, result)
+
+    # the derivatives must survive a round trip through the result file
+    loaded = pimc.BoxResult()
+    loaded.load_multiple_results([result.compute_path_to_file()])
+    assert loaded.derivatives
+    assert np.array_equal(loaded.scaled_dg, result.scaled_dg)
+    assert np.array_equal(loaded.scaled_d2g, result.scaled_d2g)
+
+    # compare against central differences of g for the last block, where both O and M change with tau
+    from pibronic.pimc.pimc import (TemperatureDependentClass, build_o_matrix, build_o_matrix_derivatives,
+                                    diagonalize_coupling_matrix, build_numerator, build_derivative_numerator)
+    vib, tau, B = block_data.vib, block_data.tau, block_data.block_size
+    # the diagonal energies were folded into the prefactor of vib.const and then zeroed in the model
+    energy = TemperatureDependentClass(vib, tau).log_omatrix_prefactor - vib.const.log_omatrix_prefactor
+    energy /= tau
+
+    def g(tau_prime):
+        const = TemperatureDependentClass(vib, tau_prime)
+        const.omatrix_prefactor *= np.exp(-tau_prime * energy)
+        build_o_matrix(block_data, const, vib.state_shift)
+        block_data.tau = tau_prime
+        output = np.empty(B)
+        build_numerator(block_data, const, output, slice(None))
+        block_data.tau = tau
+        return output
+
+    block_data.regenerate_block(block_data.blocks - 1)
+    diagonalize_coupling_matrix(block_data)
+    h = 1e-4 * tau
+    g_plus, g_zero, g_minus = g(tau + h), g(tau), g(tau - h)
+    first = (g_plus - g_minus) / (2. * h * block_data.beads)
+    second = (g_plus - 2. * g_zero + g_minus) / (h * block_data.beads)**2.
+
+    analytic = [np.empty(B) for _ in range(3)]
+    build_o_matrix(block_data, vib.const, vib.state_shift)
+    build_o_matrix_derivatives(block_data, vib.const, vib.state_shift)
+    build_derivative_numerator(block_data, vib.const, analytic, slice(None))
+    assert np.allclose(analytic[0], g_zero)
+    assert np.allclose(analytic[1], first, rtol=1e-5)
+    assert np.allclose(analytic[2], second, rtol=1e-4)
+    return
+
+
+def test_reweighted_block_compute(FS, block_data):
+    block_data.beads = 8
+    block_data.derivatives = True
+
+    # reweight to the reference temperature and to a lower one
+    block_data.reweight_temperatures = [block_data.temperature, 290.0]
+
+    block_data.preprocess()
+
+    result = pimc.BoxResult(data=block_data)
+    result.path_root = FS.path_rho_results
+    pimc.block_compute(block_data, result)
+
+    g_reweight = result.scaled_g_reweight
+    assert g_reweight.shape == (block_data.samples, 2, 3)
+    assert np.allclose(g_reweight[:, 0, 0], result.scaled_g)
+    # g+ and g- change with beta as the analytic derivatives say they should
+    h = pibronic.constants.delta_beta
+    assert np.allclose((g_reweight[:, 0, 1] - g_reweight[:, 0, 2]) / (2. * h), result.scaled_dg, rtol=1e-4)
+    # the second difference loses digits to cancellation so it is compared relative to g
+    second = (g_reweight[:, 0, 1] - 2. * g_reweight[:, 0, 0] + g_reweight[:, 0, 2]) / h**2
+    assert np.allclose(second / result.scaled_g, result.scaled_d2g / result.scaled_g, atol=1e-4)
+
+    # the reweighted g must survive a round trip through the result file
+    loaded = pimc.BoxResult()
+    loaded.load_multiple_results([result.compute_path_to_file()])
+    assert np.array_equal(loaded.reweight_temperatures, block_data.reweight_temperatures)
+    assert np.array_equal(loaded.scaled_g_reweight, g_reweight)
+    return
+
+
+def test_extra_rho_block_compute(path, FS, block_data):
+    # evaluate the sampling model itself and the other sampling model of the data set
+    block_data.extra_rho_ids = [block_data.id_rho, 1 - block_data.id_rho]
+    block_data.path_extra_rho_models = [fs.FileStructure(path, block_data.id_data, id_rho).path_rho_model
+                                        for id_rho in block_data.extra_rho_ids]
+
+    block_data.preprocess()
+
+    result = pimc.BoxResult(data=block_data)
+    result.path_root = FS.path_rho_results
+    pimc.block_compute(block_data, result)
+
+    # the extra denominators share the scaling of rho
+    assert np.allclose(result.scaled_rho_extra[:, 0], result.scaled_rho)
+    assert not np.any(np.isnan(result.scaled_rho_extra))
+
+    # the extra denominators must survive a round trip through the result file
+    loaded = pimc.BoxResult()
+    loaded.load_multiple_results([result.compute_path_to_file()])
+    assert np.array_equal(loaded.extra_rho_ids, block_data.extra_rho_ids)
+    assert np.array_equal(loaded.scaled_rho_extra, result.scaled_rho_extra)
+    return
+
+
+def test_coupling_eigendecomposition_round_trip(tmpdir, FS, block_data):
+    from pibronic.pimc.pimc import (diagonalize_coupling_matrix, build_M_matrix, build_M_matrices,
+                                    save_coupling_eigendecomposition, load_coupling_eigendecomposition)
+
+    block_data.preprocess()
+
+    block_data.regenerate_block(1)
+    R = block_data.qTensor.copy()
+    diagonalize_coupling_matrix(block_data)
+    path = str(tmpdir.join("eigendecomposition.npz"))
+    save_coupling_eigendecomposition(block_data, path, 1)
+
+    # a different block replaces the co-ordinates, loading brings them back
+    block_data.regenerate_block(0)
+    eigvals, eigvects = load_coupling_eigendecomposition(block_data, path)
+    assert np.array_equal(block_data.qTensor, R)
+
+    # the M matrices for any tau match those built from a fresh diagonalization
+    taus = block_data.tau * np.array([0.9, 1.0, 1.1])
+    M_stack = build_M_matrices(eigvals, eigvects, taus)
+    diagonalize_coupling_matrix(block_data)
+    for k, tau in enumerate(taus):
+        build_M_matrix(block_data, tau)
+        assert np.allclose(M_stack[k], block_data.M_matrix)
+
+    # every eigenpair is kept by a full rank truncation
+    save_coupling_eigendecomposition(block_data, path, 1, rank=block_data.states)
+    assert np.allclose(build_M_matrices(*load_coupling_eigendecomposition(block_data, path), taus), M_stack)
+
+    # the eigendecomposition can still be saved when M is built with expm_pade(), even when "auto" picks it
+    block_data.matrix_exponential = "auto"
+    block_data.matrix_exponential_crossover = block_data.states
+    block_data.preprocess()
+    assert block_data.use_pade_exponential()
+    block_data.regenerate_block(1)
+    diagonalize_coupling_matrix(block_data)
+    save_coupling_eigendecomposition(block_data, path, 1)
+    assert np.allclose(build_M_matrices(*load_coupling_eigendecomposition(block_data, path), taus), M_stack)
+
+    # samples drawn from another seed can't be reused
+    block_data.seed = 1
+    with pytest.raises(AssertionError):
+        load_coupling_eigendecomposition(block_data, path)
+    return
+
+
+@pytest.mark.parametrize("P", [3, 4, 7, 12, 33])
+def test_real_fourier_transform(P):
+    import scipy.linalg
+
+    circulant = scipy.linalg.circulant([0, 1] + [0]*(P-3) + [1])
+    basis = pimc.pimc.real_fourier_basis(P)
+    eigvals = pimc.pimc.circulant_eigenvalues(P)
+
+    # the modes are orthonormal eigenvectors of the circulant matrix
+    assert np.allclose(basis.T.dot(basis), np.eye(P))
+    assert np.allclose(basis.T.dot(circulant).dot(basis), np.diag(eigvals))
+
+    # the fft agrees with multiplying by the basis
+    coefficients = np.random.rand(5, 4, P)
+    dense = np.einsum('ab,ijb->ija', basis, coefficients)
+    assert np.allclose(pimc.pimc.real_fourier_transform(coefficients), dense)
+
+    # each eigenspace is the same as the one spanned by the eigenvectors from eigh
+    # (the basis inside a degenerate eigenspace is only defined up to a rotation)
+    reference_eigvals, reference_eigvects = np.linalg.eigh(circulant, UPLO='L')
+    for value in np.unique(np.round(eigvals, 10)):
+        ours = basis[:, np.isclose(eigvals, value)]
+        theirs = reference_eigvects[:, np.isclose(reference_eigvals, value)]
+        assert ours.shape == theirs.shape
+        assert np.allclose(ours.dot(ours.T), theirs.dot(theirs.T))
+    return
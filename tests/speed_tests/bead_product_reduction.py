@@ -0,0 +1,49 @@
+# this file is to demonstrate timing for multiplying the bead matrices together
+# it compares the serial (left to right) product with the pairwise (tree) reduction
+# and shows where the crossover used by BoxData.bead_product = "auto" should be
+
+from .context import pibronic
+import timeit
+
+setupstr = '''
+import numpy as np
+from pibronic.pimc.pimc import pairwise_bead_product
+
+block_size = {B:d}
+number_of_beads = {P:d}
+number_of_electronic_surfaces = {A:d}
+
+M_matrix = np.random.random_sample((block_size, number_of_beads, number_of_electronic_surfaces, number_of_electronic_surfaces))
+M_matrix /= number_of_electronic_surfaces
+numerator = np.empty((block_size, number_of_electronic_surfaces, number_of_electronic_surfaces))
+'''
+
+serial = '''
+numerator[:] = M_matrix[:, 0, ...]
+for bead_index in range(1, number_of_beads):
+    np.matmul(numerator, M_matrix[:, bead_index, ...], out=numerator)'''
+
+tree = '''
+numerator[:] = pairwise_bead_product(M_matrix)'''
+
+
+def serial_vs_tree(R, N):
+    pstr = "A={:>3d} P={:>5d} B={:>6d}   serial {:.5f}   tree {:.5f}   speedup {:.2f}"
+    total_size = int(2e5)  # keep the size of M_matrix roughly fixed
+    for A in [2, 4, 8, 16]:
+        for P in [4, 8, 16, 32, 64, 128, 256, 512, 1000]:
+            B = max(1, total_size // (P * A * A))
+            setup = setupstr.format(B=B, P=P, A=A)
+            t_serial = min(timeit.repeat(stmt=serial, setup=setup, repeat=R, number=N))
+            t_tree = min(timeit.repeat(stmt=tree, setup=setup, repeat=R, number=N))
+            print(pstr.format(A, P, B, t_serial, t_tree, t_serial / t_tree))
+
+
+def main():
+    R = 3
+    N = 5
+    serial_vs_tree(R, N)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# this file is to demonstrate timing for building the M matrices exp(-tau V)
+# it compares diagonalizing V and rebuilding U exp(-tau D) U^T with the scaling and squaring Pade approximant
+# and shows where the crossover used by BoxData.matrix_exponential = "auto" should be
+
+from .context import pibronic
+import timeit
+
+setupstr = '''
+import numpy as np
+from numpy import newaxis as NEW
+from pibronic.pimc.pimc import symmetric_eigh, expm_pade, PadeWorkspace
+
+block_size = {B:d}
+number_of_beads = {P:d}
+number_of_electronic_surfaces = {A:d}
+tau = {tau:f}
+
+coupling_matrix = np.random.normal(scale=0.5, size=(block_size, number_of_beads, number_of_electronic_surfaces, number_of_electronic_surfaces))
+coupling_matrix += coupling_matrix.swapaxes(-1, -2)
+M_matrix = np.empty((block_size, number_of_beads, number_of_electronic_surfaces, number_of_electronic_surfaces))
+workspace = PadeWorkspace(M_matrix.shape, M_matrix.dtype)
+'''
+
+eigh = '''
+eigval, eigvect = symmetric_eigh(coupling_matrix)
+np.matmul(eigvect * np.exp(-tau * eigval)[..., NEW, :], eigvect.swapaxes(-1, -2), out=M_matrix)'''
+
+pade = '''
+expm_pade(coupling_matrix, tau, out=M_matrix, workspace=workspace)'''
+
+
+def eigh_vs_pade(R, N):
+    pstr = "A={:>3d} P={:>5d} B={:>6d} tau={:>5.2f}   eigh {:.5f}   pade {:.5f}   speedup {:.2f}"
+    total_size = int(2e5)  # keep the size of M_matrix roughly fixed
+    P = 16
+    for tau in [0.1, 2.0]:
+        for A in [2, 3, 4, 6, 8, 12, 16, 24, 32, 48]:
+            B = max(1, total_size // (P * A * A))
+            setup = setupstr.format(B=B, P=P, A=A, tau=tau)
+            t_eigh = min(timeit.repeat(stmt=eigh, setup=setup, repeat=R, number=N))
+            t_pade = min(timeit.repeat(stmt=pade, setup=setup, repeat=R, number=N))
+            print(pstr.format(A, P, B, tau, t_eigh, t_pade, t_eigh / t_pade))
+
+
+def main():
+    R = 3
+    N = 5
+    eigh_vs_pade(R, N)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# this file is to demonstrate how block_compute_pm_parallel() scales with the number of processes
+# the same samples are computed with 1, 2, 4, ... processes up to the number of available cores
+# and the throughput (samples per second) is reported along with the speedup and parallel efficiency
+# relative to the serial block_compute_pm()
+
+from .context import pibronic
+import inspect
+import tempfile
+import time
+from os.path import dirname, join
+
+from pibronic import pimc
+import pibronic.data.file_structure as fs
+
+
+def run(FS, path_root, beads, samples, block_size, number_of_processes=None):
+    """returns the time it took to compute the samples of the system FS
+    with block_compute_pm_parallel() or with block_compute_pm() if number_of_processes is None"""
+    data = pimc.BoxDataPM.from_FileStructure(FS)
+    data.hash_vib = FS.hash_vib
+    data.hash_rho = FS.hash_rho
+    data.samples = samples
+    data.block_size = block_size
+    data.blocks = samples // block_size
+    data.beads = beads
+    data.temperature = 300.0
+    data.seed = 242351
+    data.preprocess()
+
+    result = pimc.BoxResultPM(data=data)
+    result.path_root = path_root
+    result.id_job = 0 if number_of_processes is None else number_of_processes
+
+    start = time.perf_counter()
+    if number_of_processes is None:
+        pimc.block_compute_pm(data, result)
+    else:
+        pimc.block_compute_pm_parallel(data, result, number_of_processes)
+    return time.perf_counter() - start
+
+
+def report_throughput(path, beads, samples, block_size):
+    pstr = "P={:>4d}   processes {:>6s}   {:>10.1f} samples/s   speedup {:5.2f}   efficiency {:5.1%}"
+    FS = fs.FileStructure(path, 1, id_rho=1)
+    FS.generate_model_hashes()
+    cores = pimc.available_cpus()
+    counts = [2**i for i in range(cores.bit_length()) if 2**i < cores] + [cores]
+
+    # the results are written to a temporary directory so the test models are left untouched
+    with tempfile.TemporaryDirectory() as path_root:
+        serial = run(FS, path_root, beads, samples, block_size)
+        print(pstr.format(beads, "serial", samples / serial, 1., 1.))
+        for n in counts:
+            elapsed = run(FS, path_root, beads, samples, block_size, n)
+            print(pstr.format(beads, str(n), samples / elapsed, serial / elapsed, serial / elapsed / n))
+
+
+def main():
+    path = join(dirname(dirname(inspect.getfile(pibronic))), "tests/test_models/")
+    samples = int(1e4)
+    block_size = int(1e2)
+    for beads in [12, 64]:
+        report_throughput(path, beads, samples, block_size)
+
+
+if __name__ == "__main__":
+    main()
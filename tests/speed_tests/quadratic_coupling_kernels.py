@@ -0,0 +1,64 @@
+# this file is to demonstrate timing for building the coupling matrix with each quadratic kernel
+# it compares the dense einsum with the diagonal, sparse and low rank kernels on quadratic terms of each structure
+# and is where the relative costs used by ModelVibronic.analyse_coupling_structure() come from
+
+from .context import pibronic
+import timeit
+
+setupstr = '''
+import numpy as np
+from pibronic import pimc
+
+B, P, N, A = {B:d}, {P:d}, {N:d}, {A:d}
+
+data = pimc.BoxData()
+data.block_size, data.beads, data.modes, data.states = B, P, N, A
+data.size = {{key: tuple(dict(B=B, P=P, N=N, A=A)[letter] for letter in key)
+             for key in ['A', 'N', 'AA', 'AN', 'NAA', 'NNAA', 'BNP', 'BPA', 'BPAA', 'BAA']}}
+data.quadratic_kernel = "{kernel:s}"
+
+data.vib = pimc.ModelVibronic(data)
+data.vib.linear = np.random.normal(size=(N, A, A))
+data.vib.linear += data.vib.linear.transpose(0, 2, 1)
+terms = np.random.normal(size=(N, N, A, A))
+if "{structure:s}" == "diagonal":
+    terms *= np.eye(N)[:, :, np.newaxis, np.newaxis]
+elif "{structure:s}" == "low_rank":
+    vectors = np.random.normal(size=(2, N, A, A))
+    terms = np.einsum('rjab, rkab->jkab', vectors, vectors)
+data.vib.quadratic = terms + terms.transpose(0, 1, 3, 2)
+data.vib.analyse_coupling_structure(data)
+
+data.workspace = pimc.pimc.BoxWorkspace(data)
+data.qTensor = np.random.normal(size=(B, N, P))
+data.coupling_matrix = np.empty((B, P, A, A))
+'''
+
+build = '''
+pimc.pimc.build_coupling_matrix(data)'''
+
+
+def compare_kernels(R, N):
+    pstr = "N={:>4d} {:>9s}   " + "   ".join(["{:s} {:>8s}"] * 4)
+    B, P, A = 20, 15, 4
+    for modes in [4, 12, 32, 64, 128]:
+        for structure in ["dense", "diagonal", "low_rank"]:
+            timings = []
+            for kernel in ["dense", "diagonal", "sparse", "low_rank"]:
+                if kernel == "diagonal" and structure != "diagonal":
+                    timings += [kernel, "-"]
+                    continue
+                setup = setupstr.format(B=B, P=P, N=modes, A=A, kernel=kernel, structure=structure)
+                t = min(timeit.repeat(stmt=build, setup=setup, repeat=R, number=N))
+                timings += [kernel, "{:.5f}".format(t)]
+            print(pstr.format(modes, structure, *timings))
+
+
+def main():
+    R = 3
+    N = 20
+    compare_kernels(R, N)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# this file is to validate BoxData.dtype = np.float32 against the default np.float64 path
+# each system in tests/test_models is run with both precisions on the same samples
+# and the bias of the estimate of Z_g / Z_rho = <g/rho> is reported relative to its statistical error
+# along with the largest error of a single sample and the time each precision took
+
+from .context import pibronic
+import inspect
+import time
+from os.path import dirname, join
+
+import numpy as np
+
+from pibronic import pimc
+import pibronic.data.file_structure as fs
+
+
+def run(FS, dtype, beads, samples, block_size):
+    """returns the g and rho of each sample for the system FS computed in dtype, and the time it took"""
+    data = pimc.BoxData.from_FileStructure(FS)
+    data.samples = samples
+    data.block_size = block_size
+    data.blocks = samples // block_size
+    data.beads = beads
+    data.temperature = 300.0
+    data.seed = 242351
+    data.dtype = dtype
+    data.preprocess()
+
+    result = pimc.BoxResult(data=data)
+    start = time.perf_counter()
+    pimc.pimc.compute_blocks(data, result, range(data.blocks))
+    return result.scaled_g, result.scaled_rho, time.perf_counter() - start
+
+
+def report_bias(path, beads, samples, block_size):
+    pstr = "data {:d} rho {:d} P={:>4d}   bias {: .3e} ({: .2f} sigma)   worst sample {:.3e}   float64 {:.3f}s   float32 {:.3f}s"
+    for id_data in [0, 1]:
+        for id_rho in [0, 1]:
+            FS = fs.FileStructure(path, id_data, id_rho=id_rho)
+            g, rho, t_double = run(FS, np.float64, beads, samples, block_size)
+            g_single, rho_single, t_single = run(FS, np.float32, beads, samples, block_size)
+
+            ratio, ratio_single = g / rho, g_single / rho_single
+            estimate = ratio.mean()
+            error = ratio.std(ddof=1) / np.sqrt(samples)
+            bias = (ratio_single.mean() - estimate) / estimate
+            worst = np.amax(np.abs(ratio_single - ratio) / np.abs(ratio))
+            # when rho is the system itself g/rho is a constant and has no statistical error
+            sigmas = bias * estimate / error if error > 0. else 0.
+            print(pstr.format(id_data, id_rho, beads, bias, sigmas, worst, t_double, t_single))
+
+
+def main():
+    path = join(dirname(dirname(inspect.getfile(pibronic))), "tests/test_models/")
+    samples = int(1e4)
+    block_size = int(1e3)
+    for beads in [12, 64, 256]:
+        report_bias(path, beads, samples, block_size)
+
+
+if __name__ == "__main__":
+    main()
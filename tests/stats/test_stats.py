@@ -1,13 +1,14 @@
 """ """
 
 # system imports
-# import inspect
+import inspect
 from functools import partial
 import random
+import shutil
 import string
 import json
 import os
-# from os.path import dirname, join
+from os.path import dirname, join
 
 
 # local imports
@@ -16,6 +17,7 @@ import pibronic.stats.stats as st
 import pibronic.data.file_structure as fs
 from pibronic.vibronic import vIO
 from pibronic.constants import boltzman
+from pibronic import pimc
 from pibronic.pimc import BoxResultPM
 
 # third party imports
@@ -103,6 +105,225 @@ def test_estimate_basic_properties():
     return
 
 
+def test_calculate_derivative_property_terms():
+    X = 100
+    rho = np.full(X, 2.0)
+    g = np.ones(X)
+    dg = np.full(X, 3.0)
+    d2g = np.full(X, 4.0)
+
+    ret = st.calculate_derivative_property_terms(rho, g, dg, d2g)
+
+    assert np.all(ret[0] == 0.5)
+    assert np.all(ret[1] == 1.5)
+    assert np.all(ret[2] == 2.0)
+    return
+
+
+def test_estimate_derivative_properties():
+    X = 100
+    T = 300.00
+    g_r = np.ones(X)
+    d1 = np.ones(X)
+    d2 = np.ones(X) + 1
+
+    # the estimates are the same as the basic ones
+    ret = st.estimate_derivative_properties(X, T, g_r, d1, d2)
+    basic = st.estimate_basic_properties(X, T, g_r, d1, d2)
+    for key in ["Z", "E", "Cv"]:
+        assert ret[key] == basic[key]
+
+    # but the errors of E and Cv come from the spread of the samples
+    assert ret["E error"] == 0.0
+    assert ret["Cv error"] == 0.0
+
+    d1 = d1 + np.random.normal(scale=0.1, size=X)
+    ret = st.estimate_derivative_properties(X, T, g_r, d1, d2)
+    assert np.isclose(ret["E error"], np.std(d1) / np.sqrt(X - 1))
+    assert ret["Cv error"] > 0.0
+    return
+
+
+def test_estimate_effective_sample_size():
+    X = 100
+    weights = np.ones((X, 2))
+    weights[:, 1] = 0.0
+    weights[0, 1] = 1.0
+
+    # equal weights keep every sample, a single non-zero weight keeps one
+    assert np.allclose(st.estimate_effective_sample_size(weights), [X, 1.0])
+    # the magnitude of negative weights is used
+    assert np.isclose(st.estimate_effective_sample_size(-weights[:, 0]), X)
+    return
+
+
+def test_estimate_reweighted_properties():
+    X = 100
+    temperatures = [290.00, 300.00]
+    g_r, sym1, sym2 = np.random.rand(3, X, 2)
+
+    ret = st.estimate_reweighted_properties(X, temperatures, g_r, sym1, sym2)
+
+    assert ret["temperatures"] == temperatures
+    for k, T in enumerate(temperatures):
+        expected = st.estimate_basic_properties(X, T, g_r[:, k], sym1[:, k], sym2[:, k])
+        for key in ["Z", "Z error", "E", "Cv"]:
+            assert np.isclose(ret[key][k], expected[key])
+        assert 0.0 < ret["ESS"][k] <= X
+    return
+
+
+@pytest.fixture()
+def model_FS(root):
+    """a copy of the second test data set to write results to, with a placeholder analytic results file"""
+    path = join(dirname(dirname(inspect.getfile(pibronic))), "tests/test_models/")
+    shutil.copytree(join(path, "data_set_1"), join(root, "data_set_1"), ignore=shutil.ignore_patterns("results"))
+    FS = fs.FileStructure(str(root), 1, id_rho=1)
+    FS.generate_model_hashes()
+
+    # non zero harmonic contributions so that they can't be left out unnoticed
+    analytic = {T: {"Z_sampling": 1.0, "E_sampling": E, "Cv_sampling": Cv, "Z_sampling+beta": 1.0, "Z_sampling-beta": 1.0}
+                for T, E, Cv in [("300.00", 0.25, 0.5), ("290.00", 0.2, 0.4)]}
+    with open(FS.path_analytic_rho, 'w') as file:
+        json.dump({"hash_vib": FS.hash_vib, "hash_rho": FS.hash_rho, **analytic}, file)
+    return FS
+
+
+def block_compute_and_analyse(FS, method, **flags):
+    """computes 20 samples at 300K with the given BoxData flags and returns the data, the results
+    and the dictionary statistical_analysis_of_pimc() saved for them"""
+    data = pimc.BoxData()
+    data.path_vib_model = FS.path_vib_model
+    data.path_rho_model = FS.path_rho_model
+    data.hash_vib = FS.hash_vib
+    data.hash_rho = FS.hash_rho
+    data.states = 2
+    data.modes = 2
+    data.samples = 20
+    data.beads = 8
+    data.temperature = 300.0
+    data.block_size = 10
+    data.blocks = 2
+    data.seed = 242351
+    for name, value in flags.items():
+        setattr(data, name, value)
+    data.preprocess()
+
+    result = pimc.BoxResult(data=data)
+    result.path_root = FS.path_rho_results
+    pimc.block_compute(data, result)
+
+    st.statistical_analysis_of_pimc(FS, method=method)
+
+    with open(FS.template_jackknife.format(P=data.beads, T=data.temperature, X=data.samples), 'r') as file:
+        return data, result, json.loads(file.read())
+
+
+def test_reweighted_statistical_analysis(model_FS):
+    """at the reference temperature E and Cv have to agree with the analytic derivatives of g"""
+    data, result, ret = block_compute_and_analyse(model_FS, "reweighted", derivatives=True,
+                                                  reweight_temperatures=[300.0, 290.0])
+
+    assert ret["temperatures"] == data.reweight_temperatures.tolist()
+    assert ret["reference temperature"] == data.temperature
+    assert len(ret["E"]) == len(ret["Cv"]) == len(ret["ESS"]) == 2
+
+    # the same run analysed with the derivative method, both include the harmonic contribution
+    st.statistical_analysis_of_pimc(model_FS, method="derivative")
+    with open(model_FS.template_jackknife.format(P=data.beads, T=data.temperature, X=data.samples), 'r') as file:
+        expected = json.loads(file.read())
+    assert np.isclose(ret["Z"][0], expected["Z"])
+    assert np.isclose(ret["E"][0], expected["E"], rtol=1e-4)
+    assert np.isclose(ret["Cv"][0], expected["Cv"], rtol=1e-2)
+    return
+
+
+def test_multiple_rho_statistical_analysis(model_FS):
+    """the antithetic pairs have to be averaged before the extra sampling models are compared"""
+    path_other_rho = fs.FileStructure(model_FS.path_root, 1, id_rho=0).path_rho_model
+    data, result, ret = block_compute_and_analyse(model_FS, "multiple_rho", antithetic=True, extra_rho_ids=[1, 0],
+                                                  path_extra_rho_models=[model_FS.path_rho_model, path_other_rho])
+
+    assert ret["rho ids"] == [1, 0]
+    assert ret["temperature"] == data.temperature
+
+    X = data.samples // 2
+    pairs = [term.reshape(X, 2, *term.shape[1:]).mean(axis=1)
+             for term in st.calculate_multiple_rho_terms(*st.extract_multiple_rho_data(result))]
+    expected = st.estimate_multiple_rho_properties(X, data.extra_rho_ids, *pairs)
+    for key in ["Z", "ESS", "relative variance", "relative cost"]:
+        assert np.allclose(ret[key], expected[key])
+    # the sampling model itself keeps every pair
+    assert np.isclose(ret["ESS"][0], X)
+    return
+
+
+def test_estimate_multiple_rho_properties():
+    X = 1000
+    g_r = np.random.rand(X) + 0.5
+    # the first model is the proposal itself, the second is the proposal with half the normalization
+    weights = np.ones((X, 2))
+    weights[:, 1] = 0.5
+
+    ret = st.estimate_multiple_rho_properties(X, [0, 1], g_r, weights)
+
+    assert ret["rho ids"] == [0, 1]
+    assert np.allclose(ret["Z"], [np.mean(g_r), 2. * np.mean(g_r)])
+    assert np.allclose(ret["ESS"], X)
+    # rescaling the sampling model doesn't change how well it samples
+    assert np.allclose(ret["relative variance"], ret["proposal relative variance"])
+    assert np.allclose(ret["relative cost"], 1.0)
+    return
+
+
+def test_pair_antithetic_terms():
+    X = 101
+    result_obj = BoxResultPM(X=X)
+    g_r = np.random.rand(X)
+    g_r_reweight = np.random.rand(X, 3)
+    constant = 2.0
+
+    # independent samples are returned as they are
+    number, terms = st.pair_antithetic_terms(result_obj, [g_r, constant])
+    assert number == X
+    assert terms[0] is g_r and terms[1] == constant
+
+    # each pair is averaged into one sample and the unpaired last sample is dropped
+    result_obj.antithetic = True
+    number, terms = st.pair_antithetic_terms(result_obj, [g_r, g_r_reweight, constant])
+    assert number == X // 2
+    assert np.allclose(terms[0], 0.5 * (g_r[0:-1:2] + g_r[1::2]))
+    assert np.allclose(terms[1], 0.5 * (g_r_reweight[0:-1:2] + g_r_reweight[1::2]))
+    assert terms[2] == constant
+
+    # perfectly anti-correlated pairs have no error
+    mirrored = np.repeat(np.random.rand(X // 2), 2) * np.tile([1., -1.], X // 2) + 1.
+    result_obj.samples = len(mirrored)
+    number, (paired, ) = st.pair_antithetic_terms(result_obj, [mirrored])
+    Z, Z_err = st.basic_estimate_Z_monte_carlo(paired, number)
+    assert np.isclose(Z, 1.0) and np.isclose(Z_err, 0.0)
+    return
+
+
+def test_apply_control_variates():
+    X = int(1e4)
+    control = np.random.normal(loc=2.0, size=X)
+    g_r = 3.0 * control + 0.1 * np.random.normal(size=X)
+    constant = np.full(X, 5.0)
+
+    terms, coefficients = st.apply_control_variates([g_r, constant], [control, constant], [2.0, 5.0])
+    assert np.isclose(coefficients[0], 3.0, rtol=1e-2)
+    # a control without any variance isn't used
+    assert coefficients[1] == 0.0 and np.array_equal(terms[1], constant)
+
+    # the adjusted term estimates the same mean with a much smaller error
+    Z, Z_err = st.basic_estimate_Z_monte_carlo(g_r, X)
+    Z_cv, Z_cv_err = st.basic_estimate_Z_monte_carlo(terms[0], X)
+    assert abs(Z_cv - 6.0) < 5. * Z_cv_err
+    assert Z_cv_err < 0.1 * Z_err
+    return
+
+
 def test_add_harmonic_contribution():
     nums = np.random.randint(0, 1000, size=4)
     test_dict = {"E": nums[0], "Cv": nums[1]}
@@ -175,6 +396,32 @@ def test_starmap_wrapper(monkeypatch, temp_FS):
     assert data["hash_rho"] == temp_FS.hash_rho
 
 
+def test_extract_scaled_data():
+    X = 50
+    result_obj = BoxResultPM(X=X)
+    result_obj.scaled_rho = np.random.rand(X)
+    result_obj.scaled_g = np.random.rand(X)
+    result_obj.scaled_gofr_plus = np.random.rand(X)
+    result_obj.scaled_gofr_minus = np.random.rand(X)
+
+    # without log scaling factors the arrays are returned as they are
+    data = st.extract_scaled_data(result_obj)
+    assert np.all(data[0] == result_obj.scaled_rho)
+    assert np.all(data[1] == result_obj.scaled_g)
+
+    # with log scaling factors the ratios with rho are preserved
+    result_obj.log_scale_rho = np.random.uniform(-800., 800., X)
+    result_obj.log_scale_g = result_obj.log_scale_rho + np.log(2.)
+    result_obj.log_scale_gofr_plus = result_obj.log_scale_rho
+    result_obj.log_scale_gofr_minus = result_obj.log_scale_rho - np.log(2.)
+
+    data = st.extract_scaled_data(result_obj)
+    assert np.allclose(data[1] / data[0], 2. * result_obj.scaled_g / result_obj.scaled_rho)
+    assert np.allclose(data[2] / data[0], result_obj.scaled_gofr_plus / result_obj.scaled_rho)
+    assert np.allclose(data[3] / data[0], 0.5 * result_obj.scaled_gofr_minus / result_obj.scaled_rho)
+    return
+
+
 class TestStatisticalAnalysisTypes():
 
     @pytest.fixture()